@@ -1,7 +1,47 @@
-from agent.agent_graph import opey_graph
-from agent.agent_graph_no_obp_tools import opey_graph_no_obp_tools
+import os
+
+from typing import Any
+
+from langgraph.graph.state import CompiledStateGraph
+
+from utils.startup_timing import startup_report
+
+
+def obp_calling_enabled() -> bool:
+    return os.getenv("DISABLE_OBP_CALLING") != "true"
+
+
+def get_opey_graph(obp_tools: bool | None = None) -> CompiledStateGraph:
+    """
+    Get the compiled Opey graph, compiling it on first use. Only the graph that is asked for is ever compiled.
+    Args:
+        obp_tools (bool, optional): Whether the graph can make calls to the OBP-API. Defaults to the DISABLE_OBP_CALLING setting.
+    """
+    if obp_tools is None:
+        obp_tools = obp_calling_enabled()
+
+    if obp_tools:
+        with startup_report.measure("init:graph:opey_graph"):
+            from agent.agent_graph import opey_graph
+        return opey_graph
+    else:
+        with startup_report.measure("init:graph:opey_graph_no_obp_tools"):
+            from agent.agent_graph_no_obp_tools import opey_graph_no_obp_tools
+        return opey_graph_no_obp_tools
+
+
+def __getattr__(name: str) -> Any:
+    # Keep `from agent import opey_graph` working without compiling both graphs on import
+    if name == "opey_graph":
+        return get_opey_graph(obp_tools=True)
+    if name == "opey_graph_no_obp_tools":
+        return get_opey_graph(obp_tools=False)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 __all__ = [
+        "get_opey_graph",
+        "obp_calling_enabled",
         "opey_graph",
         "opey_graph_no_obp_tools",
-    ]
\ No newline at end of file
+    ]
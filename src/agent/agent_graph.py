@@ -1,14 +1,16 @@
 from langgraph.graph import END, StateGraph, START
 from langgraph.prebuilt import tools_condition, ToolNode
-from langgraph.checkpoint.memory import MemorySaver
 
 from agent.components.states import OpeyGraphState
-from agent.components.nodes import run_opey, human_review_node, run_summary_chain
+from agent.utils.bounded_memory_saver import create_memory_saver
+from agent.components.nodes import run_opey, route_model, human_review_node, run_summary_chain
 from agent.components.edges import should_summarize, needs_human_review
 from agent.components.tools import obp_requests, glossary_retrieval_tool, endpoint_retrieval_tool
+from agent.utils.instrumentation import instrument_node
 
 
-memory = MemorySaver()
+# Replaced by the service's persistent checkpointer, this one bounds memory use everywhere else
+memory = create_memory_saver()
 
 opey_workflow = StateGraph(OpeyGraphState)
 
@@ -16,10 +18,11 @@ opey_workflow = StateGraph(OpeyGraphState)
 all_tools = ToolNode([glossary_retrieval_tool, endpoint_retrieval_tool, obp_requests])
 
 # Add Nodes to graph
-opey_workflow.add_node("opey", run_opey)
-opey_workflow.add_node("human_review", human_review_node)
-opey_workflow.add_node("tools", all_tools)
-opey_workflow.add_node("summarize_conversation", run_summary_chain)
+opey_workflow.add_node("route_model", instrument_node("opey", "route_model", route_model))
+opey_workflow.add_node("opey", instrument_node("opey", "opey", run_opey))
+opey_workflow.add_node("human_review", instrument_node("opey", "human_review", human_review_node))
+opey_workflow.add_node("tools", instrument_node("opey", "tools", all_tools))
+opey_workflow.add_node("summarize_conversation", instrument_node("opey", "summarize_conversation", run_summary_chain))
 
 opey_workflow.add_conditional_edges(
     "opey",
@@ -41,8 +44,9 @@ opey_workflow.add_conditional_edges(
 )
 
 opey_workflow.add_edge("human_review", "tools")
-opey_workflow.add_edge(START, "opey")
-opey_workflow.add_edge("tools", "opey")
+opey_workflow.add_edge(START, "route_model")
+opey_workflow.add_edge("route_model", "opey")
+opey_workflow.add_edge("tools", "route_model")
 opey_workflow.add_edge("summarize_conversation", END)
 
 opey_graph = opey_workflow.compile(checkpointer=memory, interrupt_before=["human_review"])
\ No newline at end of file
@@ -1,14 +1,16 @@
 from langgraph.graph import END, StateGraph, START
 from langgraph.prebuilt import tools_condition, ToolNode
-from langgraph.checkpoint.memory import MemorySaver
 
 from agent.components.states import OpeyGraphState
-from agent.components.nodes import run_opey, human_review_node, run_summary_chain
+from agent.utils.bounded_memory_saver import create_memory_saver
+from agent.components.nodes import run_opey, route_model, human_review_node, run_summary_chain
 from agent.components.edges import should_summarize, needs_human_review
 from agent.components.tools import glossary_retrieval_tool, endpoint_retrieval_tool
+from agent.utils.instrumentation import instrument_node
 
 
-memory = MemorySaver()
+# Replaced by the service's persistent checkpointer, this one bounds memory use everywhere else
+memory = create_memory_saver()
 
 opey_workflow = StateGraph(OpeyGraphState)
 
@@ -16,9 +18,10 @@ opey_workflow = StateGraph(OpeyGraphState)
 all_tools = ToolNode([glossary_retrieval_tool, endpoint_retrieval_tool])
 
 # Add Nodes to graph
-opey_workflow.add_node("opey", run_opey)
-opey_workflow.add_node("tools", all_tools)
-opey_workflow.add_node("summarize_conversation", run_summary_chain)
+opey_workflow.add_node("route_model", instrument_node("opey_no_obp_tools", "route_model", route_model))
+opey_workflow.add_node("opey", instrument_node("opey_no_obp_tools", "opey", run_opey))
+opey_workflow.add_node("tools", instrument_node("opey_no_obp_tools", "tools", all_tools))
+opey_workflow.add_node("summarize_conversation", instrument_node("opey_no_obp_tools", "summarize_conversation", run_summary_chain))
 
 
 # Route to RAG tools or not
@@ -40,8 +43,9 @@ opey_workflow.add_conditional_edges(
     }
 )
 
-opey_workflow.add_edge(START, "opey")
-opey_workflow.add_edge("tools", "opey")
+opey_workflow.add_edge(START, "route_model")
+opey_workflow.add_edge("route_model", "opey")
+opey_workflow.add_edge("tools", "route_model")
 opey_workflow.add_edge("summarize_conversation", END)
 
 opey_graph_no_obp_tools = opey_workflow.compile(checkpointer=memory)
\ No newline at end of file
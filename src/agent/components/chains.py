@@ -1,14 +1,16 @@
 # Description: Contains the chains for the main agent system
-from langchain import hub
 from langchain_core.prompts import SystemMessagePromptTemplate, PromptTemplate, ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
+from langchain_core.runnables import Runnable
 
-from agent.utils.model_factory import get_llm
+from agent.utils.model_factory import get_llm, get_tool_calling_llm, model_registry
+from agent.utils.rate_limiter import with_llm_priority
 from agent.components.tools import obp_requests, glossary_retrieval_tool, endpoint_retrieval_tool
 
+from functools import cache
 from pydantic import BaseModel, Field
+from typing import Literal
 
 ### Main Opey agent
 # Prompt
@@ -37,11 +39,60 @@ prompt = ChatPromptTemplate.from_messages(
 
 #prompt = hub.pull("opey_main_agent")
 
-# LLM
-llm = get_llm(size='medium', temperature=0.7).bind_tools([obp_requests, glossary_retrieval_tool, endpoint_retrieval_tool])
+opey_tools = [obp_requests, glossary_retrieval_tool, endpoint_retrieval_tool]
 
-# Chain
-opey_agent = prompt | llm 
+# One chain per selectable model, built on first use from the shared model registry.
+# All chains in this module are built lazily, so importing it doesn't construct any models
+_opey_agents: dict[str, Runnable] = {}
+
+def get_opey_agent(model: str = "medium") -> Runnable:
+    """
+    Get the main Opey agent chain running on the given model.
+    Args:
+        model (str): A size alias ('small' or 'medium') or any model name available in the model registry.
+    """
+    if model not in _opey_agents:
+        # LLM
+        llm = get_tool_calling_llm(size=model, temperature=0.7, tools=opey_tools, role="opey_agent")
+        # Chain
+        _opey_agents[model] = with_llm_priority(prompt | llm, "interactive")
+    return _opey_agents[model]
+
+def prebuild_opey_agents() -> None:
+    """Build the Opey agent chain for every selectable model, so that per-request model selection is just a lookup."""
+    for model in ["medium", "small"] + model_registry.available_models():
+        get_opey_agent(model)
+
+
+### Model Router
+# Optional small-model classifier, only consulted when the routing heuristics can't decide
+
+class TurnComplexity(BaseModel):
+    complexity: Literal["simple", "complex"] = Field(description="'simple' if the turn can be answered without calling tools or reasoning over API documentation, otherwise 'complex'.")
+
+turn_router_system_prompt = """You are a router for an assistant for the Open Bank Project (OBP) API.
+Given the conversation below, decide whether answering the latest message is simple or complex.
+
+A turn is simple if it is small talk, asks to restate or reformat information already present in the conversation,
+or asks for a short definition of a banking or OBP term.
+A turn is complex if it needs API endpoints to be looked up, requests to the OBP API to be made, or multi-step reasoning.
+If you are unsure, answer complex.
+"""
+
+turn_router_prompt_template = ChatPromptTemplate.from_messages(
+    [
+        SystemMessage(content=turn_router_system_prompt),
+        MessagesPlaceholder("messages"),
+    ]
+)
+
+@cache
+def get_turn_router_chain() -> Runnable:
+    # The router sits in front of the main agent, so the user is waiting on it
+    return with_llm_priority(
+        turn_router_prompt_template | get_llm(size='small', temperature=0).with_structured_output(TurnComplexity),
+        "interactive",
+    )
 
 
 ### Retrieval Query Formulator
@@ -168,8 +219,10 @@ query_formulator_prompt_template = ChatPromptTemplate.from_messages(
     ]
 )
 
-query_formulator_llm = get_llm(size='medium', temperature=0).with_structured_output(QueryFormulatorOutput)
-query_formulator_chain = query_formulator_prompt_template | query_formulator_llm
+@cache
+def get_query_formulator_chain() -> Runnable:
+    query_formulator_llm = get_llm(size='medium', temperature=0, chain_name='query_formulator').with_structured_output(QueryFormulatorOutput)
+    return with_llm_priority(query_formulator_prompt_template | query_formulator_llm, "background")
 
 
 ### Conversation Summarizer
@@ -190,5 +243,10 @@ conversation_summarizer_system_prompt_template = PromptTemplate.from_template(
     """
 )
 
-conversation_summarizer_llm = get_llm(size='medium', temperature=0)
-conversation_summarizer_chain = conversation_summarizer_system_prompt_template | conversation_summarizer_llm | StrOutputParser()
\ No newline at end of file
+@cache
+def get_conversation_summarizer_chain() -> Runnable:
+    conversation_summarizer_llm = get_llm(size='medium', temperature=0, chain_name='conversation_summarizer')
+    return with_llm_priority(
+        conversation_summarizer_system_prompt_template | conversation_summarizer_llm | StrOutputParser(),
+        "background",
+    )
@@ -1,31 +1,33 @@
+import logging
 import os
 
 from agent.components.states import OpeyGraphState
 from langgraph.graph import END
 from typing import Literal 
 
+logger = logging.getLogger("uvicorn.error")
+
 def should_summarize(state: OpeyGraphState) -> Literal["summarize_conversation", END]:
     """
     Conditional edge to route to conversation summarizer or not
     """
-    print("----- DECIDING WHETHER TO SUMMARIZE -----")
     messages = state["messages"]
     total_tokens = state["total_tokens"]
-    print(f"Total tokens in conversation: {total_tokens}")
+    logger.debug("Deciding whether to summarize, total tokens in conversation: %s", total_tokens)
 
     if not total_tokens:
         raise ValueError("Total tokens not found in state")
 
     token_limit = os.getenv("CONVERSATION_TOKEN_LIMIT")
     if not token_limit:
-        print("Token limit (CONVERSATION_TOKEN_LIMIT) not set in environment variables, defaulting to 50000")
+        logger.debug("Token limit (CONVERSATION_TOKEN_LIMIT) not set in environment variables, defaulting to 50000")
         token_limit = 50000
         
     if total_tokens >= int(token_limit):
-        print(f"Conversation more than token limit of {token_limit}, Descision: Summarize")
+        logger.info("Conversation more than token limit of %s, summarizing", token_limit)
         return "summarize_conversation"
     # Otherwise we can just end
-    print(f"Conversation less than token limit of {token_limit}, Descision: Do not summarize")
+    logger.debug("Conversation less than token limit of %s, not summarizing", token_limit)
     return END
         
 def needs_human_review(state:OpeyGraphState) -> Literal["human_review", "tools", END]:
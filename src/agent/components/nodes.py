@@ -2,25 +2,27 @@ import json
 import uuid
 import os
 import logging
+import time
 
 from typing import List
 
-from pprint import pprint
-
-from langchain_openai.chat_models import ChatOpenAI
-from langchain_anthropic.chat_models import ChatAnthropic
-from langchain_core.messages import ToolMessage, SystemMessage, RemoveMessage, AIMessage, trim_messages
+from langchain_core.messages import ToolMessage, SystemMessage, RemoveMessage, AIMessage, HumanMessage, trim_messages
+from langchain_core.runnables import RunnableConfig
 #from langchain_community.callbacks import get_openai_callback, get_bedrock_anthropic_callback
 
-from agent.components.chains import opey_agent, query_formulator_chain
-from agent.components.sub_graphs.endpoint_retrieval.endpoint_retrieval_graph import endpoint_retrieval_graph
-from agent.components.sub_graphs.glossary_retrieval.glossary_retrieval_graph import glossary_retrieval_graph
+from agent.components.chains import get_opey_agent, get_turn_router_chain, get_conversation_summarizer_chain
+from agent.components.routing import route_by_heuristics
 from agent.components.states import OpeyGraphState
-from agent.components.chains import conversation_summarizer_chain
 from agent.utils.model_factory import get_llm
+from utils.logs import Payload
+from utils.metrics import metrics
 
 logger = logging.getLogger("uvicorn.error")
 
+model_route_counter = metrics.counter("opey_model_route_total", "Turns routed to each model size, by route and reason")
+opey_llm_latency = metrics.histogram("opey_llm_latency_seconds", "Latency of the main Opey LLM call, by route and model")
+opey_llm_tokens = metrics.counter("opey_llm_tokens_total", "Tokens used by the main Opey LLM call, by route and kind")
+
 async def run_summary_chain(state: OpeyGraphState):
     logger.info("----- SUMMARIZING CONVERSATION -----")
     state["current_state"] = "summarize_conversation"
@@ -40,7 +42,7 @@ async def run_summary_chain(state: OpeyGraphState):
     messages = state["messages"]
 
     # After we summarize we reset the token_count to zero, this will be updated when Opey is next called
-    summary = await conversation_summarizer_chain.ainvoke({"messages": messages, "existing_summary_message": summary_system_message})
+    summary = await get_conversation_summarizer_chain().ainvoke({"messages": messages, "existing_summary_message": summary_system_message})
 
     logger.debug(f"\nSummary: {summary}\n")
 
@@ -58,7 +60,7 @@ async def run_summary_chain(state: OpeyGraphState):
     for i, trimmed_messages_msg in enumerate(trimmed_messages):
         # Stop at each ToolMessage to find the AIMessage that called it
         if isinstance(trimmed_messages_msg, ToolMessage):
-            print(f"Checking tool message {trimmed_messages_msg}")
+            logger.debug("Checking tool message %s", Payload(trimmed_messages_msg))
             tool_call_id = trimmed_messages_msg.tool_call_id
             found_tool_call = False
             for k, msg in enumerate(messages):
@@ -79,9 +81,7 @@ async def run_summary_chain(state: OpeyGraphState):
             i, msg = pair
             trimmed_messages.insert(i, msg)
 
-    print(f"\nTrimmed messages:\n")
-    for msg in trimmed_messages:
-        msg.pretty_print()
+    logger.debug("Trimmed messages:\n%s", Payload(trimmed_messages))
     delete_messages = [RemoveMessage(id=message.id) for message in messages if message not in trimmed_messages]
 
     # Reset total tokens count, this is fine to do even though messages remain in the state as the tokens are counted 
@@ -90,7 +90,42 @@ async def run_summary_chain(state: OpeyGraphState):
 
     return {"messages": delete_messages, "conversation_summary": summary, "total_tokens": total_tokens}
     
-async def run_opey(state: OpeyGraphState):
+async def route_model(state: OpeyGraphState, config: RunnableConfig):
+    """
+    Decide whether Opey should answer this turn with the small or the medium model.
+    Cheap heuristics are tried first, the small model classifier is only consulted if they can't decide
+    and MODEL_ROUTER_CLASSIFIER is enabled.
+    """
+    # A model picked by the user always wins over routing
+    if config.get("configurable", {}).get("model") or state.get("selected_model"):
+        model_route_counter.inc(route="pinned", reason="selected_model")
+        return {"model_route": "medium"}
+
+    if os.getenv("MODEL_ROUTING", "true") != "true":
+        model_route_counter.inc(route="medium", reason="routing_disabled")
+        return {"model_route": "medium"}
+
+    messages = state["messages"]
+    decision = route_by_heuristics(messages)
+
+    if decision is None and os.getenv("MODEL_ROUTER_CLASSIFIER") == "true":
+        # Only send plain conversation turns, tool messages without their tool calls are rejected by providers
+        conversation = [
+            msg for msg in messages
+            if isinstance(msg, HumanMessage) or (isinstance(msg, AIMessage) and not msg.tool_calls)
+        ][-6:]
+        try:
+            result = await get_turn_router_chain().ainvoke({"messages": conversation})
+            decision = ("small" if result.complexity == "simple" else "medium", "classifier")
+        except Exception as e:
+            logger.warning(f"Model router classifier failed, defaulting to medium model: {e}")
+
+    route, reason = decision or ("medium", "default")
+    logger.debug(f"Routing turn to {route} model ({reason})")
+    model_route_counter.inc(route=route, reason=reason)
+    return {"model_route": route}
+
+async def run_opey(state: OpeyGraphState, config: RunnableConfig):
 
     # Check if we have a convesration summary
     summary = state.get("conversation_summary", "")
@@ -100,20 +135,35 @@ async def run_opey(state: OpeyGraphState):
     else:
         messages = state["messages"]
 
-    response = await opey_agent.ainvoke({"messages": messages})
+    # A model passed in the config for this request takes precedence, and is remembered for the rest of the thread
+    requested_model = config.get("configurable", {}).get("model")
+    pinned_model = requested_model or state.get("selected_model")
+    route = "pinned" if pinned_model else state.get("model_route") or "medium"
+    model = pinned_model or route
+
+    start = time.perf_counter()
+    response = await get_opey_agent(model).ainvoke({"messages": messages})
+    opey_llm_latency.observe(time.perf_counter() - start, route=route, model=model)
+    if response.usage_metadata:
+        opey_llm_tokens.inc(response.usage_metadata["input_tokens"], route=route, kind="prompt")
+        opey_llm_tokens.inc(response.usage_metadata["output_tokens"], route=route, kind="completion")
 
     # Count the tokens in the messages
     total_tokens = state.get("total_tokens", 0)
-    llm = get_llm("medium")
+    llm = get_llm(model)
 
     try:
         total_tokens += llm.get_num_tokens_from_messages(messages)
     except NotImplementedError as e:
         # Note that this defaulting to gpt-4o wont work if there is no OpenAI API key in the env, so will probably need to find another defaulting method
-        print(f"could not count tokens for model provider {os.getenv('MODEL_PROVIDER')}:\n{e}\n\ndefaulting to OpenAI GPT-4o counting...")
+        logger.warning("Could not count tokens for model provider %s: %s, defaulting to OpenAI GPT-4o counting", os.getenv('MODEL_PROVIDER'), e)
+        from langchain_openai.chat_models import ChatOpenAI
         total_tokens += ChatOpenAI(model='gpt-4o').get_num_tokens_from_messages(messages)
 
-    return {"messages": response, "total_tokens": total_tokens}
+    output = {"messages": response, "total_tokens": total_tokens}
+    if requested_model:
+        output["selected_model"] = requested_model
+    return output
 
 async def return_message(state: OpeyGraphState):
     """
@@ -123,5 +173,5 @@ async def return_message(state: OpeyGraphState):
 
 async def human_review_node(state):
     state["current_state"] = "human_review"
-    print("Awaiting human approval for tool call...")
+    logger.info("Awaiting human approval for tool call")
     pass
@@ -0,0 +1,131 @@
+# Description: Cheap heuristics for routing simple turns to the small model
+import re
+
+from typing import Literal
+
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage, ToolMessage
+
+Route = Literal["small", "medium"]
+
+# Short social turns that never need tools or reasoning
+_GREETING_PATTERN = re.compile(
+    r"^(hi|hello|hey|hiya|thanks|thank you|thx|cheers|ok|okay|great|cool|nice|bye|goodbye|good (morning|afternoon|evening))"
+    r"(,? (there|opey|again|so much|very much|a lot))*[\s!.,?]*$"
+)
+_GREETING_MAX_WORDS = 6
+
+# Questions and offers from Opey, after which "ok" or "great" is a confirmation rather than small talk
+_OFFER_PATTERN = re.compile(
+    r"\?\s*$|(\b(shall|should|can|could) i\b|\bwould you like\b|\bdo you want\b|\blet me know if\b|\bi can (also )?\w+ )[^.!?]*[.!?]?\s*$"
+)
+
+# Follow ups that only ask to restate or reformat what the last tool call returned. The whole message has to match,
+# so that a follow up adding anything new, i.e. "try again with account 123", still goes to the medium model
+_RESTATE_PATTERN = re.compile(
+    r"((can|could|would|will) you |please |pls |ok(ay)?,? |so,? )*"
+    r"(repeat|summari[sz]e|rephrase|reformat|list|show( me)?|say|what (was|were))"
+    r"( (it|that|this|them|those|these|they|the (results?|response|answer|list)))?"
+    r"( again| for me| please| briefly| in (a )?(table|list|short|bullet points))*"
+    r"[\s!.,?]*"
+)
+_RESTATE_MAX_WORDS = 15
+
+# Tools whose results can be presented by the small model without further reasoning
+_SIMPLE_TOOLS = frozenset({"retrieve_glossary"})
+
+
+def _message_text(message: AnyMessage) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return "".join(
+        item if isinstance(item, str) else item.get("text", "")
+        for item in message.content
+    )
+
+
+def _trailing_tool_messages(messages: list[AnyMessage]) -> list[ToolMessage]:
+    tool_messages = []
+    for message in reversed(messages):
+        if not isinstance(message, ToolMessage):
+            break
+        tool_messages.append(message)
+    return tool_messages
+
+
+def _replies_to_offer(messages: list[AnyMessage]) -> bool:
+    """Whether Opey's message before the last one ends in a question or an offer."""
+    for message in reversed(messages[:-1]):
+        if isinstance(message, AIMessage) and not message.tool_calls:
+            return bool(_OFFER_PATTERN.search(_message_text(message).strip().lower()))
+        if isinstance(message, HumanMessage):
+            return False
+    return False
+
+
+def _last_turn_used_tools(messages: list[AnyMessage]) -> bool:
+    """Whether any tool was called since the previous human message."""
+    for message in reversed(messages[:-1]):
+        if isinstance(message, HumanMessage):
+            return False
+        if isinstance(message, ToolMessage):
+            return True
+    return False
+
+
+def route_by_heuristics(messages: list[AnyMessage]) -> tuple[Route, str] | None:
+    """
+    Decide which model size should answer the current turn using only cheap checks on the messages.
+    Args:
+        messages (list[AnyMessage]): The conversation so far, the last message is the one Opey is answering.
+    Returns:
+        tuple[Route, str] | None: The route and the reason for it, or None if the heuristics can't decide.
+
+    >>> from langchain_core.messages import AIMessage
+    >>> history = [
+    ...     HumanMessage("Show me my accounts"),
+    ...     AIMessage("", tool_calls=[{"name": "obp_requests", "args": {}, "id": "call_1"}]),
+    ...     ToolMessage("[...]", tool_call_id="call_1", name="obp_requests"),
+    ...     AIMessage("You have two accounts."),
+    ... ]
+    >>> route_by_heuristics(history + [HumanMessage("Can you summarize that again?")])
+    ('small', 'restate')
+
+    Follow ups that need new tool calls are left to the medium model (or the classifier):
+
+    >>> route_by_heuristics(history + [HumanMessage("Try again with account 123")]) is None
+    True
+    >>> route_by_heuristics(history + [HumanMessage("Summarize transactions for account X")]) is None
+    True
+    >>> route_by_heuristics(history + [HumanMessage("List them again for bank gh.29.uk")]) is None
+    True
+
+    Short affirmatives are small talk, unless they accept a question or offer from Opey:
+
+    >>> route_by_heuristics(history + [HumanMessage("Thanks a lot!")])
+    ('small', 'greeting')
+    >>> route_by_heuristics([HumanMessage("Hi"), AIMessage("Shall I fetch your accounts?"), HumanMessage("ok")]) is None
+    True
+    >>> route_by_heuristics([HumanMessage("Hi"), AIMessage("I can list the banks for you if you like."), HumanMessage("great")]) is None
+    True
+    """
+    if not messages:
+        return None
+    last_message = messages[-1]
+
+    tool_messages = _trailing_tool_messages(messages)
+    if tool_messages:
+        if all(message.name in _SIMPLE_TOOLS for message in tool_messages):
+            return "small", "glossary_only"
+        return "medium", "tool_result"
+
+    if isinstance(last_message, HumanMessage):
+        text = _message_text(last_message).strip().lower()
+        n_words = len(text.split())
+        # i.e. "ok" in reply to "Shall I fetch your accounts?" confirms a tool call
+        if n_words <= _GREETING_MAX_WORDS and _GREETING_PATTERN.match(text) and not _replies_to_offer(messages):
+            return "small", "greeting"
+        # Previous turn must have used tools for there to be a result to restate
+        if n_words <= _RESTATE_MAX_WORDS and _RESTATE_PATTERN.fullmatch(text) and _last_turn_used_tools(messages):
+            return "small", "restate"
+
+    return None
@@ -1,9 +1,10 @@
 from langgraph.graph import MessagesState
-from pprint import pprint
 
 ### States
 class OpeyGraphState(MessagesState):
     conversation_summary: str
     current_state: str
     aggregated_context: str
-    total_tokens: int
\ No newline at end of file
+    total_tokens: int
+    selected_model: str
+    model_route: str
\ No newline at end of file
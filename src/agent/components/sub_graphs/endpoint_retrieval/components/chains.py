@@ -1,8 +1,10 @@
+from functools import cache
 from pydantic import BaseModel, Field
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable
 from agent.utils.model_factory import get_llm
+from agent.utils.rate_limiter import with_llm_priority
 
 ### Document Grader chain
 # For a given document, assesses whether it is relevant to the user's query
@@ -15,10 +17,7 @@ class GradeDocuments(BaseModel):
     binary_score: str = Field(
         description="Documents are relevant to the question, 'yes' or 'no'"
     )
-        
-llm = get_llm(size='small', temperature=0.1)
 
-llm_grader = llm.with_structured_output(GradeDocuments)
 
 grader_system_prompt = """You are a grader assessing the relevance of a retrieved API endpoint or glossary entry to a user question. \n
     if the document contains keywords(s) or semantic meaning relevant to the user's query or if it is an endpoint that would help them acheive a specified task, grade it as relevant.\n
@@ -35,14 +34,15 @@ grader_prompt_template = ChatPromptTemplate.from_messages(
     ]
 )
 
-retrieval_grader = grader_prompt_template | llm_grader
+@cache
+def get_retrieval_grader() -> Runnable:
+    llm = get_llm(size='small', temperature=0.1, chain_name='retrieval_grader')
+    llm_grader = llm.with_structured_output(GradeDocuments)
+    return with_llm_priority(grader_prompt_template | llm_grader, "background")
 
 
 ### Question Re-writer
 # NOTE: we may not end up using this in subsequent versions. Have to run retrieval graph against evals (also have to make evals)
-# LLM
-llm = get_llm(size='small', temperature=0.7)
-
 # Prompt
 system = """You are a question re-writer that converts an input question to a better version that is designed to find endpoints\n 
      in a vector index of API endpoints. Look at the input and try to reason about the underlying semantic intent / meaning.\n
@@ -163,6 +163,10 @@ re_write_prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-endpoint_question_rewriter = re_write_prompt | llm | StrOutputParser()
+@cache
+def get_endpoint_question_rewriter() -> Runnable:
+    # LLM
+    llm = get_llm(size='small', temperature=0.7, chain_name='endpoint_question_rewriter')
+    return with_llm_priority(re_write_prompt | llm | StrOutputParser(), "background")
 
 
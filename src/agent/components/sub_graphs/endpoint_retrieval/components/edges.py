@@ -1,8 +1,11 @@
 ### EDGES
+import logging
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
+
+logger = logging.getLogger("uvicorn.error")
               
 def decide_to_generate(state):
     """
@@ -15,24 +18,20 @@ def decide_to_generate(state):
         str: Binary decision for next node to call
     """
 
-    print("---ASSESS GRADED DOCUMENTS---")
     relevant_documents = state["relevant_documents"]
     retry_query = state["retry_query"]
     
     max_retries = int(os.getenv("ENDPOINT_RETRIEVER_MAX_RETRIES", 2))
 
     total_retries = state.get("total_retries", 0)
-    print(f"Total retries: {total_retries}")
-    print("Documents returned: \n", "\n".join(f"{doc.metadata["method"]} - {doc.metadata["path"]}" for doc in relevant_documents))
+    logger.debug("Assessing %d relevant endpoints after %d retries", len(relevant_documents), total_retries)
     
     if retry_query and (total_retries < max_retries):
         # All documents have been filtered check_relevance
         # We will re-generate a new query
-        print(
-            "---DECISION: ALL DOCUMENTS ARE NOT RELEVANT TO QUESTION, TRANSFORM QUERY---"
-        )
+        logger.debug("Too few relevant endpoints, transforming the query")
         return "transform_query"
     else:
         # We have relevant documents, so finish
-        print("---DECISION: RETURN DOCUMENTS---")
+        logger.debug("Returning the relevant endpoints")
         return "return_documents"
\ No newline at end of file
@@ -1,21 +1,30 @@
+import logging
 import os
 
 from langchain_core.documents import Document
 from typing import List
 from agent.components.sub_graphs.endpoint_retrieval.components.states import OutputState
-from agent.components.sub_graphs.retriever_config import setup_chroma_vector_store, setup_retriever
-from agent.components.sub_graphs.endpoint_retrieval.components.chains import retrieval_grader, endpoint_question_rewriter
+from agent.components.sub_graphs.retriever_config import get_retriever
+from agent.components.sub_graphs.endpoint_retrieval.components.chains import get_retrieval_grader, get_endpoint_question_rewriter
+from utils.metrics import metrics
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger("uvicorn.error")
+
 # Setup vector store and retriever
 retriever_batch_size = os.getenv("ENDPOINT_RETRIEVER_BATCH_SIZE", 5)
 retriever_retry_threshold = os.getenv("ENDPOINT_RETRIEVER_RETRY_THRESHOLD", 2)
 retriever_max_retries = os.getenv("ENDPOINT_RETRIEVER_MAX_RETRIES", 2)
 
-endpoint_vector_store = setup_chroma_vector_store("obp_endpoints")
-endpoint_retriever = setup_retriever(k=int(retriever_batch_size), vector_store=endpoint_vector_store)
+# The vector store is loaded on first retrieval, not on import
+ENDPOINT_COLLECTION = "obp_endpoints"
+
+retrieved_documents = metrics.histogram(
+    "opey_retrieval_documents", "Documents returned by each retrieval, by collection", buckets=(0, 1, 2, 3, 5, 8, 10, 15, 20, 50)
+)
+document_grades = metrics.counter("opey_retrieval_grades_total", "Retrieved documents graded relevant or not, by collection and grade (yes, no)")
 
 async def retrieve_endpoints(state):
     """
@@ -27,7 +36,6 @@ async def retrieve_endpoints(state):
     Returns:
         state (dict): New key added to state, documents, that contains retrieved documents
     """
-    print("---RETRIEVE ENDPOINTS---")
     rewritten_question = state.get("rewritten_question", "")
     total_retries = state.get("total_retries", 0)
     
@@ -37,13 +45,15 @@ async def retrieve_endpoints(state):
     else:
         question = state["question"]
     # Retrieval
+    endpoint_retriever = get_retriever(ENDPOINT_COLLECTION, k=int(retriever_batch_size))
     documents = await endpoint_retriever.ainvoke(question)
+    logger.debug("Retrieved %d endpoints", len(documents))
+    retrieved_documents.observe(len(documents), collection=ENDPOINT_COLLECTION)
     return {"documents": documents, "total_retries": total_retries}
 
 
 async def return_documents(state) -> OutputState:
     """Return the relevant documents"""
-    print("---RETRUN RELEVANT DOCUMENTS---")
     relevant_documents: List[Document] = state["relevant_documents"]
 
     output_docs = []
@@ -73,7 +83,6 @@ async def grade_documents(state):
         state (dict): Updates documents key with only filtered relevant documents
     """
 
-    print("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
     question = state["question"]
     documents = state["documents"]
     
@@ -82,17 +91,16 @@ async def grade_documents(state):
     # glossary_search = False
     retry_query = False
     for d in documents:
-        score = await retrieval_grader.ainvoke(
+        score = await get_retrieval_grader().ainvoke(
             {"question": question, "document": d.page_content}
         )
         grade = score.binary_score
+        document_grades.inc(collection=ENDPOINT_COLLECTION, grade="yes" if grade == "yes" else "no")
         if grade == "yes":
-            print(f"{d.metadata["method"]} - {d.metadata["path"]}", " [RELEVANT]")
-            #print("---GRADE: DOCUMENT RELEVANT---")
+            logger.debug("%s - %s [RELEVANT]", d.metadata["method"], d.metadata["path"])
             filtered_docs.append(d)
         else:
-            print(f"{d.metadata["method"]} - {d.metadata["path"]}", " [NOT RELEVANT]")
-            #print("---GRADE: DOCUMENT NOT RELEVANT---")
+            logger.debug("%s - %s [NOT RELEVANT]", d.metadata["method"], d.metadata["path"])
             continue
         
     # If there are less documents than the threshold then retry query after rewriting question
@@ -118,11 +126,10 @@ async def transform_query(state):
         state (dict): Updates question key with a re-phrased question
     """
 
-    print("---TRANSFORM QUERY---")
     question = state["question"]
     documents = state["documents"]
     total_retries = state.get("total_retries", 0)
     # Re-write question
-    better_question = await endpoint_question_rewriter.ainvoke({"question": question})
-    print(f"New query: \n{better_question}\n")
+    better_question = await get_endpoint_question_rewriter().ainvoke({"question": question})
+    logger.debug("New query: %s", better_question)
     return {"documents": documents, "rewritten_question": better_question}
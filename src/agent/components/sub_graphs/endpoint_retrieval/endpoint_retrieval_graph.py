@@ -2,16 +2,17 @@ from langgraph.graph import END, StateGraph, START
 from agent.components.sub_graphs.endpoint_retrieval.components.states import SelfRAGGraphState, OutputState, InputState
 from agent.components.sub_graphs.endpoint_retrieval.components.nodes import grade_documents, retrieve_endpoints, transform_query, return_documents
 from agent.components.sub_graphs.endpoint_retrieval.components.edges import decide_to_generate
+from agent.utils.instrumentation import instrument_node
 
 workflow = StateGraph(SelfRAGGraphState, input=InputState, output=OutputState)
 
 # Define the nodes
 # Define the nodes
 
-workflow.add_node("retrieve_endpoints", retrieve_endpoints)  # retrieve
-workflow.add_node("grade_documents", grade_documents)  # grade documents
-workflow.add_node("transform_query", transform_query)  # transform_query
-workflow.add_node("return_documents", return_documents)
+workflow.add_node("retrieve_endpoints", instrument_node("endpoint_retrieval", "retrieve_endpoints", retrieve_endpoints))  # retrieve
+workflow.add_node("grade_documents", instrument_node("endpoint_retrieval", "grade_documents", grade_documents))  # grade documents
+workflow.add_node("transform_query", instrument_node("endpoint_retrieval", "transform_query", transform_query))  # transform_query
+workflow.add_node("return_documents", instrument_node("endpoint_retrieval", "return_documents", return_documents))
 
 # Build graph
 workflow.add_edge(START, "retrieve_endpoints")
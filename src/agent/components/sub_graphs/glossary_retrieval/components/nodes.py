@@ -1,13 +1,14 @@
-from agent.components.sub_graphs.retriever_config import setup_chroma_vector_store, setup_retriever
-from agent.components.sub_graphs.endpoint_retrieval.components.chains import retrieval_grader
+import logging
+
+from agent.components.sub_graphs.retriever_config import get_retriever
+from agent.components.sub_graphs.endpoint_retrieval.components.chains import get_retrieval_grader
+from agent.components.sub_graphs.endpoint_retrieval.components.nodes import retrieved_documents, document_grades
 from agent.components.sub_graphs.glossary_retrieval.components.states import SelfRAGGraphState, OutputState, InputState
 
-try:
-    glossary_vector_store = setup_chroma_vector_store("obp_glossary")
-except:
-    print("Glossary vector store not found, check configuration")
+# The vector store is loaded on first retrieval, not on import
+GLOSSARY_COLLECTION = "obp_glossary"
 
-glossary_retriever = setup_retriever(k=8, vector_store=glossary_vector_store)
+logger = logging.getLogger("uvicorn.error")
 
 async def retrieve_glossary(state):
     """
@@ -19,7 +20,6 @@ async def retrieve_glossary(state):
     Returns:
         state (dict): New key added to state, documents, that contains retrieved documents
     """
-    print("---RETRIEVE ITEMS---")
     rewritten_question = state.get("rewritten_question", "")
     total_retries = state.get("total_retries", 0)
     
@@ -29,7 +29,10 @@ async def retrieve_glossary(state):
     else:
         question = state["question"]
     # Retrieval
+    glossary_retriever = get_retriever(GLOSSARY_COLLECTION, k=8)
     documents = await glossary_retriever.ainvoke(question)
+    logger.debug("Retrieved %d glossary items", len(documents))
+    retrieved_documents.observe(len(documents), collection=GLOSSARY_COLLECTION)
     return {"documents": documents, "total_retries": total_retries}
 
 async def grade_documents_glossary(state):
@@ -43,7 +46,6 @@ async def grade_documents_glossary(state):
         state (dict): Updates documents key with only filtered relevant documents
     """
 
-    print("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
     question = state["question"]
     documents = state["documents"]
     
@@ -52,15 +54,16 @@ async def grade_documents_glossary(state):
     # glossary_search = False
     retry_query = False
     for d in documents:
-        score = await retrieval_grader.ainvoke(
+        score = await get_retrieval_grader().ainvoke(
             {"question": question, "document": d.page_content}
         )
         grade = score.binary_score
+        document_grades.inc(collection=GLOSSARY_COLLECTION, grade="yes" if grade == "yes" else "no")
         if grade == "yes":
-            print(f"{d.metadata["title"]}", " [RELEVANT]")
+            logger.debug("%s [RELEVANT]", d.metadata["title"])
             filtered_docs.append(d)
         else:
-            print(f"{d.metadata["title"]}", " [NOT RELEVANT]")
+            logger.debug("%s [NOT RELEVANT]", d.metadata["title"])
             continue
         
     # If there are three or less relevant endpoints then retry query after rewriting question
@@ -74,6 +77,5 @@ async def grade_documents_glossary(state):
               
 async def return_documents(state) -> OutputState:
     """Return the relevant documents"""
-    print("---RETRUN RELEVANT DOCUMENTS---")
     relevant_documents = state["relevant_documents"]
     return {"relevant_documents": relevant_documents}
\ No newline at end of file
@@ -1,15 +1,39 @@
 import os
+import threading
 
-from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
+from typing import TYPE_CHECKING
+
+from langchain_core.embeddings import Embeddings
 from langchain_core.vectorstores import VectorStoreRetriever
 
-def setup_chroma_vector_store(chroma_collection_name: str) -> Chroma:
+from utils.startup_timing import startup_report
+
+if TYPE_CHECKING:
+    from langchain_chroma import Chroma
+
+# Vector stores and the embeddings client are created on first use and shared, chromadb is slow to import and load
+_embeddings: Embeddings | None = None
+_vector_stores: dict[str, "Chroma"] = {}
+_lock = threading.RLock()
+
+def get_embeddings() -> Embeddings:
+    """Get the shared embeddings client used by all vector stores."""
+    global _embeddings
+    with _lock:
+        if _embeddings is None:
+            with startup_report.measure("init:embeddings"):
+                from langchain_openai import OpenAIEmbeddings
+                _embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
+        return _embeddings
+
+def setup_chroma_vector_store(chroma_collection_name: str) -> "Chroma":
     """
     Args:
         chroma_collection_name (str): name of the collection on chromadb
     """
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
+    from langchain_chroma import Chroma
+
+    embeddings = get_embeddings()
 
     chroma_directory = os.getenv("CHROMADB_DIRECTORY")
 
@@ -21,7 +45,23 @@ def setup_chroma_vector_store(chroma_collection_name: str) -> Chroma:
 
     return vector_store
 
-def setup_retriever(k: int, vector_store: Chroma) -> VectorStoreRetriever:
+def get_vector_store(chroma_collection_name: str) -> "Chroma":
+    """
+    Get the shared vector store for a collection, loading it on first use.
+    Args:
+        chroma_collection_name (str): name of the collection on chromadb
+    """
+    if chroma_collection_name in _vector_stores:
+        return _vector_stores[chroma_collection_name]
+    # Build the embeddings first so that their cost isn't counted as part of loading the collection
+    get_embeddings()
+    with _lock:
+        if chroma_collection_name not in _vector_stores:
+            with startup_report.measure(f"init:chroma:{chroma_collection_name}"):
+                _vector_stores[chroma_collection_name] = setup_chroma_vector_store(chroma_collection_name)
+        return _vector_stores[chroma_collection_name]
+
+def setup_retriever(k: int, vector_store: "Chroma") -> VectorStoreRetriever:
     """
     Args:
         chroma_collection_name (str): name of the collection on chromadb
@@ -31,4 +71,7 @@ def setup_retriever(k: int, vector_store: Chroma) -> VectorStoreRetriever:
         search_kwargs={"k": k},
     )
     return retriever
-    
+
+def get_retriever(chroma_collection_name: str, k: int) -> VectorStoreRetriever:
+    """Get a retriever returning the top k documents from the shared vector store of a collection."""
+    return setup_retriever(k=k, vector_store=get_vector_store(chroma_collection_name))
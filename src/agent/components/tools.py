@@ -1,29 +1,54 @@
 import json
+import logging
 import requests
 import aiohttp
 import asyncio
+import time
 
+from langchain_core.callbacks import adispatch_custom_event
 from langchain_core.tools import tool
 
 from typing import Any
+from urllib.parse import urlsplit
 
-from agent.utils.config import obp_base_url, get_headers
+from agent.utils.config import obp_base_url, get_headers, get_obp_session, invalidate_direct_login_token
 from agent.components.sub_graphs.endpoint_retrieval.endpoint_retrieval_graph import endpoint_retrieval_graph
 from agent.components.sub_graphs.glossary_retrieval.glossary_retrieval_graph import glossary_retrieval_graph
+from utils.logs import Payload
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+obp_requests_total = metrics.counter("opey_obp_requests_total", "Requests made to OBP by the obp_requests tool, by method and status (HTTP status code, error or timeout)")
+obp_request_seconds = metrics.histogram("opey_obp_request_seconds", "Duration of requests made to OBP by the obp_requests tool, by method")
 
 
 async def _async_request(method: str, url: str, body: Any | None, headers: dict[str, str] | None = None):
+    start = time.perf_counter()
+    status = "error"
+    result = None
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.request(method, url, json=body, headers=headers) as response:
-                json_response = await response.json()
-                status = response.status
-                return json_response, status
-            
+        session = get_obp_session()
+        async with session.request(method, url, json=body, headers=headers) as response:
+            status = response.status
+            json_response = await response.json()
+            result = json_response, status
+
     except aiohttp.ClientError as e:
-        print(f"Error fetching data from {url}: {e}")
+        logger.warning("Error fetching data from %s: %s", url, e)
     except asyncio.TimeoutError:
-        print(f"Request to {url} timed out")
+        status = "timeout"
+        logger.warning("Request to %s timed out", url)
+    finally:
+        elapsed = time.perf_counter() - start
+        obp_requests_total.inc(method=method.upper(), status=str(status))
+        obp_request_seconds.observe(elapsed, method=method.upper())
+
+    # Recorded as a span by the service's run tracer
+    await adispatch_custom_event(
+        "obp_request", {"method": method.upper(), "path": urlsplit(url).path, "status": status, "duration_seconds": elapsed}
+    )
+    return result
 
 @tool
 async def obp_requests(method: str, path: str, body: str):
@@ -55,20 +80,23 @@ async def obp_requests(method: str, path: str, body: str):
     try:
         response = await _async_request(method, url, json_body, headers=headers)
     except Exception as e:
-        print(f"Error fetching data from {url}: {e}")
+        logger.warning("Error fetching data from %s: %s", url, e)
         return
     
     if response is None:
-        print("OBP returned 'None' response")
+        logger.warning("OBP returned 'None' response")
         return
     json_response, status = response
 
-    print("Response from OBP:\n", json.dumps(json_response, indent=2))
+    logger.debug("Response from OBP: %s %s", status, Payload(json_response))
     
     if status == 200:
         return json_response
     else:
-        print("Error fetching data from OBP:", json_response)
+        if status == 401:
+            # The cached DirectLogin token may have expired, log in again on the next request
+            invalidate_direct_login_token()
+        logger.warning("Error fetching data from OBP: %s %s", status, Payload(json_response))
         return json_response
     
     
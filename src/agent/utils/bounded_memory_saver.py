@@ -0,0 +1,224 @@
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import weakref
+
+from collections import OrderedDict
+from collections.abc import Iterator, Sequence
+from typing import Any, Optional
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple
+from langgraph.checkpoint.memory import InMemorySaver
+
+from utils.metrics import metrics
+
+memory_checkpoint_bytes = metrics.gauge("opey_memory_checkpointer_bytes", "Bytes of serialized checkpoints held in memory by the in-memory checkpointer")
+memory_checkpoint_threads = metrics.gauge("opey_memory_checkpointer_threads", "Threads held in memory by the in-memory checkpointer")
+memory_checkpoint_spilled_threads = metrics.gauge("opey_memory_checkpointer_spilled_threads", "Threads spilled to disk by the in-memory checkpointer")
+memory_checkpoint_evictions = metrics.counter("opey_memory_checkpointer_evictions_total", "Threads evicted from memory and spilled to disk")
+memory_checkpoint_fault_ins = metrics.counter("opey_memory_checkpointer_fault_ins_total", "Spilled threads loaded back into memory")
+
+
+def _close_spill_file(conn: sqlite3.Connection, path: str) -> None:
+    conn.close()
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+class BoundedMemorySaver(InMemorySaver):
+    """
+    In-memory checkpointer holding at most `max_threads` threads and `max_bytes` bytes of serialized checkpoints
+    and writes. Past either cap the least recently used threads are spilled to a temporary SQLite file, and loaded
+    back the next time they are used, so that a long running process doesn't keep every thread's history in RAM.
+    The thread in use is never spilled, even if it is larger than `max_bytes` on its own. A cap of 0 turns it off.
+
+    Like MemorySaver, nothing survives a restart: the spill file belongs to this instance and is deleted with it.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, max_threads: int = 1000, spill_dir: str | None = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.max_bytes = max_bytes
+        self.max_threads = max_threads
+        # Bytes held in memory by each thread, least recently used first
+        self._thread_bytes: OrderedDict[str, int] = OrderedDict()
+        self._total_bytes = 0
+        # Keys of self.writes belonging to each thread, so a thread's writes can be spilled without a full scan
+        self._write_keys: dict[str, set[tuple[str, str, str]]] = {}
+        self._spilled: set[str] = set()
+        # The base class methods are synchronous and may be called from several threads
+        self._lock = threading.RLock()
+
+        fd, self.spill_path = tempfile.mkstemp(prefix="opey-checkpoints-", suffix=".db", dir=spill_dir)
+        os.close(fd)
+        self._spill = sqlite3.connect(self.spill_path, check_same_thread=False, isolation_level=None)
+        self._spill.execute("PRAGMA journal_mode=WAL")
+        self._spill.execute("PRAGMA synchronous=OFF")
+        self._spill.execute("CREATE TABLE spilled_threads (thread_id TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL)")
+        self._finalizer = weakref.finalize(self, _close_spill_file, self._spill, self.spill_path)
+
+    def close(self) -> None:
+        """Delete the spill file. The saver can't be used afterwards."""
+        self._finalizer()
+
+    def _update_gauges(self) -> None:
+        memory_checkpoint_bytes.set(self._total_bytes)
+        memory_checkpoint_threads.set(len(self._thread_bytes))
+        memory_checkpoint_spilled_threads.set(len(self._spilled))
+
+    def _add_bytes(self, thread_id: str, size: int) -> None:
+        self._thread_bytes[thread_id] = self._thread_bytes.get(thread_id, 0) + size
+        self._total_bytes += size
+
+    def _touch(self, thread_id: str) -> None:
+        """Mark the thread as the most recently used, loading it back from the spill file if it was spilled."""
+        if thread_id in self._thread_bytes:
+            self._thread_bytes.move_to_end(thread_id)
+            return
+        if thread_id not in self._spilled:
+            return
+        data, size = self._spill.execute("SELECT data, size FROM spilled_threads WHERE thread_id = ?", (thread_id,)).fetchone()
+        self._spill.execute("DELETE FROM spilled_threads WHERE thread_id = ?", (thread_id,))
+        self._spilled.discard(thread_id)
+        namespaces, writes = pickle.loads(data)
+        for checkpoint_ns, checkpoints in namespaces.items():
+            self.storage[thread_id][checkpoint_ns] = checkpoints
+        self.writes.update(writes)
+        self._write_keys[thread_id] = set(writes)
+        self._add_bytes(thread_id, size)
+        memory_checkpoint_fault_ins.inc()
+        self._evict(keep=thread_id)
+
+    def _over_capacity(self) -> bool:
+        return (self.max_threads > 0 and len(self._thread_bytes) > self.max_threads) or (
+            self.max_bytes > 0 and self._total_bytes > self.max_bytes
+        )
+
+    def _evict(self, keep: str) -> None:
+        """Spill the least recently used threads other than `keep` until the saver is within its caps."""
+        while self._over_capacity():
+            thread_id = next(iter(self._thread_bytes))
+            if thread_id == keep:
+                if len(self._thread_bytes) == 1:
+                    break
+                self._thread_bytes.move_to_end(keep)
+                continue
+            size = self._thread_bytes.pop(thread_id)
+            self._total_bytes -= size
+            namespaces = {checkpoint_ns: checkpoints for checkpoint_ns, checkpoints in self.storage.pop(thread_id, {}).items() if checkpoints}
+            writes = {key: self.writes.pop(key) for key in self._write_keys.pop(thread_id, ()) if key in self.writes}
+            self._spill.execute(
+                "INSERT OR REPLACE INTO spilled_threads (thread_id, data, size) VALUES (?, ?, ?)",
+                (thread_id, pickle.dumps((namespaces, writes), pickle.HIGHEST_PROTOCOL), size),
+            )
+            self._spilled.add(thread_id)
+            memory_checkpoint_evictions.inc()
+        self._update_gauges()
+
+    def _discard_empty(self, thread_id: str, checkpoint_ids: Sequence[tuple[str, Optional[str]]]) -> None:
+        """Drop the empty entries the base class's defaultdicts create when reading missing keys."""
+        for checkpoint_ns, checkpoint_id in checkpoint_ids:
+            if checkpoint_id and not self.writes.get((thread_id, checkpoint_ns, checkpoint_id), True):
+                del self.writes[(thread_id, checkpoint_ns, checkpoint_id)]
+        namespaces = self.storage.get(thread_id)
+        if namespaces is not None and not any(namespaces.values()):
+            del self.storage[thread_id]
+
+    @staticmethod
+    def _read_ids(config: RunnableConfig, result: Optional[CheckpointTuple]) -> list[tuple[str, Optional[str]]]:
+        configurable = config["configurable"]
+        ids = [(configurable.get("checkpoint_ns", ""), configurable.get("checkpoint_id"))]
+        for read_config in (result.config, result.parent_config) if result else ():
+            if read_config:
+                ids.append((read_config["configurable"]["checkpoint_ns"], read_config["configurable"]["checkpoint_id"]))
+        return ids
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        with self._lock:
+            self._touch(thread_id)
+            result = super().get_tuple(config)
+            self._discard_empty(thread_id, self._read_ids(config, result))
+        return result
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        if config is None:
+            # Every thread, spilled ones included, loading them back one at a time
+            with self._lock:
+                thread_ids = [*self._thread_bytes, *self._spilled]
+            for thread_id in thread_ids:
+                for item in self.list({"configurable": {"thread_id": thread_id}}, filter=filter, before=before, limit=limit):
+                    yield item
+                    if limit is not None:
+                        limit -= 1
+                        if limit <= 0:
+                            return
+            return
+        thread_id = config["configurable"]["thread_id"]
+        with self._lock:
+            self._touch(thread_id)
+            # Read under the lock, the base class iterates over dicts other threads may change
+            items = [*super().list(config, filter=filter, before=before, limit=limit)]
+            read_ids = [read_id for item in items for read_id in self._read_ids(config, item)]
+            self._discard_empty(thread_id, read_ids or self._read_ids(config, None))
+        yield from items
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        with self._lock:
+            self._touch(thread_id)
+            previous = self.storage[thread_id][checkpoint_ns].get(checkpoint["id"])
+            next_config = super().put(config, checkpoint, metadata, new_versions)
+            saved = self.storage[thread_id][checkpoint_ns][checkpoint["id"]]
+            size = len(saved[0][1]) + len(saved[1][1])
+            if previous is not None:
+                size -= len(previous[0][1]) + len(previous[1][1])
+            self._add_bytes(thread_id, size)
+            self._evict(keep=thread_id)
+        return next_config
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        key = (thread_id, config["configurable"].get("checkpoint_ns", ""), config["configurable"]["checkpoint_id"])
+        with self._lock:
+            self._touch(thread_id)
+            before = sum(len(write[2][1]) for write in self.writes.get(key, {}).values())
+            super().put_writes(config, writes, task_id, task_path)
+            after = sum(len(write[2][1]) for write in self.writes.get(key, {}).values())
+            self._write_keys.setdefault(thread_id, set()).add(key)
+            self._add_bytes(thread_id, after - before)
+            self._evict(keep=thread_id)
+
+
+def create_memory_saver() -> BoundedMemorySaver:
+    """The in-memory checkpointer for graphs that aren't given a persistent one, capped by the MEMORY_CHECKPOINT_* env vars."""
+    return BoundedMemorySaver(
+        max_bytes=int(os.getenv("MEMORY_CHECKPOINT_MAX_BYTES", 256 * 1024 * 1024)),
+        max_threads=int(os.getenv("MEMORY_CHECKPOINT_MAX_THREADS", 1000)),
+        spill_dir=os.getenv("MEMORY_CHECKPOINT_SPILL_DIR") or None,
+    )
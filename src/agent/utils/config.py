@@ -1,14 +1,31 @@
+import logging
 import os
+import time
+import threading
+import aiohttp
 import requests
 from dotenv import load_dotenv
 
+from utils.logs import Payload
+
 load_dotenv()
 
+logger = logging.getLogger("uvicorn.error")
+
 obp_base_url = os.getenv("OBP_BASE_URL")
 username = os.getenv("OBP_USERNAME")
 password = os.getenv("OBP_PASSWORD")
 consumer_key = os.getenv("OBP_CONSUMER_KEY")
 
+# DirectLogin tokens are long lived, reuse one instead of logging in again before every request
+obp_token_ttl_seconds = float(os.getenv("OBP_TOKEN_TTL_SECONDS", 3600))
+_token: str | None = None
+_token_fetched_at = 0.0
+_token_lock = threading.Lock()
+
+# Connection pool shared by all requests to OBP, created on first use in the running event loop
+_obp_session: aiohttp.ClientSession | None = None
+
 def get_direct_login_token():
     url = f"{obp_base_url}/my/logins/direct"
     headers = {
@@ -19,18 +36,46 @@ def get_direct_login_token():
     response = requests.post(url, headers=headers)
     if response.status_code == 201:
         token = response.json().get('token')
-        print("Token fetched successfully!")
+        logger.debug("DirectLogin token fetched")
         return token
     else:
-        print("Error fetching token:", response.json())
+        logger.warning("Error fetching DirectLogin token: %s", Payload(response.text))
         return None
 
+def get_cached_direct_login_token():
+    """Get a DirectLogin token, logging in again only if there is none or it is older than OBP_TOKEN_TTL_SECONDS."""
+    global _token, _token_fetched_at
+    with _token_lock:
+        if _token is None or time.monotonic() - _token_fetched_at > obp_token_ttl_seconds:
+            _token = get_direct_login_token()
+            _token_fetched_at = time.monotonic()
+        return _token
+
+def invalidate_direct_login_token():
+    """Forget the cached DirectLogin token, i.e. after OBP rejected it."""
+    global _token
+    with _token_lock:
+        _token = None
+
 def get_headers():
-    token = get_direct_login_token()
+    token = get_cached_direct_login_token()
     if token:
         return {
             "Authorization": f"DirectLogin token={token}",
             "Content-Type": "application/json"
         }
     else:
-        return None
\ No newline at end of file
+        return None
+
+def get_obp_session() -> aiohttp.ClientSession:
+    """Get the aiohttp session shared by all requests to OBP, so that connections are kept alive between tool calls."""
+    global _obp_session
+    if _obp_session is None or _obp_session.closed:
+        _obp_session = aiohttp.ClientSession()
+    return _obp_session
+
+async def close_obp_session():
+    global _obp_session
+    if _obp_session is not None:
+        await _obp_session.close()
+        _obp_session = None
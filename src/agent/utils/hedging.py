@@ -0,0 +1,290 @@
+import asyncio
+import os
+import time
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Iterator, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel, agenerate_from_stream
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable, RunnableConfig
+from pydantic import ConfigDict
+
+from utils.metrics import metrics
+
+hedge_requests = metrics.counter("llm_hedge_requests_total", "LLM calls made under a hedging policy, by role")
+hedges_fired = metrics.counter("llm_hedges_fired_total", "Hedged requests sent to the secondary model, by role")
+hedge_wins = metrics.counter("llm_hedge_wins_total", "Which model produced the first token of a hedged call, by role and winner")
+hard_timeouts = metrics.counter("llm_hard_timeouts_total", "LLM calls that hit the hard timeout and fell back, by role")
+first_token_latency = metrics.histogram("llm_hedged_first_token_seconds", "Time to first token of hedged calls, by role and winner")
+
+# Minimum number of samples before the percentile is trusted over the initial delay
+_MIN_SAMPLES = 20
+
+
+@dataclass
+class HedgingPolicy:
+    """
+    When to hedge and when to give up on a model call.
+
+    Attributes:
+        secondary_model: Model to send the hedged request to, as accepted by the model registry.
+        fallback_model: Model to use when nothing produced a first token within the hard timeout.
+        percentile: Percentile of recent primary time-to-first-token used as the hedge delay.
+        initial_delay: Hedge delay used until enough latency samples have been collected.
+        min_delay: Lower bound on the hedge delay, so that hedging never doubles normal traffic.
+        max_delay: Upper bound on the hedge delay.
+        hard_timeout: Seconds to wait for a first token from any model before falling back.
+        window: Number of recent latency samples to compute the percentile over.
+    """
+    secondary_model: str | None = None
+    fallback_model: str | None = None
+    percentile: float = 95
+    initial_delay: float = 3.0
+    min_delay: float = 1.0
+    max_delay: float = 10.0
+    hard_timeout: float | None = 60.0
+    window: int = 200
+
+    @classmethod
+    def from_env(cls) -> "HedgingPolicy":
+        hard_timeout = float(os.getenv("LLM_HARD_TIMEOUT_SECONDS", 60))
+        return cls(
+            secondary_model=os.getenv("HEDGE_SECONDARY_MODEL") or None,
+            fallback_model=os.getenv("LLM_FALLBACK_MODEL") or None,
+            percentile=float(os.getenv("HEDGE_PERCENTILE", 95)),
+            initial_delay=float(os.getenv("HEDGE_INITIAL_DELAY_SECONDS", 3)),
+            min_delay=float(os.getenv("HEDGE_MIN_DELAY_SECONDS", 1)),
+            max_delay=float(os.getenv("HEDGE_MAX_DELAY_SECONDS", 10)),
+            hard_timeout=hard_timeout if hard_timeout > 0 else None,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.secondary_model or self.fallback_model)
+
+
+class LatencyTracker:
+    """Rolling window of time-to-first-token samples for one primary model."""
+
+    def __init__(self, window: int):
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, p: float) -> float | None:
+        if len(self._samples) < _MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        idx = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[idx]
+
+
+class _End:
+    pass
+
+
+@dataclass
+class _Failure:
+    error: BaseException
+
+
+class _StreamAttempt:
+    """Streams one model call in a background task, exposing its first chunk as a future."""
+
+    def __init__(self, name: str, runnable: Runnable, messages: list[BaseMessage], config: RunnableConfig, kwargs: dict[str, Any]):
+        self.name = name
+        self.started = time.perf_counter()
+        self.first_at: float | None = None
+        self.first: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run(runnable, messages, config, kwargs))
+
+    async def _run(self, runnable: Runnable, messages: list[BaseMessage], config: RunnableConfig, kwargs: dict[str, Any]) -> None:
+        try:
+            async for chunk in runnable.astream(messages, config, **kwargs):
+                if not self.first.done():
+                    self.first_at = time.perf_counter()
+                    self.first.set_result(chunk)
+                else:
+                    self._queue.put_nowait(chunk)
+            if not self.first.done():
+                self.first_at = time.perf_counter()
+                self.first.set_result(_End())
+            self._queue.put_nowait(_End())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not self.first.done():
+                self.first.set_result(_Failure(e))
+            else:
+                self._queue.put_nowait(_Failure(e))
+
+    @property
+    def failed(self) -> bool:
+        return self.first.done() and isinstance(self.first.result(), _Failure)
+
+    async def rest(self) -> AsyncIterator[AIMessageChunk]:
+        while True:
+            item = await self._queue.get()
+            if isinstance(item, _End):
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def cancel(self) -> None:
+        self._task.cancel()
+
+
+class HedgedChatModel(BaseChatModel):
+    """
+    Chat model that hedges a primary model against a secondary one to cut tail latency.
+
+    If the primary has not produced its first token after the hedge delay (a percentile of its recent
+    time-to-first-token), the same request is sent to the secondary and whichever streams first is used,
+    cancelling the other. If no model produced a first token within the hard timeout, both are cancelled
+    and the request is retried once on the fallback model.
+
+    The wrapped runnables are called without the parent's callbacks, so only the winner's tokens
+    are reported, once, through this model's own callbacks.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    primary: Runnable
+    secondary: Optional[Runnable] = None
+    fallback: Optional[Runnable] = None
+    policy: HedgingPolicy
+    tracker: LatencyTracker
+    role: str = "default"
+
+    @property
+    def _llm_type(self) -> str:
+        return "hedged-chat-model"
+
+    def _hedge_delay(self) -> float:
+        delay = self.tracker.percentile(self.policy.percentile)
+        if delay is None:
+            delay = self.policy.initial_delay
+        return min(max(delay, self.policy.min_delay), self.policy.max_delay)
+
+    async def _race(self, messages: list[BaseMessage], kwargs: dict[str, Any]) -> tuple[_StreamAttempt, list[_StreamAttempt]]:
+        """Start the primary, hedge if needed, and return the first attempt to produce a chunk plus all attempts started."""
+        config: RunnableConfig = {"callbacks": []}
+        primary = _StreamAttempt("primary", self.primary, messages, config, kwargs)
+        attempts = [primary]
+        hedge_at = primary.started + self._hedge_delay() if self.secondary is not None else None
+        deadline = primary.started + self.policy.hard_timeout if self.policy.hard_timeout else None
+
+        while True:
+            pending = [a for a in attempts if not a.first.done()]
+            now = time.perf_counter()
+            wake_ups = [t - now for t in (hedge_at, deadline) if t is not None]
+            timeout = max(min(wake_ups), 0) if wake_ups else None
+            if pending:
+                await asyncio.wait([a.first for a in pending], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for attempt in attempts:
+                if attempt.first.done() and not attempt.failed:
+                    return attempt, attempts
+
+            now = time.perf_counter()
+            pending = [a for a in attempts if not a.first.done()]
+            # Hedge when the delay has passed, or straight away if the primary already failed
+            if hedge_at is not None and (now >= hedge_at or not pending):
+                hedge_at = None
+                hedges_fired.inc(role=self.role)
+                attempts.append(_StreamAttempt("secondary", self.secondary, messages, config, kwargs))
+                continue
+
+            if (deadline is not None and now >= deadline) or not pending:
+                for attempt in attempts:
+                    attempt.cancel()
+                if self.fallback is None:
+                    failures = [a.first.result().error for a in attempts if a.failed]
+                    if failures:
+                        raise failures[-1]
+                    raise TimeoutError(f"No first token from {self.role} model within {self.policy.hard_timeout}s")
+                if pending:
+                    hard_timeouts.inc(role=self.role)
+                fallback = _StreamAttempt("fallback", self.fallback, messages, config, kwargs)
+                await fallback.first
+                if fallback.failed:
+                    raise fallback.first.result().error
+                return fallback, attempts + [fallback]
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        if stop:
+            kwargs["stop"] = stop
+        hedge_requests.inc(role=self.role)
+        attempts: list[_StreamAttempt] = []
+        try:
+            winner, attempts = await self._race(messages, kwargs)
+            hedge_wins.inc(role=self.role, winner=winner.name)
+            first_token_latency.observe(winner.first_at - attempts[0].started, role=self.role, winner=winner.name)
+
+            primary = attempts[0]
+            if winner is primary:
+                self.tracker.record(primary.first_at - primary.started)
+            else:
+                # The primary was slower than this, recording the lower bound keeps the percentile honest
+                self.tracker.record(winner.first_at - primary.started)
+
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.cancel()
+
+            first = winner.first.result()
+            if isinstance(first, _End):
+                return
+            yield ChatGenerationChunk(message=first)
+            async for chunk in winner.rest():
+                yield ChatGenerationChunk(message=chunk)
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        # Hedging needs concurrency, synchronous calls only go to the primary
+        if stop:
+            kwargs["stop"] = stop
+        message = self.primary.invoke(messages, **kwargs)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        if stop:
+            kwargs["stop"] = stop
+        for chunk in self.primary.stream(messages, **kwargs):
+            yield ChatGenerationChunk(message=chunk)
@@ -0,0 +1,137 @@
+import functools
+import inspect
+import time
+
+from collections.abc import Callable
+from typing import Any
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+from langchain_core.runnables import Runnable
+
+from utils.metrics import metrics
+
+graph_node_seconds = metrics.histogram("opey_graph_node_seconds", "Duration of graph node runs, by graph, node and status (ok, error)")
+llm_ttft_seconds = metrics.histogram("opey_llm_ttft_seconds", "Time to first token of streamed LLM calls, by role (the graph node making the call) and model")
+llm_tokens_per_second = metrics.histogram(
+    "opey_llm_tokens_per_second",
+    "Completion tokens per second of LLM calls, from the first token when streamed, by role and model",
+    buckets=(1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500),
+)
+llm_prompt_tokens = metrics.counter("opey_llm_prompt_tokens_total", "Prompt tokens of LLM calls, by role and model")
+llm_completion_tokens = metrics.counter("opey_llm_completion_tokens_total", "Completion tokens of LLM calls, by role and model")
+tool_seconds = metrics.histogram("opey_tool_seconds", "Duration of tool calls, by tool and status (ok, error)")
+
+
+def instrument_node(graph: str, node: str, action: Callable | Runnable) -> Callable | Runnable:
+    """
+    Wrap a graph node so the duration of its runs is recorded in opey_graph_node_seconds.
+
+    Args:
+        graph (str): Name of the graph the node belongs to, used as a label
+        node (str): Name of the node, used as a label
+        action: The node's function or runnable, as passed to StateGraph.add_node
+
+    Returns:
+        The wrapped node, to be passed to StateGraph.add_node in place of `action`
+    """
+    if isinstance(action, Runnable):
+        # Timed from the runnable's own run, so that its config, i.e. the store injected into a ToolNode, is untouched
+        def on_end(run) -> None:
+            status = "error" if run.error else "ok"
+            graph_node_seconds.observe((run.end_time - run.start_time).total_seconds(), graph=graph, node=node, status=status)
+
+        return action.with_listeners(on_end=on_end, on_error=on_end)
+
+    if inspect.iscoroutinefunction(action):
+        @functools.wraps(action)
+        async def async_node(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            status = "error"
+            try:
+                result = await action(*args, **kwargs)
+                status = "ok"
+                return result
+            finally:
+                graph_node_seconds.observe(time.perf_counter() - start, graph=graph, node=node, status=status)
+
+        return async_node
+
+    # functools.wraps keeps the signature visible to LangGraph, which passes `config` to nodes that take it
+    @functools.wraps(action)
+    def node_function(*args: Any, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = action(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            graph_node_seconds.observe(time.perf_counter() - start, graph=graph, node=node, status=status)
+
+    return node_function
+
+
+class GraphMetricsHandler(BaseCallbackHandler):
+    """
+    Callback handler recording the latency and token use of every LLM call and tool call of a run, including
+    those in subgraphs. LLM calls are labelled with their role, the graph node that made the call, and model.
+    One handler is shared by every run, calls are told apart by their run ID.
+    """
+
+    run_inline = True
+
+    def __init__(self):
+        # Per LLM call: (role, model, start, first token time)
+        self._llm_calls: dict[UUID, list] = {}
+        # Per tool call: (tool name, start)
+        self._tool_calls: dict[UUID, tuple[str, float]] = {}
+
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: list, *, run_id: UUID, metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
+        metadata = metadata or {}
+        role = metadata.get("langgraph_node", "unknown")
+        model = metadata.get("ls_model_name") or (serialized or {}).get("name", "unknown")
+        self._llm_calls[run_id] = [role, model, time.perf_counter(), None]
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        call = self._llm_calls.get(run_id)
+        if call is not None and call[3] is None:
+            call[3] = time.perf_counter()
+            llm_ttft_seconds.observe(call[3] - call[2], role=call[0], model=call[1])
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        call = self._llm_calls.pop(run_id, None)
+        if call is None:
+            return
+        role, model, start, first_token = call
+        for generations in response.generations:
+            for generation in generations:
+                if not isinstance(generation, ChatGeneration) or not isinstance(generation.message, AIMessage):
+                    continue
+                usage = generation.message.usage_metadata
+                if not usage:
+                    continue
+                llm_prompt_tokens.inc(usage.get("input_tokens", 0), role=role, model=model)
+                llm_completion_tokens.inc(usage.get("output_tokens", 0), role=role, model=model)
+                elapsed = time.perf_counter() - (first_token or start)
+                if usage.get("output_tokens") and elapsed > 0:
+                    llm_tokens_per_second.observe(usage["output_tokens"] / elapsed, role=role, model=model)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._llm_calls.pop(run_id, None)
+
+    def on_tool_start(self, serialized: dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._tool_calls[run_id] = ((serialized or {}).get("name") or kwargs.get("name") or "unknown", time.perf_counter())
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        if call := self._tool_calls.pop(run_id, None):
+            tool_seconds.observe(time.perf_counter() - call[1], tool=call[0], status="ok")
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        if call := self._tool_calls.pop(run_id, None):
+            tool_seconds.observe(time.perf_counter() - call[1], tool=call[0], status="error")
+
+
+graph_metrics = GraphMetricsHandler()
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Any, Optional
+
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load import dumps, loads
+
+from utils.metrics import metrics
+
+llm_cache_requests = metrics.counter("llm_cache_requests_total", "LLM response cache lookups, by result (hit, miss, expired)")
+
+# How often (in inserts) to enforce the size cap, deleting is done in bulk to keep inserts cheap
+_EVICTION_INTERVAL = 100
+
+
+class SQLiteLLMCache(BaseCache):
+    """
+    Persistent exact-match cache for LLM responses, stored in a local SQLite file.
+
+    Entries are keyed by a hash of the prompt and the LLM string. LangChain builds the LLM string from the
+    model name, temperature and any bound arguments, so the tools or response format used for structured output
+    are part of the key as well. Entries expire after `ttl_seconds`, and the least recently used entries are
+    evicted once there are more than `max_entries`.
+    """
+
+    def __init__(self, database_path: str, ttl_seconds: float, max_entries: int):
+        self.database_path = database_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._inserts_since_eviction = 0
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(database_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                value TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode()).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self._key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT created_at, value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                llm_cache_requests.inc(result="miss")
+                return None
+            created_at, value = row
+            if now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                llm_cache_requests.inc(result="expired")
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        llm_cache_requests.inc(result="hit")
+        return loads(value)
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        key = self._key(prompt, llm_string)
+        now = time.time()
+        value = dumps(list(return_val))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, created_at, accessed_at, value) VALUES (?, ?, ?, ?)",
+                (key, now, now, value),
+            )
+            self._inserts_since_eviction += 1
+            if self._inserts_since_eviction >= _EVICTION_INTERVAL:
+                self._inserts_since_eviction = 0
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        self._conn.execute(
+            """
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        )
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+
+
+def _cached_chains() -> set[str]:
+    return {name.strip() for name in os.getenv("LLM_CACHE_CHAINS", "").split(",") if name.strip()}
+
+
+_llm_cache: SQLiteLLMCache | None = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache(chain_name: str | None) -> SQLiteLLMCache | None:
+    """
+    Get the shared LLM response cache if caching is enabled for the given chain in LLM_CACHE_CHAINS.
+    Args:
+        chain_name (str | None): Name of the chain that the model will be used in, i.e. 'retrieval_grader'.
+    Returns:
+        SQLiteLLMCache | None: The cache, or None if caching is not enabled for this chain.
+    """
+    global _llm_cache
+    if not chain_name or chain_name not in _cached_chains():
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = SQLiteLLMCache(
+                database_path=os.getenv("LLM_CACHE_PATH", "llm_cache.db"),
+                ttl_seconds=float(os.getenv("LLM_CACHE_TTL_SECONDS", 86400)),
+                max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 100000)),
+            )
+        return _llm_cache
@@ -1,92 +1,299 @@
 import os
+import threading
 
-from typing import Literal
+from typing import Any, Literal
+
+import httpx
 
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain_ollama import ChatOllama
 from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.caches import BaseCache
+from langchain_core.runnables import Runnable
+
+from agent.utils.llm_cache import get_llm_cache
+from agent.utils.hedging import HedgedChatModel, HedgingPolicy, LatencyTracker
+from agent.utils.rate_limiter import ProviderRateLimiter, provider_rate_limiter_from_env, with_llm_priority
+from utils.startup_timing import startup_report
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-models: dict[str, BaseChatModel] = {}
+SUPPORTED_PROVIDERS = ("openai", "anthropic", "ollama")
 
-model_provider = os.getenv("MODEL_PROVIDER")
-if not model_provider:
-    raise ValueError("MODEL_PROVIDER is not set in the environment variables.")
+# Environment variables holding the small and medium model names for each provider
+_PROVIDER_SIZE_ENV_VARS = {
+    "openai": ("OPENAI_SMALL_MODEL", "OPENAI_MEDIUM_MODEL"),
+    "anthropic": ("ANTHROPIC_SMALL_MODEL", "ANTHROPIC_MEDIUM_MODEL"),
+    "ollama": ("OLLAMA_SMALL_MODEL", "OLLAMA_MEDIUM_MODEL"),
+}
 
-if model_provider == "openai":
 
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    if not openai_api_key:
+def _check_provider_credentials(provider: str) -> None:
+    if provider == "openai" and not os.getenv("OPENAI_API_KEY"):
         raise ValueError("MODEL_PROVIDER='openai' but OpenAI API key is not set in the environment variables.")
-    
-    small_model = os.getenv("OPENAI_SMALL_MODEL")
-    medium_model = os.getenv("OPENAI_MEDIUM_MODEL")
-    if not small_model or not medium_model:
-        raise ValueError("MODEL_PROVIDER='openai' but OpenAI model names are not set in the environment variables. Please set OPENAI_SMALL_MODEL and OPENAI_MEDIUM_MODEL.")
-    
-    models["small"] = ChatOpenAI(model=small_model)
-    models["medium"] = ChatOpenAI(model=medium_model)
-
-elif model_provider == "anthropic":
-
-    anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
-    if not anthropic_api_key:
+    if provider == "anthropic" and not os.getenv("ANTHROPIC_API_KEY"):
         raise ValueError("MODEL_PROVIDER='anthropic' but Anthropic API key is not set in the environment variables.")
-    
-    small_model = os.getenv("ANTHROPIC_SMALL_MODEL")
-    medium_model = os.getenv("ANTHROPIC_MEDIUM_MODEL")
-    if not small_model or not medium_model:
-        raise ValueError("MODEL_PROVIDER='anthropic' but Anthropic model names are not set in the environment variables. Please set ANTHROPIC_SMALL_MODEL and ANTHROPIC_MEDIUM_MODEL.")
-    
-    models["small"] = ChatAnthropic(
-        model_name=small_model,
-        max_tokens=1024,
-        timeout=None,
-        max_retries=2,
-    )
-    models["medium"] = ChatAnthropic(
-        model_name=medium_model,
-        max_tokens=1024,
-        timeout=None,
-        max_retries=2,
-    )
 
-elif model_provider == "ollama":
 
-    small_model = os.getenv("OLLAMA_SMALL_MODEL")
-    medium_model = os.getenv("OLLAMA_MEDIUM_MODEL")
-    if not small_model or not medium_model:
-        raise ValueError("MODEL_PROVIDER='ollama' but Ollama model names are not set in the environment variables. Please set OLLAMA_SMALL_MODEL and OLLAMA_MEDIUM_MODEL.")
-    models["small"] = ChatOllama(model=small_model)
-    models["medium"] = ChatOllama(model=medium_model)
+class ModelRegistry:
+    """
+    Pool of chat model instances, holding exactly one instance per (provider, model, temperature) role,
+    plus a separate instance for roles whose responses are cached.
 
-else:
-    raise ValueError(f"MODEL_PROVIDER={model_provider} is not a valid model provider or not currently supported.")
+    Instances are never mutated after they are built, so the same instance can be shared by any number of
+    concurrent chains. Models of the same provider share one HTTP connection pool, with the provider SDK's
+    connection limits for OpenAI and Anthropic.
 
-def get_llm(size: Literal['small', 'medium'], temperature: float = 0) -> BaseChatModel:
+    Models can be referred to by size alias ('small' or 'medium'), by plain model name for the default provider
+    (i.e. 'gpt-4o-mini'), or by '<provider>:<model name>' for any other supported provider.
     """
-    Retrieve a language model of the specified size and set its temperature.
+
+    def __init__(self, provider: str, small_model: str, medium_model: str, extra_models: list[str] | None = None, request_timeout: float | None = None):
+        if provider not in SUPPORTED_PROVIDERS:
+            raise ValueError(f"MODEL_PROVIDER={provider} is not a valid model provider or not currently supported.")
+        self.provider = provider
+        self.sizes = {"small": small_model, "medium": medium_model}
+        self.extra_models = extra_models or []
+        self.request_timeout = request_timeout
+        self._models: dict[tuple[str, str, float, bool], BaseChatModel] = {}
+        # Per provider, the sync and async clients shared by its models, see _shared_clients
+        self._clients: dict[str, tuple[Any, Any]] = {}
+        self._rate_limiters: dict[str, ProviderRateLimiter | None] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "ModelRegistry":
+        """Build the registry from the MODEL_PROVIDER, <PROVIDER>_SMALL_MODEL/_MEDIUM_MODEL and EXTRA_MODELS env vars."""
+        provider = os.getenv("MODEL_PROVIDER")
+        if not provider:
+            raise ValueError("MODEL_PROVIDER is not set in the environment variables.")
+        if provider not in SUPPORTED_PROVIDERS:
+            raise ValueError(f"MODEL_PROVIDER={provider} is not a valid model provider or not currently supported.")
+
+        _check_provider_credentials(provider)
+
+        small_env, medium_env = _PROVIDER_SIZE_ENV_VARS[provider]
+        small_model = os.getenv(small_env)
+        medium_model = os.getenv(medium_env)
+        if not small_model or not medium_model:
+            raise ValueError(f"MODEL_PROVIDER='{provider}' but model names are not set in the environment variables. Please set {small_env} and {medium_env}.")
+
+        extra_models = [m.strip() for m in os.getenv("EXTRA_MODELS", "").split(",") if m.strip()]
+        request_timeout = float(os.getenv("LLM_REQUEST_TIMEOUT_SECONDS", 120))
+        return cls(provider, small_model, medium_model, extra_models, request_timeout if request_timeout > 0 else None)
+
+    def resolve(self, model: str) -> tuple[str, str]:
+        """
+        Resolve a model alias to a (provider, model name) pair.
+        Args:
+            model (str): 'small', 'medium', a model name of the default provider, or '<provider>:<model name>'.
+        Returns:
+            tuple[str, str]: The provider and model name.
+        """
+        if model in self.sizes:
+            return self.provider, self.sizes[model]
+        provider, sep, model_name = model.partition(":")
+        if sep and provider in SUPPORTED_PROVIDERS:
+            return provider, model_name
+        return self.provider, model
+
+    def available_models(self) -> list[str]:
+        """Models that clients are allowed to select per request or per thread."""
+        models = [self.sizes["medium"], self.sizes["small"]]
+        for model in self.extra_models:
+            if model not in models:
+                models.append(model)
+        return models
+
+    def is_available(self, model: str) -> bool:
+        return model in self.sizes or model in self.available_models()
+
+    def get(self, model: str, temperature: float = 0, cache: BaseCache | None = None) -> BaseChatModel:
+        """
+        Get the shared instance for a model at a given temperature, building it on first use.
+        If a cache is given, the instance looks up and stores its responses there.
+        """
+        provider, model_name = self.resolve(model)
+        key = (provider, model_name, float(temperature), cache is not None)
+        if key in self._models:
+            return self._models[key]
+        with self._lock:
+            if key not in self._models:
+                with startup_report.measure(f"init:model:{provider}"):
+                    self._models[key] = self._build(provider, model_name, float(temperature), cache)
+            return self._models[key]
+
+    def prebuild(self, roles: list[tuple[str, float]]) -> None:
+        """Eagerly build the given (model, temperature) roles so that requests never pay for construction."""
+        for model, temperature in roles:
+            self.get(model, temperature)
+
+    async def aopen_connection(self, model: str, temperature: float = 0) -> None:
+        """
+        Open a connection from a model's client to its provider without generating anything, so that the TLS handshake
+        and connection pool setup are done before the first request. Lists the provider's models, which is free.
+        """
+        provider, _ = self.resolve(model)
+        llm = self.get(model, temperature)
+        if provider == "openai":
+            await llm.root_async_client.models.list()
+        elif provider == "anthropic":
+            await llm._async_client.models.list(limit=1)
+        elif provider == "ollama":
+            await llm._async_client.list()
+
+    async def aping(self, model: str, temperature: float = 0) -> None:
+        """Make a one-token call to a model, going through the same client, rate limiter and connection pool as real calls."""
+        provider, _ = self.resolve(model)
+        llm = self.get(model, temperature)
+        max_tokens = {"num_predict": 1} if provider == "ollama" else {"max_tokens": 1}
+        await with_llm_priority(llm.bind(**max_tokens), "background").ainvoke("Hi")
+
+    def _shared_clients(self, provider: str) -> tuple[Any, Any]:
+        """
+        The sync and async clients shared by every model of a provider. For OpenAI and Anthropic these are the
+        SDK's default httpx clients, which allow 1000 connections with 100 kept alive, where a plain httpx client
+        allows 100 and 20. The Ollama client can't be given an httpx client, so its own clients are shared.
+        """
+        if provider not in self._clients:
+            if provider == "openai":
+                import openai
+                self._clients[provider] = (openai.DefaultHttpxClient(), openai.DefaultAsyncHttpxClient())
+            elif provider == "anthropic":
+                import anthropic
+                self._clients[provider] = (anthropic.DefaultHttpxClient(), anthropic.DefaultAsyncHttpxClient())
+            else:
+                import ollama
+                limits = httpx.Limits(max_connections=1000, max_keepalive_connections=100)
+                self._clients[provider] = (
+                    ollama.Client(timeout=self.request_timeout, limits=limits),
+                    ollama.AsyncClient(timeout=self.request_timeout, limits=limits),
+                )
+        return self._clients[provider]
+
+    def rate_limiter(self, provider: str) -> ProviderRateLimiter | None:
+        """The process-wide rate limiter shared by all models of a provider, if limits are configured for it."""
+        if provider not in self._rate_limiters:
+            self._rate_limiters[provider] = provider_rate_limiter_from_env(provider)
+        return self._rate_limiters[provider]
+
+    def _build(self, provider: str, model_name: str, temperature: float, cache: BaseCache | None = None) -> BaseChatModel:
+        if provider != self.provider:
+            _check_provider_credentials(provider)
+        rate_limiter = self.rate_limiter(provider)
+
+        # Provider integrations are imported on first use, they are slow to import and usually only one is needed
+        if provider == "openai":
+            from langchain_openai import ChatOpenAI
+            http_client, http_async_client = self._shared_clients(provider)
+            return ChatOpenAI(
+                model=model_name,
+                temperature=temperature,
+                http_client=http_client,
+                http_async_client=http_async_client,
+                timeout=self.request_timeout,
+                # Streamed calls only report their token usage when asked to, the token metrics depend on it
+                stream_usage=True,
+                cache=cache,
+                rate_limiter=rate_limiter,
+            )
+        elif provider == "anthropic":
+            import anthropic
+            from langchain_anthropic import ChatAnthropic
+            llm = ChatAnthropic(
+                model_name=model_name,
+                temperature=temperature,
+                max_tokens=1024,
+                timeout=self.request_timeout,
+                max_retries=2,
+                cache=cache,
+                rate_limiter=rate_limiter,
+            )
+            # ChatAnthropic has no http_client option, its cached clients are set to ones on the shared pool instead
+            http_client, http_async_client = self._shared_clients(provider)
+            llm.__dict__["_client"] = anthropic.Client(**llm._client_params, http_client=http_client)
+            llm.__dict__["_async_client"] = anthropic.AsyncClient(**llm._client_params, http_client=http_async_client)
+            return llm
+        elif provider == "ollama":
+            from langchain_ollama import ChatOllama
+            llm = ChatOllama(
+                model=model_name,
+                temperature=temperature,
+                client_kwargs={"timeout": self.request_timeout},
+                cache=cache,
+                rate_limiter=rate_limiter,
+            )
+            llm._client, llm._async_client = self._shared_clients(provider)
+            return llm
+        else:
+            raise ValueError(f"Model provider '{provider}' is not a valid model provider or not currently supported.")
+
+
+model_registry = ModelRegistry.from_env()
+
+
+def get_llm(size: Literal['small', 'medium'] | str, temperature: float = 0, chain_name: str | None = None) -> BaseChatModel:
+    """
+    Retrieve the shared language model instance of the specified size and temperature.
     Args:
-        size (Literal['small', 'medium']): The size of the language model to retrieve I.e. gpt-4o-mini vs gpt-4o.
-                                           The models are set in the environment variables for a specific model provider. 
-                                           Supported sizes are 'small' and 'medium'.
-        temperature (float, optional): The temperature setting for the language model. 
+        size (Literal['small', 'medium'] | str): The size of the language model to retrieve I.e. gpt-4o-mini vs gpt-4o.
+                                           The models are set in the environment variables for a specific model provider.
+                                           Supported sizes are 'small' and 'medium'. Any model from the model registry
+                                           can also be requested by name.
+        temperature (float, optional): The temperature setting for the language model.
                                        Defaults to 0.
-        **kwargs: Additional keyword arguments.
+        chain_name (str, optional): Name of the chain the model is used in. If the chain is listed in
+                                    LLM_CACHE_CHAINS, the returned model caches its responses.
     Returns:
         The language model of the specified size with the temperature set.
+        The instance is shared and must not be mutated.
     Raises:
         ValueError: If the specified size is not supported or not set for the current model provider.
     """
-    
-    if size in models:
-        model = models[size]
-        model.temperature = temperature
-        return models[size]
+    if size in model_registry.sizes or model_registry.is_available(size):
+        return model_registry.get(size, temperature, cache=get_llm_cache(chain_name))
     else:
         raise ValueError(f"Model size '{size}' is not supported or not set for current model provider. Supported sizes are 'small' and 'medium'.")
-    
\ No newline at end of file
+
+
+hedging_policy = HedgingPolicy.from_env()
+
+# Time-to-first-token history per primary model, shared by every chain using that model
+_latency_trackers: dict[str, LatencyTracker] = {}
+
+
+def get_tool_calling_llm(size: Literal['small', 'medium'] | str, temperature: float, tools: list, role: str) -> Runnable:
+    """
+    Retrieve a language model bound to the given tools, hedged according to the hedging policy.
+    If HEDGE_SECONDARY_MODEL or LLM_FALLBACK_MODEL are set, slow first tokens are hedged against the secondary model
+    and calls that time out fall back to the fallback model. Otherwise the plain model bound to the tools is returned.
+    Args:
+        size (Literal['small', 'medium'] | str): The primary model, see get_llm.
+        temperature (float): The temperature setting for all the models.
+        tools (list): Tools to bind to all the models.
+        role (str): Name of the model's role, used to label the hedging metrics i.e. 'opey_agent'.
+    Returns:
+        Runnable: A chat model runnable taking a list of messages.
+    """
+    primary = get_llm(size, temperature).bind_tools(tools)
+    if not hedging_policy.enabled:
+        return primary
+
+    secondary = None
+    if hedging_policy.secondary_model:
+        secondary = model_registry.get(hedging_policy.secondary_model, temperature).bind_tools(tools)
+    fallback = None
+    if hedging_policy.fallback_model:
+        fallback = model_registry.get(hedging_policy.fallback_model, temperature).bind_tools(tools)
+
+    if size not in _latency_trackers:
+        _latency_trackers[size] = LatencyTracker(hedging_policy.window)
+
+    return HedgedChatModel(
+        primary=primary,
+        secondary=secondary,
+        fallback=fallback,
+        policy=hedging_policy,
+        tracker=_latency_trackers[size],
+        role=role,
+    )
@@ -0,0 +1,254 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Literal, Optional
+
+from langchain_core.messages import BaseMessage
+from langchain_core.prompt_values import PromptValue
+from langchain_core.rate_limiters import BaseRateLimiter
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableSerializable, ensure_config
+from pydantic import ConfigDict
+
+from utils.metrics import metrics
+
+rate_limit_wait = metrics.histogram("llm_rate_limit_wait_seconds", "Time LLM calls spent queued in the client-side rate limiter, by provider and priority")
+rate_limit_queue_depth = metrics.gauge("llm_rate_limit_queue_depth", "LLM calls currently queued in the client-side rate limiter, by provider")
+rate_limited_calls = metrics.counter("llm_rate_limited_calls_total", "LLM calls that had to wait for the rate limiter, by provider and priority")
+
+Priority = Literal["interactive", "background"]
+
+# Lower values are served first
+_PRIORITY_ORDER: dict[str, int] = {"interactive": 0, "background": 1}
+
+# Rough number of characters per token, good enough for budgeting
+_CHARS_PER_TOKEN = 4
+
+
+@dataclass(frozen=True)
+class LLMCallContext:
+    """What the rate limiter knows about the LLM call being made in the current context."""
+    priority: Priority = "interactive"
+    estimated_tokens: int = 0
+    fairness_key: str = ""
+
+
+_llm_call_context: contextvars.ContextVar[LLMCallContext] = contextvars.ContextVar("llm_call_context", default=LLMCallContext())
+
+
+def estimate_prompt_tokens(input: Any) -> int:
+    """Estimate the number of prompt tokens of a runnable input, without calling a tokenizer."""
+    if isinstance(input, PromptValue):
+        input = input.to_messages()
+    if isinstance(input, BaseMessage):
+        input = [input]
+    if isinstance(input, list):
+        chars = sum(len(str(m.content)) if isinstance(m, BaseMessage) else len(str(m)) for m in input)
+    elif isinstance(input, str):
+        chars = len(input)
+    else:
+        chars = len(json.dumps(input, default=str))
+    return chars // _CHARS_PER_TOKEN + 1
+
+
+class PrioritisedRunnable(RunnableSerializable):
+    """
+    Runs a chain with its LLM calls tagged with a priority and a prompt token estimate for the rate limiter.
+    Calls are also grouped by thread_id so that the limiter can serve conversation threads fairly.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    bound: Runnable
+    priority: Priority = "interactive"
+
+    def _context(self, input: Any, config: RunnableConfig) -> LLMCallContext:
+        thread_id = config.get("configurable", {}).get("thread_id", "")
+        return LLMCallContext(self.priority, estimate_prompt_tokens(input), str(thread_id))
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        config = ensure_config(config)
+        token = _llm_call_context.set(self._context(input, config))
+        try:
+            return self.bound.invoke(input, config, **kwargs)
+        finally:
+            _llm_call_context.reset(token)
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        config = ensure_config(config)
+        token = _llm_call_context.set(self._context(input, config))
+        try:
+            return await self.bound.ainvoke(input, config, **kwargs)
+        finally:
+            _llm_call_context.reset(token)
+
+
+def with_llm_priority(runnable: Runnable, priority: Priority) -> Runnable:
+    """
+    Wrap a chain so that its LLM calls are queued with the given priority by the provider rate limiter.
+    Use 'interactive' for calls a user is waiting on (i.e. the main agent) and 'background' for everything else.
+    """
+    return PrioritisedRunnable(bound=runnable, priority=priority)
+
+
+class _TokenBucket:
+    """Bucket refilled continuously at a per-minute rate, holding at most `burst_seconds` worth of budget."""
+
+    def __init__(self, per_minute: float, burst_seconds: float):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float) -> float:
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+class ProviderRateLimiter(BaseRateLimiter):
+    """
+    Process-wide rate limiter for one model provider, enforcing a requests-per-minute and a
+    tokens-per-minute budget based on estimated prompt tokens.
+
+    Calls that can't go straight away wait in a queue ordered by priority, then by how many calls
+    their conversation thread already has queued (so one busy thread can't starve others), then by arrival.
+    The limiter is attached to every model of the provider, and LangChain only consults it on cache misses.
+    """
+
+    def __init__(self, provider: str, requests_per_minute: float | None, tokens_per_minute: float | None, burst_seconds: float = 10):
+        self.provider = provider
+        self._requests = _TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self._tokens = _TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self._lock = threading.Lock()
+        self._waiters: list[tuple[int, int, int, float, str, asyncio.Future]] = []
+        self._queued_per_key: dict[str, int] = defaultdict(int)
+        self._seq = itertools.count()
+        self._wakeup: asyncio.TimerHandle | None = None
+
+    def _tokens_needed(self, context: LLMCallContext) -> float:
+        if self._tokens is None:
+            return 0
+        # A single huge prompt must still be able to go through eventually
+        return min(context.estimated_tokens, self._tokens.capacity)
+
+    def _try_take(self, tokens: float) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            for bucket in (self._requests, self._tokens):
+                if bucket:
+                    bucket.refill(now)
+            if self._requests and self._requests.level < 1:
+                return False
+            if self._tokens and self._tokens.level < tokens:
+                return False
+            if self._requests:
+                self._requests.level -= 1
+            if self._tokens:
+                self._tokens.level -= tokens
+            return True
+
+    def _time_until(self, tokens: float) -> float:
+        with self._lock:
+            waits = [0.0]
+            if self._requests:
+                waits.append(self._requests.time_until(1))
+            if self._tokens:
+                waits.append(self._tokens.time_until(tokens))
+            return max(waits)
+
+    def _dequeued(self, key: str) -> None:
+        self._queued_per_key[key] -= 1
+        if self._queued_per_key[key] <= 0:
+            del self._queued_per_key[key]
+
+    def _dispatch(self) -> None:
+        """Serve queued calls in order for as long as the budget allows, then schedule the next attempt."""
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        while self._waiters:
+            _, _, _, tokens, key, future = self._waiters[0]
+            if future.done():
+                # Cancelled while waiting
+                heapq.heappop(self._waiters)
+                self._dequeued(key)
+                continue
+            if not self._try_take(tokens):
+                loop = asyncio.get_running_loop()
+                self._wakeup = loop.call_later(self._time_until(tokens), self._dispatch)
+                break
+            heapq.heappop(self._waiters)
+            self._dequeued(key)
+            future.set_result(True)
+        rate_limit_queue_depth.set(len(self._waiters), provider=self.provider)
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        context = _llm_call_context.get()
+        tokens = self._tokens_needed(context)
+        if not self._waiters and self._try_take(tokens):
+            rate_limit_wait.observe(0, provider=self.provider, priority=context.priority)
+            return True
+        if not blocking:
+            return False
+
+        rate_limited_calls.inc(provider=self.provider, priority=context.priority)
+        start = time.perf_counter()
+        key = context.fairness_key
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self._waiters,
+            (_PRIORITY_ORDER.get(context.priority, 0), self._queued_per_key[key], next(self._seq), tokens, key, future),
+        )
+        self._queued_per_key[key] += 1
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Leave the cancelled entry for _dispatch to drop, but don't let it hold up the queue
+            self._dispatch()
+            raise
+        finally:
+            rate_limit_wait.observe(time.perf_counter() - start, provider=self.provider, priority=context.priority)
+        return True
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        # Synchronous callers are not queued, they poll the buckets outside the priority order
+        context = _llm_call_context.get()
+        tokens = self._tokens_needed(context)
+        start = time.perf_counter()
+        while not self._try_take(tokens):
+            if not blocking:
+                return False
+            time.sleep(max(self._time_until(tokens), 0.01))
+        rate_limit_wait.observe(time.perf_counter() - start, provider=self.provider, priority=context.priority)
+        return True
+
+
+def provider_rate_limiter_from_env(provider: str) -> ProviderRateLimiter | None:
+    """
+    Build the rate limiter for a provider from <PROVIDER>_REQUESTS_PER_MINUTE and <PROVIDER>_TOKENS_PER_MINUTE.
+    The limits are for the whole service, so with several WORKERS each worker gets an equal share of them.
+    Returns None if neither is set.
+    """
+    prefix = provider.upper()
+    workers = max(int(os.getenv("WORKERS", 1)), 1)
+    requests_per_minute = float(os.getenv(f"{prefix}_REQUESTS_PER_MINUTE", 0)) / workers
+    tokens_per_minute = float(os.getenv(f"{prefix}_TOKENS_PER_MINUTE", 0)) / workers
+    if not requests_per_minute and not tokens_per_minute:
+        return None
+    return ProviderRateLimiter(
+        provider,
+        requests_per_minute=requests_per_minute or None,
+        tokens_per_minute=tokens_per_minute or None,
+        burst_seconds=float(os.getenv("RATE_LIMIT_BURST_SECONDS", 10)),
+    )
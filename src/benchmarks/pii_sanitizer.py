@@ -0,0 +1,149 @@
+# Description: Throughput of the chat log PII sanitizer on synthetic conversation logs, against naive sanitizing
+# with one regex per kind of personal data and one per dictionary term
+#
+# The logs mix user questions, agent answers and OBP responses (JSON with accounts, IBANs, balances and dates),
+# with the customers' names and IDs in a dictionary like the one loaded from OBP. Run from the src directory:
+#
+#   python -m benchmarks.pii_sanitizer --messages 5000 --dictionary-size 2000 --workers 4
+import argparse
+import json
+import random
+import re
+import string
+import time
+import uuid
+
+from collections.abc import Callable
+
+from utils.pii import PIISanitizer, SanitizerPool, ahocorasick
+
+FIRST_NAMES = ["Alice", "Bob", "Carlos", "Dana", "Elif", "Femi", "Grace", "Hiro", "Ines", "Jonas", "Kofi", "Lena"]
+LAST_NAMES = ["Smith", "Garcia", "Okafor", "Novak", "Tanaka", "Muller", "Rossi", "Kowalski", "Silva", "Brown"]
+QUESTIONS = [
+    "How do I create a new account at bank {bank}?",
+    "What is the balance of account {account_id}?",
+    "Can you transfer 250 EUR from my account to {iban}?",
+    "My card {card} was declined on {date}, why?",
+    "Please update the email of customer {customer_number} to {email}",
+    "Call me back on {phone} about the consent for {name}",
+    "List the transactions of {name} since {date}",
+    "What does the glossary say about a Transaction Request?",
+]
+ANSWERS = [
+    "To create an account, call POST /obp/v5.1.0/banks/{bank}/accounts with the product code and the owner's user ID.",
+    "The account {account_id} belongs to {name} and has a balance of 1,254.30 EUR as of {date}.",
+    "I found the customer {customer_number} ({name}). Their registered email is {email} and phone {phone}.",
+    "A Transaction Request moves money between accounts. It may need a challenge to be answered before it completes.",
+]
+
+
+def _luhn_card() -> str:
+    digits = [4] + [random.randint(0, 9) for _ in range(14)]
+    total = sum(d if i % 2 else (d * 2 - 9 if d > 4 else d * 2) for i, d in enumerate(reversed(digits)))
+    digits.append((10 - total % 10) % 10)
+    number = "".join(map(str, digits))
+    return " ".join(number[i:i + 4] for i in range(0, 16, 4))
+
+
+def _iban() -> str:
+    bban = "WEST" + "".join(random.choices(string.digits, k=14))
+    check = 98 - int("".join(str(int(c, 36)) for c in bban + "GB00")) % 97
+    return f"GB{check:02d}{bban}"
+
+
+def make_dictionary(size: int) -> dict[str, str]:
+    dictionary = {}
+    while len(dictionary) < size:
+        dictionary[f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}-{random.randint(1, 10**6)}"] = "name"
+        dictionary[f"CUST-{random.randint(10**5, 10**6)}"] = "id"
+    return dictionary
+
+
+def make_logs(count: int, dictionary: dict[str, str]) -> list[str]:
+    names = [term for term, kind in dictionary.items() if kind == "name"]
+    ids = [term for term, kind in dictionary.items() if kind == "id"]
+    logs = []
+    for _ in range(count):
+        values = {
+            "bank": "gh.29.uk",
+            "account_id": str(uuid.uuid4()),
+            "iban": _iban(),
+            "card": _luhn_card(),
+            "date": f"2024-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}",
+            "customer_number": random.choice(ids),
+            "email": f"user{random.randint(1, 9999)}@example.com",
+            "phone": f"+44 20 {random.randint(1000, 9999)} {random.randint(1000, 9999)}",
+            "name": random.choice(names),
+        }
+        kind = random.random()
+        if kind < 0.4:
+            logs.append(random.choice(QUESTIONS).format(**values))
+        elif kind < 0.8:
+            logs.append(random.choice(ANSWERS).format(**values))
+        else:
+            # An OBP response returned by a tool call
+            accounts = [
+                {"id": str(uuid.uuid4()), "label": "Savings", "bank_id": values["bank"], "owners": [{"display_name": random.choice(names)}],
+                 "account_routings": [{"scheme": "IBAN", "address": _iban()}], "balance": {"currency": "EUR", "amount": f"{random.uniform(0, 10**5):.2f}"},
+                 "opened": values["date"]}
+                for _ in range(random.randint(1, 5))
+            ]
+            logs.append(json.dumps({"accounts": accounts}, indent=2))
+    return logs
+
+
+def naive_sanitizer(dictionary: dict[str, str]) -> Callable[[str], str]:
+    """One regex per kind of personal data and one per dictionary term, each a pass over the text."""
+    patterns = [
+        (re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b"), "[EMAIL]"),
+        (re.compile(r"\b[A-Z]{2}\d{2}(?: ?[A-Z0-9]{4}){2,7}(?: ?[A-Z0-9]{1,3})?\b"), "[IBAN]"),
+        (re.compile(r"\b(?:\d[ -]?){12,18}\d\b"), "[CARD]"),
+        (re.compile(r"\+\d{1,3}(?:[ .-]?\d{2,4}){2,4}\b"), "[PHONE]"),
+        (re.compile(r"\b\d{8,18}\b"), "[ACCOUNT]"),
+    ]
+    patterns += [(re.compile(rf"\b{re.escape(term)}\b", re.IGNORECASE), f"[{kind.upper()}]") for term, kind in dictionary.items()]
+
+    def sanitize(text: str) -> str:
+        for pattern, replacement in patterns:
+            text = pattern.sub(replacement, text)
+        return text
+
+    return sanitize
+
+
+def measure(name: str, sanitize_batch: Callable[[list[str]], list[str]], logs: list[str], batch_size: int) -> None:
+    # Warm up caches and worker processes
+    sanitize_batch(logs[:batch_size])
+    size = sum(len(text) for text in logs)
+    start = time.perf_counter()
+    for i in range(0, len(logs), batch_size):
+        sanitize_batch(logs[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+    print(f"{name:<40} {len(logs) / elapsed:>10.0f} msg/s {size / elapsed / 1e6:>8.2f} MB/s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--dictionary-size", type=int, default=2000, help="Names and IDs in the dictionary")
+    parser.add_argument("--batch-size", type=int, default=100, help="Messages per batch, as shipped by the chat log shipper")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes for the pooled run")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    dictionary = make_dictionary(args.dictionary_size)
+    logs = make_logs(args.messages, dictionary)
+    print(f"{len(logs)} messages, {sum(map(len, logs)) / 1e6:.1f} MB, {len(dictionary)} dictionary terms, pyahocorasick {'installed' if ahocorasick else 'not installed'}\n")
+
+    naive = naive_sanitizer(dictionary)
+    measure("naive, one regex per kind and term", lambda texts: [naive(text) for text in texts], logs, args.batch_size)
+    measure("patterns only, no dictionary", SanitizerPool(PIISanitizer()).sanitize_batch, logs, args.batch_size)
+    measure("patterns and dictionary", SanitizerPool(PIISanitizer(dictionary=dictionary)).sanitize_batch, logs, args.batch_size)
+    pool = SanitizerPool(PIISanitizer(dictionary=dictionary), workers=args.workers, chunk_size=max(args.batch_size // args.workers, 1))
+    measure(f"patterns and dictionary, {args.workers} workers", pool.sanitize_batch, logs, args.batch_size)
+    pool.close()
+
+
+if __name__ == "__main__":
+    main()
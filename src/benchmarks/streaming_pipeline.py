@@ -0,0 +1,161 @@
+# Description: Compares the CPU cost of the two /stream pipelines, astream_events vs graph stream modes,
+# and the bytes and CPU saved by the stream options (token coalescing, omitting originals, compact JSON)
+#
+# Runs a graph shaped like Opey's (an agent node streaming its answer, and a tool node running a retrieval
+# subgraph with grader and rewriter chains) on fake chat models, so only the streaming overhead is measured.
+# Needs the same environment as the service, run from the src directory:
+#
+#   python -m benchmarks.streaming_pipeline --concurrency 50 --answer-tokens 300 --coalesce-ms 50
+import argparse
+import asyncio
+import time
+
+from typing import Annotated, Any
+
+from langchain_core.language_models.chat_models import BaseChatModel, agenerate_from_stream
+from langchain_core.messages import AIMessage, AIMessageChunk, AnyMessage, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langgraph.graph import END, START, StateGraph
+from langgraph.graph.message import add_messages
+from typing_extensions import TypedDict
+
+from schema import StreamInput, StreamOptions
+from service.service import _stream_with_astream_events, _stream_with_graph_modes
+from service.sse import encode_sse_stream
+
+
+class BenchState(TypedDict):
+    messages: Annotated[list[AnyMessage], add_messages]
+
+
+class RetrievalState(TypedDict):
+    question: str
+    grades: list[str]
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """Chat model replying with `tokens` words, streamed natively one word per chunk like a provider would."""
+
+    tokens: int
+    token_interval: float = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming"
+
+    def _generate(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(f"word{i} " for i in range(self.tokens))))])
+
+    async def _astream(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs: Any):
+        for i in range(self.tokens):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=f"word{i} "))
+            # Let other streams run, as waiting on the provider would
+            await asyncio.sleep(self.token_interval)
+
+    async def _agenerate(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages))
+
+
+def _fake_llm(tokens: int, token_interval: float = 0) -> FakeStreamingChatModel:
+    return FakeStreamingChatModel(tokens=tokens, token_interval=token_interval)
+
+
+def build_graph(answer_tokens: int, documents: int, grader_tokens: int, token_interval: float = 0):
+    agent_llm = _fake_llm(answer_tokens, token_interval)
+    grader = ChatPromptTemplate.from_messages([("human", "{document} {question}")]) | _fake_llm(grader_tokens) | StrOutputParser()
+    rewriter = ChatPromptTemplate.from_messages([("human", "{question}")]) | _fake_llm(grader_tokens) | StrOutputParser()
+
+    async def grade_documents(state: RetrievalState):
+        grades = [await grader.ainvoke({"document": f"doc {i}", "question": state["question"]}) for i in range(documents)]
+        return {"grades": grades}
+
+    async def transform_query(state: RetrievalState):
+        return {"question": await rewriter.ainvoke({"question": state["question"]})}
+
+    retrieval = StateGraph(RetrievalState)
+    retrieval.add_node("grade_documents", grade_documents)
+    retrieval.add_node("transform_query", transform_query)
+    retrieval.add_edge(START, "grade_documents")
+    retrieval.add_edge("grade_documents", "transform_query")
+    retrieval.add_edge("transform_query", END)
+    retrieval_graph = retrieval.compile()
+
+    async def tools(state: BenchState):
+        result = await retrieval_graph.ainvoke({"question": state["messages"][-1].content, "grades": []})
+        return {"messages": [AIMessage(content=f"retrieved {len(result['grades'])} documents")]}
+
+    async def opey(state: BenchState):
+        return {"messages": [await agent_llm.ainvoke(state["messages"])]}
+
+    workflow = StateGraph(BenchState)
+    workflow.add_node("tools", tools)
+    workflow.add_node("opey", opey)
+    workflow.add_edge(START, "tools")
+    workflow.add_edge("tools", "opey")
+    workflow.add_edge("opey", END)
+    return workflow.compile()
+
+
+async def _consume(pipeline, graph, options: StreamOptions, n: int) -> tuple[int, int]:
+    user_input = StreamInput(message=f"question {n}", stream_tokens=True, **options.model_dump())
+    kwargs: dict[str, Any] = {
+        "input": {"messages": [HumanMessage(content=user_input.message)]},
+        "config": {"configurable": {"thread_id": str(n)}},
+    }
+    frames = 0
+    n_bytes = 0
+    async for frame in encode_sse_stream(pipeline(graph, kwargs, user_input, str(n)), user_input):
+        frames += 1
+        n_bytes += len(frame)
+    return frames, n_bytes
+
+
+async def run(pipeline, graph, options: StreamOptions, concurrency: int) -> dict[str, float]:
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    results = await asyncio.gather(*(_consume(pipeline, graph, options, n) for n in range(concurrency)))
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    frames = sum(f for f, _ in results)
+    return {"cpu": cpu, "wall": wall, "frames": frames, "bytes": sum(b for _, b in results)}
+
+
+async def main(args: argparse.Namespace) -> None:
+    graph = build_graph(args.answer_tokens, args.documents, args.grader_tokens, args.token_interval_ms / 1000)
+    compact = StreamOptions(
+        coalesce_tokens_ms=args.coalesce_ms,
+        coalesce_tokens_bytes=args.coalesce_bytes,
+        omit_original=True,
+        compact_json=True,
+    )
+    runs = {
+        "astream_events": (_stream_with_astream_events, StreamOptions()),
+        "stream_modes": (_stream_with_graph_modes, StreamOptions()),
+        "stream_modes+opts": (_stream_with_graph_modes, compact),
+    }
+    # Warm up every pipeline once before measuring
+    for pipeline, options in runs.values():
+        await run(pipeline, graph, options, 1)
+
+    print(f"{args.concurrency} concurrent streams, {args.answer_tokens} answer tokens, {args.documents} graded documents")
+    print(f"stream_modes+opts: {compact.model_dump()}\n")
+    print(f"{'pipeline':<18} {'cpu s':>8} {'wall s':>8} {'frames':>8} {'bytes':>10} {'cpu us/frame':>13}")
+    for name, (pipeline, options) in runs.items():
+        best = min([await run(pipeline, graph, options, args.concurrency) for _ in range(args.repeats)], key=lambda r: r["cpu"])
+        per_frame = best["cpu"] / best["frames"] * 1e6
+        print(f"{name:<18} {best['cpu']:8.2f} {best['wall']:8.2f} {best['frames']:8d} {best['bytes']:10d} {per_frame:13.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--answer-tokens", type=int, default=300)
+    parser.add_argument("--documents", type=int, default=5)
+    parser.add_argument("--grader-tokens", type=int, default=20)
+    parser.add_argument("--token-interval-ms", type=float, default=0, help="Delay between the answer's tokens")
+    parser.add_argument("--coalesce-ms", type=int, default=50)
+    parser.add_argument("--coalesce-bytes", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    asyncio.run(main(parser.parse_args()))
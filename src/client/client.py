@@ -1,27 +1,39 @@
 from concurrent.futures import thread
 import json
+import logging
 import os
 from collections.abc import AsyncGenerator, Generator
 from typing import Any, Literal
 
 import httpx
 
-from schema import ChatMessage, Feedback, StreamInput, UserInput, ToolCallApproval
+from schema import ChatMessage, Feedback, ModelList, StreamInput, StreamOptions, UserInput, ToolCallApproval
+from utils.logs import Payload
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 
 class AgentClient:
     """Client for interacting with the agent service."""
 
-    def __init__(self, base_url: str = "http://localhost:8000", timeout: float | None = None) -> None:
+    def __init__(self, base_url: str = "http://localhost:8000", timeout: float | None = None, max_reconnects: int = 3) -> None:
         """
         Initialize the client.
 
         Args:
             base_url (str): The base URL of the agent service.
+            max_reconnects (int): Times a stream reattaches to its run after the connection drops.
         """
         self.base_url = base_url
         self.auth_secret = os.getenv("AUTH_SECRET")
         self.timeout = timeout
+        self.max_reconnects = max_reconnects
 
     @property
     def _headers(self) -> dict[str, str]:
@@ -89,15 +101,31 @@ class AgentClient:
             return ChatMessage.model_validate(response.json())
         raise Exception(f"Error: {response.status_code} - {response.text}")
 
+    def list_models(self) -> ModelList:
+        """
+        Get the models that can be selected with the `model` argument.
+
+        Returns:
+            ModelList: The default model and all available models
+        """
+        response = httpx.get(
+            f"{self.base_url}/models",
+            headers=self._headers,
+            timeout=self.timeout,
+        )
+        if response.status_code == 200:
+            return ModelList.model_validate(response.json())
+        raise Exception(f"Error: {response.status_code} - {response.text}")
+
     def _parse_stream_line(self, line: str) -> ChatMessage | str | None:
         line = line.strip()
-        print(line)
+        logger.debug("Stream line: %s", Payload(line))
         if line.startswith("data: "):
             data = line[6:]
             if data == "[DONE]":
                 return None
             try:
-                parsed = json.loads(data)
+                parsed = _json_loads(data)
             except Exception as e:
                 raise Exception(f"Error JSON parsing message from server: {e}")
             match parsed["type"]:
@@ -125,6 +153,7 @@ class AgentClient:
         model: str | None = None,
         thread_id: str | None = None,
         stream_tokens: bool = True,
+        stream_options: StreamOptions | None = None,
     ) -> Generator[ChatMessage | str, None, None]:
         """
         Stream the agent's response synchronously.
@@ -139,32 +168,23 @@ class AgentClient:
             thread_id (str, optional): Thread ID for continuing a conversation
             stream_tokens (bool, optional): Stream tokens as they are generated
                 Default: True
+            stream_options (StreamOptions, optional): How the server encodes the stream, i.e. token coalescing
+                and compact frames. Default: send every token as it arrives, as uncompacted JSON
 
         Returns:
             Generator[ChatMessage | str, None, None]: The response from the agent
         """
-        request = StreamInput(message=message, stream_tokens=stream_tokens)
+        request = StreamInput(message=message, stream_tokens=stream_tokens, **(stream_options.model_dump() if stream_options else {}))
         if thread_id:
             request.thread_id = thread_id
-        with httpx.stream(
-            "POST",
-            f"{self.base_url}/stream",
-            json=request.model_dump(),
-            headers=self._headers,
-            timeout=self.timeout,
-        ) as response:
-            if response.status_code != 200:
-                raise Exception(f"Error: {response.status_code} - {response.text}")
-            for line in response.iter_lines():
-                if line.strip():
-                    parsed = self._parse_stream_line(line)
-                    if parsed is None:
-                        break
-                    # On receiving an approval request, we need to yeild it to streamlit and stop streaming
-                    if isinstance(parsed, dict) and parsed["type"] == "approval_request":
-                        yield parsed
-                        break
-                    yield parsed
+        if model:
+            request.model = model
+        for parsed in self._stream_run(f"{self.base_url}/stream", request.model_dump()):
+            # On receiving an approval request, we need to yeild it to streamlit and stop streaming
+            if isinstance(parsed, dict) and parsed["type"] == "approval_request":
+                yield parsed
+                break
+            yield parsed
 
     async def astream(
         self,
@@ -172,6 +192,7 @@ class AgentClient:
         model: str | None = None,
         thread_id: str | None = None,
         stream_tokens: bool = True,
+        stream_options: StreamOptions | None = None,
     ) -> AsyncGenerator[ChatMessage | str, None]:
         """
         Stream the agent's response asynchronously.
@@ -186,56 +207,105 @@ class AgentClient:
             thread_id (str, optional): Thread ID for continuing a conversation
             stream_tokens (bool, optional): Stream tokens as they are generated
                 Default: True
+            stream_options (StreamOptions, optional): How the server encodes the stream, i.e. token coalescing
+                and compact frames. Default: send every token as it arrives, as uncompacted JSON
 
         Returns:
             AsyncGenerator[ChatMessage | str, None]: The response from the agent
         """
-        request = StreamInput(message=message, stream_tokens=stream_tokens)
+        request = StreamInput(message=message, stream_tokens=stream_tokens, **(stream_options.model_dump() if stream_options else {}))
         if thread_id:
             request.thread_id = thread_id
-        async with httpx.AsyncClient() as client:
-            async with client.stream(
-                "POST",
-                f"{self.base_url}/stream",
-                json=request.model_dump(),
-                headers=self._headers,
-                timeout=self.timeout,
-            ) as response:
-                if response.status_code != 200:
-                    content = await response.aread()
-                    raise Exception(f"Error: {response.status_code} - {content.decode('utf-8')}")
-                async for line in response.aiter_lines():
-                    if line.strip():
-                        parsed = self._parse_stream_line(line)
-                        if parsed is None:
-                            break
-                        # On receiving an approval request, we need to yeild it to streamlit and stop streaming
-                        if isinstance(parsed, dict) and parsed["type"] == "approval_request":
-                            yield parsed
-                        yield parsed
+        if model:
+            request.model = model
+        async for parsed in self._astream_run(f"{self.base_url}/stream", request.model_dump()):
+            yield parsed
 
     async def approve_request_and_stream(self, thread_id: str, user_input: ToolCallApproval):
-        print(f"request: {user_input}")    
+        logger.debug("Approval request for thread %s: %s", thread_id, Payload(user_input))
+        async for parsed in self._astream_run(f"{self.base_url}/approval/{thread_id}", user_input.model_dump()):
+            yield parsed
+
+    def _reattach_headers(self, last_event_id: str | None) -> dict[str, str]:
+        headers = self._headers
+        if last_event_id:
+            headers["Last-Event-ID"] = last_event_id
+        return headers
+
+    def _stream_run(self, url: str, payload: dict[str, Any]) -> Generator[ChatMessage | str | dict, None, None]:
+        """
+        Start a run by posting `payload` to `url` and stream its messages. If the connection drops, the run keeps
+        going on the server, so reattach to it from the last event received, up to max_reconnects times.
+        """
+        run_id = None
+        last_event_id = None
+        reconnects = 0
+        with httpx.Client() as client:
+            while True:
+                if run_id is None:
+                    request = client.stream("POST", url, json=payload, headers=self._headers, timeout=self.timeout)
+                else:
+                    request = client.stream("GET", f"{self.base_url}/stream/{run_id}", headers=self._reattach_headers(last_event_id), timeout=self.timeout)
+                try:
+                    with request as response:
+                        if response.status_code != 200:
+                            response.read()
+                            raise Exception(f"Error: {response.status_code} - {response.text}")
+                        run_id = response.headers.get("X-Run-ID")
+                        for line in response.iter_lines():
+                            if line.startswith("id:"):
+                                last_event_id = line[3:].strip()
+                                continue
+                            if not line.strip():
+                                continue
+                            if line.strip() == "data: [DONE]":
+                                return
+                            parsed = self._parse_stream_line(line)
+                            if parsed is not None:
+                                yield parsed
+                        return
+                except httpx.TransportError:
+                    # Without a run ID there is nothing to reattach to, i.e. the run never started
+                    if run_id is None or reconnects >= self.max_reconnects:
+                        raise
+                    reconnects += 1
+                    logger.info("Connection to run %s dropped, reattaching from event %s", run_id, last_event_id)
+
+    async def _astream_run(self, url: str, payload: dict[str, Any]) -> AsyncGenerator[ChatMessage | str | dict, None]:
+        """Async version of _stream_run."""
+        run_id = None
+        last_event_id = None
+        reconnects = 0
         async with httpx.AsyncClient() as client:
-            async with client.stream(
-                "POST",
-                f"{self.base_url}/approval/{thread_id}",
-                json=user_input.model_dump(),
-                headers=self._headers,
-                timeout=self.timeout,
-            ) as response:
-                if response.status_code != 200:
-                    content = await response.aread()
-                    raise Exception(f"Error: {response.status_code} - {content.decode('utf-8')}")
-                async for line in response.aiter_lines():
-                    if line.strip():
-                        parsed = self._parse_stream_line(line)
-                        if parsed is None:
-                            break
-                        # On receiving an approval request, we need to yeild it to streamlit and stop streaming
-                        if isinstance(parsed, dict) and parsed["type"] == "approval_request":
-                            yield parsed
-                        yield parsed
+            while True:
+                if run_id is None:
+                    request = client.stream("POST", url, json=payload, headers=self._headers, timeout=self.timeout)
+                else:
+                    request = client.stream("GET", f"{self.base_url}/stream/{run_id}", headers=self._reattach_headers(last_event_id), timeout=self.timeout)
+                try:
+                    async with request as response:
+                        if response.status_code != 200:
+                            content = await response.aread()
+                            raise Exception(f"Error: {response.status_code} - {content.decode('utf-8')}")
+                        run_id = response.headers.get("X-Run-ID")
+                        async for line in response.aiter_lines():
+                            if line.startswith("id:"):
+                                last_event_id = line[3:].strip()
+                                continue
+                            if not line.strip():
+                                continue
+                            if line.strip() == "data: [DONE]":
+                                return
+                            parsed = self._parse_stream_line(line)
+                            if parsed is not None:
+                                yield parsed
+                        return
+                except httpx.TransportError:
+                    # Without a run ID there is nothing to reattach to, i.e. the run never started
+                    if run_id is None or reconnects >= self.max_reconnects:
+                        raise
+                    reconnects += 1
+                    logger.info("Connection to run %s dropped, reattaching from event %s", run_id, last_event_id)
 
     async def acreate_feedback(
         self, run_id: str, key: str, score: float, kwargs: dict[str, Any] = {}
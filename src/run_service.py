@@ -6,7 +6,11 @@ from dotenv import load_dotenv
 load_dotenv()
 
 if __name__ == "__main__":
-    if os.getenv("MODE") != "dev":
+    workers = int(os.getenv("WORKERS", 1))
+    if os.getenv("MODE") != "dev" and workers > 1:
+        # Each worker is a separate process with its own runs, caches and rate limiters, sharing the checkpointer
+        uvicorn.run("service:app", host="0.0.0.0", port=int(os.getenv("PORT", 5000)), workers=workers)
+    elif os.getenv("MODE") != "dev":
         from service import app
 
         uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
@@ -4,11 +4,15 @@ from schema.schema import (
     Feedback,
     FeedbackResponse,
     StreamInput,
+    StreamOptions,
     UserInput,
     convert_message_content_to_string,
     ToolCallApproval,
     ConsentAuthBody,
     AuthResponse,
+    ModelList,
+    ComponentStatus,
+    Readiness,
 )
 
 __all__ = [
@@ -16,10 +20,14 @@ __all__ = [
     "AgentResponse",
     "ChatMessage",
     "StreamInput",
+    "StreamOptions",
     "Feedback",
     "FeedbackResponse",
     "convert_message_content_to_string",
     "ToolCallApproval",
     "ConsentAuthBody",
     "AuthResponse",
+    "ModelList",
+    "ComponentStatus",
+    "Readiness",
 ]
\ No newline at end of file
@@ -42,9 +42,39 @@ class UserInput(BaseModel):
         description="Whether this input is a tool call approval.",
         default=False,
     )
+    model: str | None = Field(
+        description="LLM model to use for the agent. Once set, the model is kept for the rest of the thread. See /models for the available models.",
+        default=None,
+        examples=["gpt-4o-mini"],
+    )
 
 
-class StreamInput(UserInput):
+class StreamOptions(BaseModel):
+    """Options controlling how a response is encoded on the SSE stream."""
+
+    coalesce_tokens_ms: int = Field(
+        description="Send the tokens generated within this many milliseconds as a single token frame. 0 sends every token as it arrives.",
+        default=0,
+        ge=0,
+        examples=[50],
+    )
+    coalesce_tokens_bytes: int = Field(
+        description="When coalescing tokens, send the frame early once it holds this many bytes of token text. 0 for no limit.",
+        default=0,
+        ge=0,
+        examples=[256],
+    )
+    omit_original: bool = Field(
+        description="Leave the serialized LangChain message out of message frames, it duplicates the content and tool calls.",
+        default=False,
+    )
+    compact_json: bool = Field(
+        description="Encode frames as compact JSON without whitespace, using a fast encoder if the service has one.",
+        default=False,
+    )
+
+
+class StreamInput(UserInput, StreamOptions):
     """User input for streaming the agent's response."""
 
     stream_tokens: bool = Field(
@@ -140,16 +170,24 @@ class ChatMessage(BaseModel):
             raw_original = messages_from_dict([self.original])[0]
             raw_original.content = self.content
             return raw_original
+        # Message frames sent with omit_original only carry the fields of this model
         match self.type:
             case "human":
                 return HumanMessage(content=self.content)
+            case "ai":
+                return AIMessage(content=self.content, tool_calls=self.tool_calls)
+            case "tool":
+                return ToolMessage(content=self.content, tool_call_id=self.tool_call_id or "")
             case _:
                 raise NotImplementedError(f"Unsupported message type: {self.type}")
 
+    def pretty_repr(self) -> str:
+        """Pretty representation of the ChatMessage, as printed by pretty_print."""
+        return self.to_langchain().pretty_repr()
+
     def pretty_print(self) -> None:
         """Pretty print the ChatMessage."""
-        lc_msg = self.to_langchain()
-        lc_msg.pretty_print()
+        print(self.pretty_repr())
 
 
 class Feedback(BaseModel):
@@ -177,7 +215,51 @@ class Feedback(BaseModel):
 class FeedbackResponse(BaseModel):
     status: Literal["success"] = "success"
 
-class ToolCallApproval(BaseModel):
+class ModelList(BaseModel):
+    """Models that can be selected per request or per thread."""
+
+    default: str = Field(
+        description="Model used when no model is selected.",
+        examples=["gpt-4o"],
+    )
+    models: list[str] = Field(
+        description="Available models.",
+        examples=[["gpt-4o", "gpt-4o-mini"]],
+    )
+
+class ComponentStatus(BaseModel):
+    """Warm-up state of one component of the service."""
+
+    status: Literal["pending", "warming", "warm", "failed", "skipped"] = Field(
+        description="Warm-up status of the component.",
+        examples=["warm"],
+    )
+    required: bool = Field(
+        description="Whether the service is only ready once this component is warm.",
+        default=True,
+    )
+    seconds: float | None = Field(
+        description="How long the last warm-up attempt took.",
+        default=None,
+        examples=[0.42],
+    )
+    error: str | None = Field(
+        description="Error of the last failed warm-up attempt.",
+        default=None,
+    )
+
+class Readiness(BaseModel):
+    """Whether the service can serve requests at full speed, and the warm-up state of each component."""
+
+    ready: bool = Field(
+        description="True once all required components are warm.",
+    )
+    components: dict[str, ComponentStatus] = Field(
+        description="Warm-up state per component.",
+        examples=[{"vector_store:obp_glossary": {"status": "warm", "required": True, "seconds": 0.7, "error": None}}],
+    )
+
+class ToolCallApproval(StreamOptions):
     approval: Literal["approve", "deny"] = Field(
         description="Approval status for the tool call.",
     )
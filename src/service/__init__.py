@@ -1,3 +1,3 @@
-from service.service import app, opey_instance
+from service.service import app
 
-__all__ = ["app", "opey_instance"]
\ No newline at end of file
+__all__ = ["app"]
\ No newline at end of file
@@ -0,0 +1,135 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Literal
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+RunKind = Literal["stream", "invoke", "approval"]
+
+admission_queue_depth = metrics.gauge("opey_admission_queue_depth", "Requests waiting for a run slot")
+admission_active_runs = metrics.gauge("opey_admission_active_runs", "Runs holding a run slot")
+admission_wait = metrics.histogram("opey_admission_wait_seconds", "Time requests waited for a run slot, by kind")
+admission_rejected = metrics.counter("opey_admission_rejected_total", "Requests rejected with a 429, by kind and reason")
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request can't get a run slot. `retry_after` is a hint for the client, in seconds."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits the number of runs executing at once, so that admitted runs keep a predictable latency under load
+    instead of every run slowing down together.
+
+    Requests that can't run straight away wait in a queue of at most `max_queue` requests, for up to
+    `queue_timeout` seconds. Requests are rejected when the queue is full or they time out. Approvals continue
+    a turn the user is waiting on, with `prioritise_approvals` they go ahead of the queue and are not rejected
+    because the queue is full.
+
+    With `max_concurrent` at 0 every request is admitted straight away, runs are only counted.
+    """
+
+    def __init__(self, max_concurrent: int = 0, max_queue: int = 0, queue_timeout: float = 10, prioritise_approvals: bool = True):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.prioritise_approvals = prioritise_approvals
+        self.active = 0
+        # Waiting requests as (priority, arrival, future), the future is resolved when a slot is handed over
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+        # Mean run duration, for the Retry-After hint
+        self._mean_run_seconds = 10.0
+
+    def _update_gauges(self) -> None:
+        admission_queue_depth.set(len(self._waiters))
+        admission_active_runs.set(self.active)
+
+    def retry_after(self) -> int:
+        """Estimate of the seconds until a slot frees up for a new request."""
+        if self.max_concurrent <= 0:
+            return 1
+        return max(1, math.ceil(self._mean_run_seconds * (len(self._waiters) + 1) / self.max_concurrent))
+
+    def _reject(self, kind: RunKind, reason: str) -> AdmissionRejected:
+        admission_rejected.inc(kind=kind, reason=reason)
+        retry_after = self.retry_after()
+        logger.warning(f"Rejected {kind} request ({reason}), {self.active} runs active and {len(self._waiters)} waiting, retry after {retry_after}s")
+        return AdmissionRejected(reason, retry_after)
+
+    async def acquire(self, kind: RunKind) -> None:
+        """
+        Wait for a run slot.
+        Raises:
+            AdmissionRejected: If the queue is full or the request waited longer than `queue_timeout`
+        """
+        if self.max_concurrent <= 0 or (self.active < self.max_concurrent and not self._waiters):
+            self.active += 1
+            self._update_gauges()
+            admission_wait.observe(0, kind=kind)
+            return
+
+        priority = 0 if kind == "approval" and self.prioritise_approvals else 1
+        if priority and len(self._waiters) >= self.max_queue:
+            raise self._reject(kind, "queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._arrivals), waiter)
+        heapq.heappush(self._waiters, entry)
+        self._update_gauges()
+        start = time.perf_counter()
+        try:
+            # Shielded so that a timeout can't cancel the waiter while a slot is being handed to it
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except BaseException as e:
+            # Timed out, or the client went away
+            if waiter.done():
+                # A slot was handed over just as the request stopped waiting, pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            self._update_gauges()
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject(kind, "queue_timeout")
+            raise
+        finally:
+            admission_wait.observe(time.perf_counter() - start, kind=kind)
+
+    def release(self, run_seconds: float | None = None) -> None:
+        """Free a run slot, handing it to the next waiting request if there is one."""
+        if run_seconds is not None:
+            self._mean_run_seconds += (run_seconds - self._mean_run_seconds) * 0.1
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                # The slot goes straight to the waiter, so active stays the same
+                waiter.set_result(None)
+                self._update_gauges()
+                return
+        self.active -= 1
+        self._update_gauges()
+
+    @asynccontextmanager
+    async def slot(self, kind: RunKind) -> AsyncIterator[None]:
+        """Hold a run slot for the duration of the block."""
+        await self.acquire(kind)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
@@ -1,7 +1,13 @@
+import hmac
 import jwt
 import os
+import time
+
+from collections import OrderedDict
+from typing import Any
 
 from dotenv import load_dotenv
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 load_dotenv()
 
@@ -10,4 +16,87 @@ def sign_jwt(payload: dict) -> str:
     secret = os.getenv("JWT_SIGNING_SECRET")
     if not secret:
         raise ValueError("JWT_SIGNING_SECRET not set in environment variables. Please set it.")
-    return jwt.encode(payload, secret, algorithm="HS256")
\ No newline at end of file
+    return jwt.encode(payload, secret, algorithm="HS256")
+
+
+class VerifiedTokenCache:
+    """
+    Opey JWTs that verified recently, so that a client sending the same token with every request is only
+    checked once per `ttl_seconds`. Tokens are kept no longer than their own expiry.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._tokens: OrderedDict[str, float] = OrderedDict()
+
+    def verify(self, token: str, secret: str) -> bool:
+        now = time.time()
+        expires_at = self._tokens.get(token)
+        if expires_at is not None:
+            if expires_at > now:
+                return True
+            del self._tokens[token]
+        try:
+            payload = jwt.decode(token, secret, algorithms=["HS256"])
+        except jwt.InvalidTokenError:
+            return False
+        expires_at = now + self.ttl_seconds
+        if "exp" in payload:
+            expires_at = min(expires_at, float(payload["exp"]))
+        self._tokens[token] = expires_at
+        if len(self._tokens) > self.max_size:
+            self._tokens.popitem(last=False)
+        return True
+
+
+def _unauthorized_start(content: bytes) -> dict[str, Any]:
+    return {
+        "type": "http.response.start",
+        "status": 401,
+        "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", str(len(content)).encode())],
+    }
+
+
+class AuthMiddleware:
+    """
+    Checks that HTTP requests carry the AUTH_SECRET as a bearer token, or an Opey JWT from /auth as a bearer token
+    or in the `jwt` cookie. Nothing is checked if AUTH_SECRET isn't set.
+
+    This is a plain ASGI middleware: it only reads the request headers, and passes the request body and the
+    response through untouched, so streamed responses aren't slowed down.
+    """
+
+    def __init__(self, app: ASGIApp, auth_secret: str | None = None, jwt_secret: str | None = None, token_cache: VerifiedTokenCache | None = None):
+        self.app = app
+        self.auth_secret = auth_secret.encode() if auth_secret else None
+        self.jwt_secret = jwt_secret
+        self.token_cache = token_cache or VerifiedTokenCache()
+
+    def _authorized(self, token: str | None) -> bool:
+        if not token:
+            return False
+        # Constant time, so the secret can't be guessed from response timings
+        if hmac.compare_digest(token.encode(), self.auth_secret):
+            return True
+        return self.jwt_secret is not None and self.token_cache.verify(token, self.jwt_secret)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or self.auth_secret is None:
+            await self.app(scope, receive, send)
+            return
+        bearer = cookie_token = None
+        for name, value in scope["headers"]:
+            if name == b"authorization" and value.startswith(b"Bearer "):
+                bearer = value[7:].decode("latin-1")
+            elif name == b"cookie":
+                for cookie in value.decode("latin-1").split(";"):
+                    key, _, cookie_value = cookie.strip().partition("=")
+                    if key == "jwt":
+                        cookie_token = cookie_value
+        if self._authorized(bearer) or (cookie_token and self._authorized(cookie_token)):
+            await self.app(scope, receive, send)
+            return
+        content = b"Invalid token" if bearer else b"Missing or invalid token"
+        await send(_unauthorized_start(content))
+        await send({"type": "http.response.body", "body": content})
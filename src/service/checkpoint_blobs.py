@@ -0,0 +1,305 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from collections.abc import Iterable
+from typing import Any
+
+from langchain_core.messages import BaseMessage
+from langgraph.checkpoint.serde.base import SerializerProtocol
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+# Key in a message's additional_kwargs pointing to its content in the blob store
+BLOB_MARKER = "__opey_blob__"
+# Blob keys are sha256 hex digests, they appear as plain text in serialized checkpoints
+BLOB_KEY_PATTERN = re.compile(rb"[0-9a-f]{64}")
+
+blobs_written = metrics.counter("opey_checkpoint_blobs_written_total", "Message contents written to the checkpoint blob store")
+blob_bytes_offloaded = metrics.counter(
+    "opey_checkpoint_blob_bytes_offloaded_total",
+    "Bytes of message content replaced by blob references in serialized checkpoints",
+)
+
+
+class _LRU(OrderedDict):
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key: Any, value: Any) -> None:
+        self[key] = value
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+class SqliteBlobStore:
+    """
+    Content addressed blob store in an SQLite database. This has to be a different file from the checkpoint
+    database: blobs are written synchronously from the serializer, which would wait forever for a write lock
+    held by the checkpointer's connection, as the checkpointer can't commit while the event loop is blocked.
+    """
+
+    def __init__(self, path: str, timeout: float = 0.5, batch_size: int = 200):
+        # Blobs are put from the event loop, so waiting on another worker's lock is kept short
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=timeout)
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        with self._lock:
+            # auto_vacuum only applies to new databases, freed pages are then given back after deletes
+            self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint_blobs (key TEXT PRIMARY KEY, data BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def put(self, key: str, data: bytes) -> None:
+        # A blob that's already stored only has its created_at refreshed, so the sweep's grace period restarts
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO checkpoint_blobs (key, data, created_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET created_at = excluded.created_at",
+                (key, data, time.time()),
+            )
+            self._conn.commit()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM checkpoint_blobs WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def delete_unreferenced(self, live_keys: set[str], created_before: float) -> int:
+        with self._lock:
+            keys = [key for (key,) in self._conn.execute("SELECT key FROM checkpoint_blobs WHERE created_at < ?", (created_before,))]
+        dead = [key for key in keys if key not in live_keys]
+        deleted = 0
+        # A batch at a time, the lock is released in between so that puts from the event loop don't wait for the sweep
+        for start in range(0, len(dead), self.batch_size):
+            batch = dead[start:start + self.batch_size]
+            placeholders = ", ".join("?" * len(batch))
+            with self._lock:
+                # created_at is checked again, the blob may have been put again since it was read
+                deleted += self._conn.execute(
+                    f"DELETE FROM checkpoint_blobs WHERE key IN ({placeholders}) AND created_at < ?", (*batch, created_before)
+                ).rowcount
+                self._conn.commit()
+        if deleted:
+            with self._lock:
+                self._conn.execute("PRAGMA incremental_vacuum")
+        return deleted
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class FileBlobStore:
+    """Content addressed blob store in a directory, one file per blob."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        try:
+            # Already stored, its mtime is refreshed so the sweep's grace period restarts
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so that readers never see a partial blob
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete_unreferenced(self, live_keys: set[str], created_before: float) -> int:
+        deleted = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name in live_keys or name.endswith(".tmp"):
+                    continue
+                try:
+                    if os.path.getmtime(path) < created_before:
+                        os.remove(path)
+                        deleted += 1
+                except FileNotFoundError:
+                    pass
+        return deleted
+
+    def close(self) -> None:
+        pass
+
+
+BlobStore = SqliteBlobStore | FileBlobStore
+
+
+class BlobOffloadingSerializer(SerializerProtocol):
+    """
+    Serializer storing large message contents out of line, once, in a content addressed blob store.
+
+    Every checkpoint holds the thread's full message history, so without this a large ToolMessage (i.e. an OBP
+    response or endpoint documentation) is written again with every later checkpoint. Here the content of
+    messages of at least `min_bytes` is replaced by a reference to its blob, and put back when the checkpoint
+    is loaded. A blob is put again, refreshing it in the store, when it was last put over `refresh_seconds`
+    ago, so that the store's sweep never deletes a blob a new checkpoint refers to. The sweep's grace period
+    has to be longer than `refresh_seconds`.
+    """
+
+    def __init__(
+        self,
+        inner: SerializerProtocol,
+        store: BlobStore,
+        min_bytes: int = 4096,
+        cache_size: int = 512,
+        refresh_seconds: float = 60,
+    ):
+        self.inner = inner
+        self.store = store
+        self.min_bytes = min_bytes
+        self.refresh_seconds = refresh_seconds
+        # Blob keys of recently serialized messages by (id, content length), to avoid hashing them again
+        self._message_keys = _LRU(cache_size * 8)
+        # When recently put blobs were last put, by key
+        self._put_times = _LRU(cache_size * 8)
+        # Recently loaded blobs by key
+        self._blobs = _LRU(cache_size)
+
+    def _offload_message(self, message: BaseMessage) -> BaseMessage:
+        if BLOB_MARKER in message.additional_kwargs:
+            return message
+        content = message.content
+        cache_key = (message.id, len(content)) if message.id else None
+        cached = self._message_keys.get(cache_key) if cache_key else None
+        if cached is None:
+            if isinstance(content, str):
+                if len(content) < self.min_bytes // 4:
+                    # Can't be over min_bytes once encoded, skip encoding it
+                    return message
+                data, content_format = content.encode(), "text"
+            else:
+                data, content_format = json.dumps(content).encode(), "json"
+            if len(data) < self.min_bytes:
+                return message
+            cached = (hashlib.sha256(data).hexdigest(), content_format, len(data))
+            if cache_key:
+                self._message_keys.put(cache_key, cached)
+        else:
+            data = None
+        key, content_format, size = cached
+        now = time.monotonic()
+        put_at = self._put_times.get(key)
+        if put_at is None or now - put_at >= self.refresh_seconds:
+            if data is None:
+                data = content.encode() if content_format == "text" else json.dumps(content).encode()
+            try:
+                self.store.put(key, data)
+            except (sqlite3.Error, OSError) as e:
+                # i.e. another worker holds the blob database, the content is kept in the checkpoint this time
+                logger.warning(f"Failed to store the content of message {message.id} in the checkpoint blob store: {e}")
+                return message
+            self._put_times.put(key, now)
+            blobs_written.inc()
+        blob_bytes_offloaded.inc(size)
+        return message.model_copy(
+            update={"content": "", "additional_kwargs": {**message.additional_kwargs, BLOB_MARKER: {"key": key, "format": content_format}}}
+        )
+
+    def _resolve_message(self, message: BaseMessage) -> BaseMessage:
+        reference = message.additional_kwargs.pop(BLOB_MARKER, None)
+        if reference is None:
+            return message
+        data = self._blobs.get(reference["key"])
+        if data is None:
+            data = self.store.get(reference["key"])
+            if data is None:
+                logger.warning(f"Blob {reference['key']} of message {message.id} is missing from the checkpoint blob store")
+                message.content = "[content unavailable]"
+                return message
+            self._blobs.put(reference["key"], data)
+        # Decoded every time, so that messages never share a content list
+        message.content = data.decode() if reference["format"] == "text" else json.loads(data)
+        return message
+
+    def _map_messages(self, obj: Any, fn: Any, depth: int = 0) -> Any:
+        """Apply `fn` to the messages in `obj`, copying only the containers that change."""
+        if isinstance(obj, BaseMessage):
+            return fn(obj)
+        # Messages are at most a few levels deep, i.e. checkpoint -> channel_values -> messages -> message
+        if depth > 4:
+            return obj
+        if isinstance(obj, dict):
+            changed = {k: v2 for k, v in obj.items() if (v2 := self._map_messages(v, fn, depth + 1)) is not v}
+            return {**obj, **changed} if changed else obj
+        # Only plain lists and tuples, named tuples can't be rebuilt from a list
+        if type(obj) in (list, tuple):
+            mapped = [self._map_messages(v, fn, depth + 1) for v in obj]
+            if all(a is b for a, b in zip(mapped, obj)):
+                return obj
+            return type(obj)(mapped)
+        return obj
+
+    def dumps(self, obj: Any) -> bytes:
+        return self.inner.dumps(self._map_messages(obj, self._offload_message))
+
+    def dumps_typed(self, obj: Any) -> tuple[str, bytes]:
+        return self.inner.dumps_typed(self._map_messages(obj, self._offload_message))
+
+    def loads(self, data: bytes) -> Any:
+        return self._map_messages(self.inner.loads(data), self._resolve_message)
+
+    def loads_typed(self, data: tuple[str, bytes]) -> Any:
+        return self._map_messages(self.inner.loads_typed(data), self._resolve_message)
+
+
+def referenced_blob_keys(serialized: Iterable[bytes | None]) -> set[str]:
+    """Blob keys that appear in serialized checkpoints. Other hex strings may match too, which only keeps blobs longer."""
+    keys: set[str] = set()
+    for data in serialized:
+        if data:
+            keys.update(match.decode() for match in BLOB_KEY_PATTERN.findall(data))
+    return keys
+
+
+def create_blob_store() -> BlobStore | None:
+    """The blob store configured with CHECKPOINT_BLOB_STORE, sqlite (the default), file or none."""
+    kind = os.getenv("CHECKPOINT_BLOB_STORE", "sqlite")
+    if kind == "sqlite":
+        return SqliteBlobStore(
+            os.getenv("CHECKPOINT_BLOB_DB_PATH", "checkpoint_blobs.db"),
+            timeout=float(os.getenv("CHECKPOINT_BLOB_BUSY_TIMEOUT_MS", 500)) / 1000,
+        )
+    if kind == "file":
+        return FileBlobStore(os.getenv("CHECKPOINT_BLOB_DIR", "checkpoint_blobs"))
+    if kind != "none":
+        raise ValueError(f"Unknown CHECKPOINT_BLOB_STORE {kind}, use sqlite, file or none")
+    return None
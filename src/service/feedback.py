@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+from typing import Protocol
+
+from schema import Feedback
+from utils.metrics import metrics
+from utils.startup_timing import startup_report
+from .admission import AdmissionRejected
+
+logger = logging.getLogger("uvicorn.error")
+
+feedback_submissions = metrics.counter("opey_feedback_submissions_total", "Feedback submissions, by result (submitted, failed, rejected)")
+feedback_queue_depth = metrics.gauge("opey_feedback_queue_depth", "Feedback waiting to be submitted")
+feedback_batch_seconds = metrics.histogram("opey_feedback_batch_seconds", "Duration of feedback batch submissions, by sink")
+
+
+class FeedbackSink(Protocol):
+    name: str
+
+    def write(self, batch: list[Feedback]) -> list[Feedback]:
+        """Submit a batch of feedback, returns the feedback that failed."""
+        ...
+
+
+class LangsmithFeedbackSink:
+    """Submits feedback to LangSmith with one long lived client, so its connections are reused between batches."""
+
+    name = "langsmith"
+
+    def __init__(self):
+        with startup_report.measure("init:langsmith"):
+            from langsmith import Client as LangsmithClient
+
+            self.client = LangsmithClient()
+
+    def write(self, batch: list[Feedback]) -> list[Feedback]:
+        failed = []
+        for feedback in batch:
+            try:
+                self.client.create_feedback(run_id=feedback.run_id, key=feedback.key, score=feedback.score, **(feedback.kwargs or {}))
+            except Exception as e:
+                logger.warning(f"Failed to submit feedback for run {feedback.run_id} to LangSmith: {e}")
+                failed.append(feedback)
+        return failed
+
+
+class FileFeedbackSink:
+    """Appends feedback to a JSON lines file, a stand-in for LangSmith when running offline."""
+
+    name = "file"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, batch: list[Feedback]) -> list[Feedback]:
+        lines = "".join(json.dumps({"submitted_at": time.time(), **feedback.model_dump()}) + "\n" for feedback in batch)
+        with self._lock, open(self.path, "a") as f:
+            f.write(lines)
+        return []
+
+
+class FeedbackSubmitter:
+    """
+    Submits feedback from a background task, so that /feedback returns straight away and bursts of feedback
+    don't hold up the event loop. Feedback is queued, up to `max_queue` of it, and submitted in batches of up
+    to `batch_size`, at least every `flush_interval` seconds, in a worker thread as the sinks are synchronous.
+    Feedback that fails is retried with backoff up to `max_retries` times.
+    """
+
+    def __init__(self, sink: FeedbackSink, max_queue: int = 1000, batch_size: int = 50, flush_interval: float = 1, max_retries: int = 3):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue: asyncio.Queue[tuple[Feedback, int]] = asyncio.Queue(max_queue)
+        self._task: asyncio.Task | None = None
+
+    def submit(self, feedback: Feedback) -> None:
+        """
+        Queue feedback for submission.
+        Raises:
+            AdmissionRejected: If the queue is full
+        """
+        try:
+            self._queue.put_nowait((feedback, 0))
+        except asyncio.QueueFull:
+            feedback_submissions.inc(result="rejected")
+            raise AdmissionRejected("feedback_queue_full", max(1, round(self.flush_interval)))
+        feedback_queue_depth.set(self._queue.qsize())
+
+    async def _next_batch(self) -> list[tuple[Feedback, int]]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _submit(self, batch: list[tuple[Feedback, int]]) -> None:
+        attempts = {id(feedback): attempt for feedback, attempt in batch}
+        with feedback_batch_seconds.time(sink=self.sink.name):
+            failed = await asyncio.to_thread(self.sink.write, [feedback for feedback, _ in batch])
+        feedback_submissions.inc(len(batch) - len(failed), result="submitted")
+        for feedback in failed:
+            attempt = attempts[id(feedback)] + 1
+            if attempt > self.max_retries:
+                feedback_submissions.inc(result="failed")
+                logger.warning(f"Dropping feedback for run {feedback.run_id} after {attempt} failed attempts")
+                continue
+            # Retried later without holding up the rest of the queue
+            asyncio.get_running_loop().call_later(min(2 ** attempt, 30), self._requeue, feedback, attempt)
+
+    def _requeue(self, feedback: Feedback, attempt: int) -> None:
+        try:
+            self._queue.put_nowait((feedback, attempt))
+        except asyncio.QueueFull:
+            feedback_submissions.inc(result="failed")
+
+    async def run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            feedback_queue_depth.set(self._queue.qsize())
+            try:
+                await self._submit(batch)
+            except Exception as e:
+                logger.warning(f"Feedback submission failed: {e}")
+                feedback_submissions.inc(len(batch), result="failed")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Submit the queued feedback, waiting up to `timeout` seconds, and stop. Pending retries are dropped."""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Feedback submission didn't finish within {timeout}s on shutdown, {self._queue.qsize()} left unsubmitted")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def create_feedback_submitter() -> FeedbackSubmitter | None:
+    """The feedback submitter for FEEDBACK_SINK, langsmith (the default), file or none."""
+    sink_name = os.getenv("FEEDBACK_SINK", "langsmith")
+    if sink_name == "none":
+        return None
+    if sink_name == "langsmith":
+        sink = LangsmithFeedbackSink()
+    elif sink_name == "file":
+        sink = FileFeedbackSink(os.getenv("FEEDBACK_FILE_PATH", "feedback.jsonl"))
+    else:
+        raise ValueError(f"Unknown FEEDBACK_SINK {sink_name}, use langsmith, file or none")
+    return FeedbackSubmitter(
+        sink,
+        max_queue=int(os.getenv("FEEDBACK_QUEUE_SIZE", 1000)),
+        batch_size=int(os.getenv("FEEDBACK_BATCH_SIZE", 50)),
+        flush_interval=float(os.getenv("FEEDBACK_FLUSH_INTERVAL_SECONDS", 1)),
+    )
@@ -0,0 +1,161 @@
+import asyncio
+import hmac
+import logging
+import os
+import random
+import uuid
+
+from collections.abc import AsyncGenerator, AsyncIterator
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Literal
+
+from utils.metrics import metrics
+from utils.startup_timing import startup_report
+
+if TYPE_CHECKING:
+    from pyinstrument import Profiler
+
+logger = logging.getLogger("uvicorn.error")
+
+profiles_total = metrics.counter("opey_profiles_total", "Run profiles, by trigger (header, sampled) and result (saved, failed)")
+
+# Header asking for a request's run to be profiled, its value must be PROFILING_SECRET
+PROFILE_HEADER = "x-opey-profile"
+
+ProfileFormat = Literal["speedscope", "html"]
+_EXTENSIONS = {"speedscope": ".speedscope.json", "html": ".html"}
+_MEDIA_TYPES = {"speedscope": "application/json", "html": "text/html"}
+
+
+class RunProfiler:
+    """
+    Profiles whole agent runs with pyinstrument, for requests sending the profiling header and for a sample of
+    `sample_rate` of the others. Profiles are wall-clock and async aware: the time a run spends awaiting, i.e.
+    the model provider, Chroma or the checkpointer, is attributed to the code that awaited it rather than lost.
+
+    Each profile is saved in `profile_dir` under its run ID, in the background once the run ends, in the speedscope
+    format that speedscope.app and other flamegraph viewers open, or as pyinstrument's HTML. Only the latest
+    `max_profiles` are kept.
+    While a run is being profiled the event loop thread is sampled, which slows the other runs a little.
+    """
+
+    def __init__(
+        self,
+        profile_dir: str,
+        secret: str | None = None,
+        sample_rate: float = 0,
+        interval: float = 0.001,
+        format: ProfileFormat = "speedscope",
+        max_profiles: int = 100,
+    ):
+        try:
+            with startup_report.measure("import:pyinstrument"):
+                import pyinstrument  # noqa: F401
+        except ImportError as e:
+            raise ImportError("Profiling runs needs pyinstrument, install it with `pip install pyinstrument`") from e
+        self.profile_dir = profile_dir
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.format = format
+        self.max_profiles = max_profiles
+        self._saving: set[asyncio.Task] = set()
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def trigger(self, header: str | None) -> str | None:
+        """
+        Whether a request's run should be profiled.
+        Args:
+            header: The request's profiling header, if it sent one
+        Returns:
+            "header" or "sampled" if the run should be profiled, None otherwise
+        """
+        if header is not None:
+            if self.secret and hmac.compare_digest(header.encode(), self.secret.encode()):
+                return "header"
+            logger.warning("Ignoring a profiling request header that doesn't match PROFILING_SECRET")
+        if self.sample_rate and random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    def path(self, profile_id: str) -> str | None:
+        """The saved profile of a run, None if there isn't one."""
+        try:
+            profile_id = str(uuid.UUID(profile_id))
+        except ValueError:
+            return None
+        path = os.path.join(self.profile_dir, profile_id + _EXTENSIONS[self.format])
+        return path if os.path.exists(path) else None
+
+    @property
+    def media_type(self) -> str:
+        return _MEDIA_TYPES[self.format]
+
+    def _save(self, profiler: "Profiler", profile_id: str) -> None:
+        if self.format == "html":
+            output = profiler.output_html()
+        else:
+            from pyinstrument.renderers import SpeedscopeRenderer
+
+            output = profiler.output(SpeedscopeRenderer())
+        path = os.path.join(self.profile_dir, profile_id + _EXTENSIONS[self.format])
+        with open(path, "w") as f:
+            f.write(output)
+        # Oldest first, the latest max_profiles are kept
+        profiles = sorted(
+            (entry for entry in os.scandir(self.profile_dir) if entry.name.endswith(_EXTENSIONS[self.format])),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in profiles[:max(len(profiles) - self.max_profiles, 0)]:
+            os.remove(entry.path)
+        logger.info(f"Saved the profile of run {profile_id} to {path}")
+
+    @asynccontextmanager
+    async def profile(self, profile_id: str, trigger: str) -> AsyncIterator[None]:
+        """Profile the block, run in the current task, and save the profile under `profile_id`."""
+        from pyinstrument import Profiler
+
+        profiler = Profiler(interval=self.interval, async_mode="enabled")
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            # Saved in the background, so that the run can end, and release its thread, without waiting for it
+            task = asyncio.create_task(self._save_in_background(profiler, profile_id, trigger))
+            self._saving.add(task)
+            task.add_done_callback(self._saving.discard)
+
+    async def _save_in_background(self, profiler: "Profiler", profile_id: str, trigger: str) -> None:
+        try:
+            # Rendering a long run takes a while, it's done off the event loop
+            await asyncio.to_thread(self._save, profiler, profile_id)
+            profiles_total.inc(trigger=trigger, result="saved")
+        except Exception as e:
+            logger.warning(f"Failed to save the profile of run {profile_id}: {e}")
+            profiles_total.inc(trigger=trigger, result="failed")
+
+    async def profile_stream(self, profile_id: str, trigger: str, frames: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+        """Profile a streamed run, from its first frame to its last."""
+        async with self.profile(profile_id, trigger):
+            async for frame in frames:
+                yield frame
+
+
+def create_run_profiler() -> RunProfiler | None:
+    """
+    The run profiler, configured with the PROFILING_* env vars. Profiling is off, and costs nothing,
+    unless PROFILING_SECRET or PROFILING_SAMPLE_RATE is set.
+    """
+    secret = os.getenv("PROFILING_SECRET") or None
+    sample_rate = float(os.getenv("PROFILING_SAMPLE_RATE", 0))
+    if not secret and not sample_rate:
+        return None
+    return RunProfiler(
+        os.getenv("PROFILING_DIR", "profiles"),
+        secret=secret,
+        sample_rate=sample_rate,
+        interval=float(os.getenv("PROFILING_INTERVAL_SECONDS", 0.001)),
+        format=os.getenv("PROFILING_FORMAT", "speedscope"),
+        max_profiles=int(os.getenv("PROFILING_MAX_PROFILES", 100)),
+    )
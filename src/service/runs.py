@@ -0,0 +1,350 @@
+import asyncio
+import json
+import logging
+import time
+
+from collections import deque
+from collections.abc import AsyncGenerator, AsyncIterator, Hashable
+from contextlib import asynccontextmanager
+from typing import Any, Literal
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import ChatGeneration, LLMResult
+
+from utils.metrics import metrics
+from .sse import DONE_FRAME
+from .thread_leases import ThreadLeases
+
+logger = logging.getLogger("uvicorn.error")
+
+runs_cancelled = metrics.counter("opey_runs_cancelled_total", "Agent runs cancelled before finishing, by reason")
+run_tokens = metrics.counter("opey_run_tokens_total", "Tokens used by agent runs, by status (completed, cancelled, failed)")
+run_tokens_saved = metrics.counter(
+    "opey_run_tokens_saved_total",
+    "Estimated tokens not spent because runs were cancelled, from the mean tokens used by completed runs",
+)
+active_streams = metrics.gauge("opey_active_streams", "SSE streams currently open to clients")
+
+KEEP_ALIVE_FRAME = f"data: {json.dumps({'type': 'keep_alive', 'content': ''})}\n\n"
+
+
+class ThreadBusyError(Exception):
+    """Raised when a run can't be started because its thread already has runs in progress."""
+
+
+class RunTokenUsage(BaseCallbackHandler):
+    """Callback handler adding up the tokens used by every LLM call of a run, including those in subgraphs."""
+
+    run_inline = True
+
+    def __init__(self):
+        self.total_tokens = 0
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                if isinstance(generation, ChatGeneration) and generation.message.usage_metadata:
+                    self.total_tokens += generation.message.usage_metadata.get("total_tokens", 0)
+
+
+class AgentRun:
+    """
+    A graph run streaming in the background. The SSE frames it produces are numbered from 1 and the latest
+    `buffer_size` of them are kept, so that clients can reattach and resume from the last frame they received.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        thread_id: str,
+        buffer_size: int,
+        token_usage: RunTokenUsage | None = None,
+        request_key: Hashable | None = None,
+    ):
+        self.run_id = run_id
+        self.thread_id = thread_id
+        # Identifies the request that started the run, so that duplicate requests can attach to it
+        self.request_key = request_key
+        self.token_usage = token_usage or RunTokenUsage()
+        self.started_at = time.time()
+        self.finished_at: float | None = None
+        self.events: deque[tuple[int, str]] = deque(maxlen=buffer_size)
+        self.last_event_id = 0
+        self.task: asyncio.Task | None = None
+        # Whether the run has produced its last frame, it may still be releasing its thread
+        self.frames_done = False
+        self.subscribers = 0
+        self.cancel_reason: str | None = None
+        self._cancel_timer: asyncio.TimerHandle | None = None
+        self._changed = asyncio.Event()
+        # Set once the run no longer holds or waits for its thread, the thread's next run can go
+        self._turn_ended = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def append(self, frame: str) -> None:
+        self.last_event_id += 1
+        self.events.append((self.last_event_id, frame))
+        self._notify()
+
+    def finish(self) -> None:
+        self.finished_at = time.time()
+        self._notify()
+
+    def cancel(self, reason: str) -> None:
+        if self.task is not None and not self.task.done():
+            self.cancel_reason = reason
+            self.task.cancel()
+
+    def _notify(self) -> None:
+        # Wake up every subscriber waiting on the current event, later waits use a new one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def events_after(self, event_id: int) -> list[tuple[int, str]]:
+        """The buffered frames after `event_id`. Frames that were dropped from the buffer are skipped."""
+        new = min(self.last_event_id - event_id, len(self.events))
+        if new <= 0:
+            return []
+        # Indexing from the right end of the deque, new frames are usually few
+        return [self.events[i] for i in range(len(self.events) - new, len(self.events))]
+
+    async def subscribe(self, last_event_id: int = 0, heartbeat_seconds: float = 15) -> AsyncGenerator[str, None]:
+        """
+        Stream the run's frames after `last_event_id`, each with an SSE `id:` line, until the run is done.
+        A keep_alive frame is sent whenever no frame was sent for `heartbeat_seconds`.
+        """
+        cursor = last_event_id
+        while True:
+            # Take the event before reading the buffer, so frames appended while we are yielding aren't missed
+            changed = self._changed
+            events = self.events_after(cursor)
+            if events and events[0][0] > cursor + 1:
+                logger.warning(f"Run {self.run_id}: frames {cursor + 1} to {events[0][0] - 1} were dropped from the buffer before the client reattached")
+            for event_id, frame in events:
+                yield f"id: {event_id}\n{frame}"
+                cursor = event_id
+            if self.done and cursor >= self.last_event_id:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), heartbeat_seconds)
+            except asyncio.TimeoutError:
+                yield KEEP_ALIVE_FRAME
+
+
+class RunManager:
+    """
+    Runs agent streams as background tasks, so that a run doesn't end when the client's connection drops.
+    Finished runs are kept for `retention_seconds` so that clients can still fetch the end of the stream.
+
+    A run that has no client attached for `disconnect_grace_seconds` is cancelled, so that abandoned turns
+    stop spending tokens. A negative grace period keeps abandoned runs going until they finish.
+
+    Runs of the same thread never run at the same time, they would load the same checkpoint and interleave
+    their writes. With the "wait" policy a run waits for the thread's earlier runs, up to `queue_depth` runs
+    can wait per thread. With the "reject" policy a run can't start while the thread has one in progress.
+    With `leases`, the runs also wait for runs of the thread on other workers sharing the checkpoint database.
+    """
+
+    def __init__(
+        self,
+        buffer_size: int = 2048,
+        retention_seconds: float = 300,
+        heartbeat_seconds: float = 15,
+        disconnect_grace_seconds: float = 15,
+        busy_policy: Literal["wait", "reject"] = "wait",
+        queue_depth: int = 1,
+        leases: ThreadLeases | None = None,
+    ):
+        self.buffer_size = buffer_size
+        self.retention_seconds = retention_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.disconnect_grace_seconds = disconnect_grace_seconds
+        self.busy_policy = busy_policy
+        self.queue_depth = queue_depth
+        self.leases = leases
+        self.runs: dict[str, AgentRun] = {}
+        # Unfinished runs of each thread in the order they started, the first one is running
+        self._thread_runs: dict[str, list[AgentRun]] = {}
+        # Mean tokens used by completed runs, to estimate what cancelling a run saved
+        self._completed_runs = 0
+        self._mean_run_tokens = 0.0
+
+    def get(self, run_id: str) -> AgentRun | None:
+        return self.runs.get(run_id)
+
+    def find_duplicate(self, thread_id: str, request_key: Hashable | None) -> AgentRun | None:
+        """
+        The unfinished run of the thread started by the same request, i.e. after a double click or a retry.
+        Runs are found from the moment they are reserved, before they start.
+        """
+        if request_key is None:
+            return None
+        for run in self._thread_runs.get(thread_id, []):
+            if run.request_key == request_key:
+                return run
+        return None
+
+    async def reserve(self, run_id: str, thread_id: str, request_key: Hashable | None = None, allow_wait: bool = True) -> AgentRun:
+        """
+        Reserve the thread's next turn for a new run, if it can start under the busy policy. The run is queued
+        on the thread before anything is awaited, so that requests arriving together can't all pass the checks.
+        It must then be started with `start`, run with `thread_turn`, or given up with `discard`.
+        Args:
+            request_key (Hashable, optional): Identifies the request, see find_duplicate
+            allow_wait (bool): Whether the run may wait for the thread's other runs, if the policy allows it
+        Raises:
+            ThreadBusyError: If the run can't start
+        """
+        queued = self._thread_runs.get(thread_id, [])
+        # Runs that have produced their last frame are only releasing the thread, the new run waits for them
+        # whatever the policy, i.e. an approval sent as soon as the client sees the end of the previous run
+        in_progress = [queued_run for queued_run in queued if not queued_run.frames_done]
+        if in_progress:
+            if self.busy_policy == "reject" or not allow_wait:
+                raise ThreadBusyError(f"Thread {thread_id} already has a run in progress")
+            if len(in_progress) - 1 >= self.queue_depth:
+                raise ThreadBusyError(f"Thread {thread_id} already has {len(in_progress) - 1} run(s) waiting")
+        run = AgentRun(run_id, thread_id, self.buffer_size, request_key=request_key)
+        self._thread_runs.setdefault(thread_id, []).append(run)
+        if not queued and self.leases and (self.busy_policy == "reject" or not allow_wait):
+            try:
+                held_elsewhere = await self.leases.held_elsewhere(thread_id)
+            except BaseException:
+                self.discard(run)
+                raise
+            if held_elsewhere:
+                self.discard(run, "Thread already has a run in progress")
+                raise ThreadBusyError(f"Thread {thread_id} already has a run in progress")
+        return run
+
+    def discard(self, run: AgentRun, reason: str = "Run could not be started") -> None:
+        """Give up a reserved run that wasn't started, clients attached to it as duplicates get an error. Does nothing once the run's turn is over."""
+        queued = self._thread_runs.get(run.thread_id, [])
+        if run not in queued:
+            return
+        self._end_turn(run)
+        if run.task is None and not run.done:
+            run.append(f"data: {json.dumps({'type': 'error', 'content': reason})}\n\n")
+            run.append(DONE_FRAME)
+            run.finish()
+
+    def start(self, run: AgentRun, frames: AsyncIterator[str], token_usage: RunTokenUsage | None = None) -> AgentRun:
+        """
+        Start consuming `frames` in the background as the reserved `run`, once the thread's earlier runs are done.
+        Args:
+            token_usage (RunTokenUsage, optional): The callback handler counting the run's tokens, for the metrics
+        """
+        if token_usage is not None:
+            run.token_usage = token_usage
+        self.runs[run.run_id] = run
+        run.task = asyncio.create_task(self._run(run, frames))
+        return run
+
+    def _end_turn(self, run: AgentRun) -> None:
+        queued = self._thread_runs[run.thread_id]
+        queued.remove(run)
+        if not queued:
+            del self._thread_runs[run.thread_id]
+        run._turn_ended.set()
+
+    @asynccontextmanager
+    async def thread_turn(self, run: AgentRun) -> AsyncIterator[None]:
+        """
+        Wait for the thread's earlier runs, here and on other workers, and hold the thread until the block is done.
+        Used by `start` for streamed runs, and directly for runs that aren't streamed.
+        """
+        queued = self._thread_runs[run.thread_id]
+        try:
+            while queued[0] is not run:
+                # Only waits, cancelling this run doesn't cancel the earlier one
+                await queued[0]._turn_ended.wait()
+            if self.leases is None:
+                yield
+                return
+            owner = self.leases.owner(run.run_id)
+            await self.leases.acquire(run.thread_id, owner)
+            renewal = asyncio.create_task(self.leases.keep_renewed(run.thread_id, owner))
+            try:
+                yield
+            finally:
+                renewal.cancel()
+                await self.leases.release(run.thread_id, owner)
+        finally:
+            self._end_turn(run)
+
+    async def _run(self, run: AgentRun, frames: AsyncIterator[str]) -> None:
+        done_frame = None
+        try:
+            async with self.thread_turn(run):
+                async for frame in frames:
+                    if frame == DONE_FRAME:
+                        # Held back until the thread is released, so a client acting on it finds the thread free
+                        done_frame = frame
+                        continue
+                    run.append(frame)
+                run.frames_done = True
+            if done_frame is not None:
+                run.append(done_frame)
+        except asyncio.CancelledError:
+            self._record_cancelled(run)
+            run.append(f"data: {json.dumps({'type': 'error', 'content': 'Run was cancelled'})}\n\n")
+            run.append(DONE_FRAME)
+            raise
+        except Exception as e:
+            logger.error(f"Run {run.run_id} on thread {run.thread_id} failed: {e}")
+            run_tokens.inc(run.token_usage.total_tokens, status="failed")
+            run.append(f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n")
+            run.append(DONE_FRAME)
+        else:
+            self._record_completed(run)
+        finally:
+            run.finish()
+            asyncio.get_running_loop().call_later(self.retention_seconds, self._forget, run)
+
+    def _record_completed(self, run: AgentRun) -> None:
+        used = run.token_usage.total_tokens
+        run_tokens.inc(used, status="completed")
+        self._completed_runs += 1
+        self._mean_run_tokens += (used - self._mean_run_tokens) / self._completed_runs
+
+    def _record_cancelled(self, run: AgentRun) -> None:
+        used = run.token_usage.total_tokens
+        reason = run.cancel_reason or "unknown"
+        runs_cancelled.inc(reason=reason)
+        run_tokens.inc(used, status="cancelled")
+        saved = max(self._mean_run_tokens - used, 0) if self._completed_runs else 0
+        run_tokens_saved.inc(saved)
+        logger.info(f"Run {run.run_id} on thread {run.thread_id} cancelled ({reason}) after {used} tokens, ~{saved:.0f} tokens saved")
+
+    def _forget(self, run: AgentRun) -> None:
+        if self.runs.get(run.run_id) is run:
+            del self.runs[run.run_id]
+
+    async def subscribe(self, run: AgentRun, last_event_id: int = 0) -> AsyncGenerator[str, None]:
+        """Stream the run's frames to a client, see AgentRun.subscribe. The run is cancelled if it's left without clients."""
+        run.subscribers += 1
+        active_streams.inc()
+        if run._cancel_timer is not None:
+            run._cancel_timer.cancel()
+            run._cancel_timer = None
+        try:
+            async for frame in run.subscribe(last_event_id, self.heartbeat_seconds):
+                yield frame
+        finally:
+            run.subscribers -= 1
+            active_streams.dec()
+            if not run.subscribers and not run.done and self.disconnect_grace_seconds >= 0:
+                logger.info(f"Client disconnected from run {run.run_id}, cancelling it in {self.disconnect_grace_seconds}s unless a client reattaches")
+                run._cancel_timer = asyncio.get_running_loop().call_later(
+                    self.disconnect_grace_seconds, run.cancel, "client_disconnected"
+                )
+
+    async def shutdown(self) -> None:
+        """Cancel the runs that are still going."""
+        runs = [run for run in self.runs.values() if run.task is not None and not run.task.done()]
+        for run in runs:
+            run.cancel("shutdown")
+        await asyncio.gather(*(run.task for run in runs), return_exceptions=True)
@@ -1,59 +1,166 @@
 import json
 import os
 import warnings
-from collections.abc import AsyncGenerator, Callable
+from collections.abc import AsyncGenerator, Iterator
 from contextlib import asynccontextmanager
 from typing import Any, Union
 import uuid
 import asyncio
 import logging
-from fastapi import FastAPI, HTTPException, Request, Response, status
-from fastapi.responses import StreamingResponse
-from fastapi.middleware.cors import CORSMiddleware
-from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
-from langchain_core.runnables import RunnableConfig
-from langchain_core.runnables.schema import StreamEvent
-from langchain_core.messages import ToolMessage
-from langgraph.graph.state import CompiledStateGraph
-from langsmith import Client as LangsmithClient
+import time
+from utils.startup_timing import startup_report
+with startup_report.measure("import:fastapi"):
+    from fastapi import FastAPI, Header, HTTPException, Request, Response, status
+    from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+    from fastapi.middleware.cors import CORSMiddleware
+    from starlette.background import BackgroundTask
+with startup_report.measure("import:langgraph"):
+    from langchain_core.runnables import RunnableConfig
+    from langchain_core.runnables.schema import StreamEvent
+    from langchain_core.messages import AIMessage, BaseMessageChunk, ToolMessage
+    from langgraph.graph.state import CompiledStateGraph
 from utils.obp_utils import obp_requests
-from .auth import sign_jwt
-from agent import opey_graph, opey_graph_no_obp_tools
-from agent.components.chains import QueryFormulatorOutput
-from starlette.background import BackgroundTask
+from .auth import AuthMiddleware, sign_jwt
+from .sse import DONE_FRAME, SSEEncoder, SSEEvent, encode_sse_stream
+from .checkpoint_blobs import BlobOffloadingSerializer, create_blob_store
+from .checkpoint_store import CheckpointMaintenance, checkpoint_backend, open_checkpointer
+from .admission import AdmissionController, AdmissionRejected
+from .runs import AgentRun, RunManager, RunTokenUsage, ThreadBusyError
+from .thread_leases import create_thread_leases
+from .warmup import create_warmup
+from .feedback import create_feedback_submitter
+from .tracing import create_run_tracing
+from .profiling import create_run_profiler
+with startup_report.measure("import:agent"):
+    from agent import get_opey_graph, obp_calling_enabled
+    from agent.components.chains import QueryFormulatorOutput, prebuild_opey_agents
+    from agent.utils.model_factory import model_registry
+    from agent.utils.config import close_obp_session
+    from agent.utils.instrumentation import graph_metrics
 from schema import (
     ChatMessage,
     Feedback,
     FeedbackResponse,
     StreamInput,
+    StreamOptions,
     UserInput,
     convert_message_content_to_string,
     ToolCallApproval,
     ConsentAuthBody,
     AuthResponse,
+    ModelList,
+    Readiness,
 )
-from utils.chat_log import log_chat_message
+from utils.chat_log import close_chat_log_shipper, log_chat_message
+from utils.logs import Payload, configure_logging, stop_logging
+from utils.metrics import metrics
 
 logger = logging.getLogger('uvicorn.error')
 
-if os.getenv("DISABLE_OBP_CALLING") == "true":
-    logger.info("Disabling OBP tools: Calls to the OBP-API will not be available")
-    opey_instance = opey_graph_no_obp_tools
-else:
-    logger.info("Enabling OBP tools: Calls to the OBP-API will be available")
-    opey_instance = opey_graph
-
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
-    # Construct agent with Sqlite checkpointer
-    async with AsyncSqliteSaver.from_conn_string("checkpoints.db") as saver:
+    # Console output is written from a background thread, uvicorn has set up its loggers by now
+    configure_logging()
+    # Construct agent with the Sqlite or Postgres checkpointer
+    backend = checkpoint_backend()
+    async with open_checkpointer() as saver:
+        # Large message contents are stored once in the blob store instead of in every checkpoint. Unreferenced
+        # blobs are only swept from SQLite checkpoint databases, so this is off with Postgres
+        blob_store = create_blob_store() if backend == "sqlite" else None
+        if blob_store is not None:
+            min_bytes = int(os.getenv("CHECKPOINT_BLOB_MIN_BYTES", 4096))
+            saver.serde = BlobOffloadingSerializer(saver.serde, blob_store, min_bytes)
+            saver.jsonplus_serde = BlobOffloadingSerializer(saver.jsonplus_serde, blob_store, min_bytes)
+        # Only the graph in use is compiled
+        if obp_calling_enabled():
+            logger.info("Enabling OBP tools: Calls to the OBP-API will be available")
+        else:
+            logger.info("Disabling OBP tools: Calls to the OBP-API will not be available")
+        opey_instance = get_opey_graph()
         opey_instance.checkpointer = saver
+        # Build the agent for every selectable model now rather than on the first request that uses it
+        with startup_report.measure("init:opey_agents"):
+            prebuild_opey_agents()
         app.state.agent = opey_instance
+        startup_report.mark_ready()
+        startup_report.log(logger)
+        # Warm up in the background, /ready reports when it's done
+        warmup = create_warmup()
+        app.state.warmup = warmup
+        warmup.start()
+        app.state.admission = AdmissionController(
+            max_concurrent=int(os.getenv("MAX_CONCURRENT_RUNS", 0)),
+            max_queue=int(os.getenv("ADMISSION_QUEUE_SIZE", 0)),
+            queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", 10)),
+            prioritise_approvals=os.getenv("ADMISSION_PRIORITISE_APPROVALS", "true") == "true",
+        )
+        # Thread leases in the checkpoint database keep runs of a thread on different workers from overlapping
+        leases = create_thread_leases(saver, backend)
+        if leases is not None:
+            await leases.setup()
+        app.state.runs = RunManager(
+            buffer_size=int(os.getenv("RUN_EVENT_BUFFER_SIZE", 2048)),
+            retention_seconds=float(os.getenv("RUN_RETENTION_SECONDS", 300)),
+            heartbeat_seconds=float(os.getenv("STREAM_HEARTBEAT_SECONDS", 15)),
+            disconnect_grace_seconds=float(os.getenv("RUN_DISCONNECT_GRACE_SECONDS", 15)),
+            busy_policy=os.getenv("THREAD_BUSY_POLICY", "wait"),
+            queue_depth=int(os.getenv("THREAD_QUEUE_DEPTH", 1)),
+            leases=leases,
+        )
+        # Feedback is submitted in batches in the background
+        app.state.feedback = create_feedback_submitter()
+        if app.state.feedback is not None:
+            app.state.feedback.start()
+        # Sampled run traces are written to a local file, independently of LangSmith
+        app.state.tracing = create_run_tracing()
+        if app.state.tracing is not None:
+            app.state.tracing.writer.start()
+        # Runs are profiled on request, with PROFILING_SECRET in the X-Opey-Profile header, or for a sample of them
+        app.state.profiler = create_run_profiler()
+        # Retention, eviction of idle threads and vacuuming of the SQLite checkpoint database
+        checkpoint_maintenance = None
+        if backend == "sqlite":
+            checkpoint_maintenance = CheckpointMaintenance(
+                saver,
+                os.getenv("CHECKPOINT_DB_PATH", "checkpoints.db"),
+                keep_latest=int(os.getenv("CHECKPOINT_KEEP_LATEST", 20)),
+                thread_ttl_seconds=float(os.getenv("CHECKPOINT_THREAD_TTL_DAYS", 30)) * 24 * 3600,
+                interval_seconds=float(os.getenv("CHECKPOINT_MAINTENANCE_INTERVAL_SECONDS", 3600)),
+                vacuum_min_free_bytes=int(os.getenv("CHECKPOINT_VACUUM_MIN_FREE_BYTES", 64 * 1024 * 1024)),
+                blob_store=blob_store,
+                # With several workers only one of them runs maintenance
+                leases=leases,
+            )
+            checkpoint_maintenance.start()
         yield
-    # context manager will clean up the AsyncSqliteSaver on exit
+        if checkpoint_maintenance is not None:
+            await checkpoint_maintenance.stop()
+        await app.state.runs.shutdown()
+        if app.state.feedback is not None:
+            await app.state.feedback.stop()
+        if app.state.tracing is not None:
+            await app.state.tracing.writer.stop()
+        await warmup.stop()
+        await close_obp_session()
+        # Ship the chat logs still queued
+        await asyncio.to_thread(close_chat_log_shipper)
+        if blob_store is not None:
+            blob_store.close()
+    # context manager will clean up the checkpointer on exit
+    stop_logging()
 
 app = FastAPI(lifespan=lifespan)
 
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected) -> JSONResponse:
+    """Tell clients to back off when the service is at capacity."""
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": f"Service is at capacity ({exc.reason}), retry later"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 # Setup CORS policy
 if cors_allowed_origins := os.getenv("CORS_ALLOWED_ORIGINS"):
     app.add_middleware(
@@ -68,20 +175,7 @@ else:
 
 # TODO: change to implement our own authentication checking (also decide what auth to use)
 # NOTE: will be different when we use consents rather than a secret
-@app.middleware("http")
-async def check_auth_header(request: Request, call_next: Callable) -> Response:
-    request_body = await request.body()
-    logger.debug("This is coming from the auth middleware")
-    logger.debug(f"Request: {request_body}")
-    if auth_secret := os.getenv("AUTH_SECRET"):
-        auth_header = request.headers.get("Authorization")
-        if not auth_header or not auth_header.startswith("Bearer "):
-            return Response(status_code=401, content="Missing or invalid token")
-        if auth_header[7:] != auth_secret:
-            return Response(status_code=401, content="Invalid token")
-    response = await call_next(request)
-    logger.debug(f"Response: {response}")
-    return response
+app.add_middleware(AuthMiddleware, auth_secret=os.getenv("AUTH_SECRET"), jwt_secret=os.getenv("JWT_SIGNING_SECRET"))
 
 # @app.middleware("http")
 # async def log_request_response(request: Request, call_next: Callable):
@@ -95,9 +189,22 @@ async def check_auth_header(request: Request, call_next: Callable) -> Response:
 #     logger.info(f"Response: {response.status_code} {res_body}")
 #     return response
 
-def _parse_input(user_input: UserInput) -> tuple[dict[str, Any], uuid.UUID]:
-    run_id = uuid.uuid4()
+def _check_model_available(model: str | None) -> None:
+    """Raise a 422 if a model was requested that is not in the model registry."""
+    if model and not model_registry.is_available(model):
+        raise HTTPException(
+            status_code=422,
+            detail=f"Model '{model}' is not available. Available models: {model_registry.available_models()}",
+        )
+
+
+def _parse_input(user_input: UserInput, run_id: uuid.UUID | None = None) -> tuple[dict[str, Any], uuid.UUID]:
+    run_id = run_id or uuid.uuid4()
     thread_id = user_input.thread_id or str(uuid.uuid4())
+    configurable = {"thread_id": thread_id}
+    if user_input.model:
+        _check_model_available(user_input.model)
+        configurable["model"] = user_input.model
     # If this is a tool call approval, we don't need to send any input to the agent.
     if user_input.is_tool_call_approval:
         _input = None
@@ -105,10 +212,13 @@ def _parse_input(user_input: UserInput) -> tuple[dict[str, Any], uuid.UUID]:
         input_message = ChatMessage(type="human", content=user_input.message)
         _input = {"messages": [input_message.to_langchain()]}
 
+    callbacks = [graph_metrics]
+    if app.state.tracing is not None:
+        callbacks.append(app.state.tracing.tracer(thread_id))
     kwargs = {
         "input": _input,
         "config": RunnableConfig(
-            configurable={"thread_id": thread_id}, run_id=run_id
+            configurable=configurable, run_id=run_id, callbacks=callbacks
         ),
     }
     return kwargs, run_id
@@ -126,7 +236,48 @@ def _remove_tool_calls(content: Union[str, list[Union[str, dict]]]) -> Union[str
     ]
 
 
-async def _process_stream_event(event: StreamEvent, user_input: Union[StreamInput, ToolCallApproval], run_id: str) -> AsyncGenerator[str, None]:
+# Nodes whose output messages are not sent to the client
+_SILENT_MESSAGE_NODES = frozenset({"human_review", "summarize_conversation"})
+# Nodes running internal chains, whose LLM tokens are not streamed to the client
+_SILENT_TOKEN_NODES = frozenset({"transform_query", "retrieval_decider", "summarize_conversation", "route_model"})
+# This is a proper hacky way to make sure that no messages are sent from the retreiaval decider node
+_ERASE_CONTENT_NODES = frozenset({"retrieval_decider"})
+
+# Use the astream_events based streaming pipeline instead of graph stream modes
+STREAM_WITH_ASTREAM_EVENTS = os.getenv("STREAM_WITH_ASTREAM_EVENTS") == "true"
+
+
+def _message_events(new_messages: Any, node: str, user_input: Union[StreamInput, ToolCallApproval], run_id: str) -> Iterator[SSEEvent]:
+    """Stream events for the messages returned by a graph node."""
+    if not isinstance(new_messages, list):
+        new_messages = [new_messages]
+    erase_content = node in _ERASE_CONTENT_NODES
+    if erase_content:
+        logger.debug("Retrieval decider node returned text content, erasing...")
+
+    for message in new_messages:
+        if erase_content:
+            message.content = ""
+        try:
+            chat_message = ChatMessage.from_langchain(message)
+            chat_message.run_id = str(run_id)
+        except Exception as e:
+            yield {'type': 'error', 'content': f'Error parsing message: {e}'}
+            continue
+        if not (chat_message.type == "human" and chat_message.content == user_input.message):
+            logger.debug("%s", Payload(chat_message))
+            yield {'type': 'message', 'content': chat_message}
+
+
+def _token_event(chunk: BaseMessageChunk) -> SSEEvent | None:
+    """Stream event for a token streamed from an LLM, or None if it has no text content."""
+    content = _remove_tool_calls(chunk.content)
+    if content:
+        return {'type': 'token', 'content': convert_message_content_to_string(content)}
+    return None
+
+
+async def _process_stream_event(event: StreamEvent, user_input: Union[StreamInput, ToolCallApproval], run_id: str) -> AsyncGenerator[SSEEvent, None]:
     """Helper to process stream events consistently"""
     if not event:
         return
@@ -137,102 +288,167 @@ async def _process_stream_event(event: StreamEvent, user_input: Union[StreamInpu
         and any(t.startswith("graph:step:") for t in event.get("tags", []))
         and event["data"].get("output") is not None
         and "messages" in event["data"]["output"]
-        and event["metadata"].get("langgraph_node", "") not in ["human_review", "summarize_conversation"]
+        and event["metadata"].get("langgraph_node", "") not in _SILENT_MESSAGE_NODES
     ):
-        new_messages = event["data"]["output"]["messages"]
-        if not isinstance(new_messages, list):
-            new_messages = [new_messages]
-        # This is a proper hacky way to make sure that no messages are sent from the retreiaval decider node
-        if event["metadata"].get("langgraph_node", "") == "retrieval_decider":
-            print(f"Retrieval decider node returned text content, erasing...")
-            erase_content = True
-        else:
-            erase_content = False
-
-        for message in new_messages:
-            if erase_content:
-                message.content = ""
-            try:
-                chat_message = ChatMessage.from_langchain(message)
-                chat_message.run_id = str(run_id)
-            except Exception as e:
-                yield f"data: {json.dumps({'type': 'error', 'content': f'Error parsing message: {e}'})}\n\n"
-                continue
-            if not (chat_message.type == "human" and chat_message.content == user_input.message):
-                chat_message.pretty_print()
-                yield f"data: {json.dumps({'type': 'message', 'content': chat_message.model_dump()})}\n\n"
+        for sse_event in _message_events(event["data"]["output"]["messages"], event["metadata"].get("langgraph_node", ""), user_input, run_id):
+            yield sse_event
     # Handle tokens streamed from LLMs
     if (
         event["event"] == "on_chat_model_stream"
         and user_input.stream_tokens
-        and event['metadata'].get('langgraph_node', '') != "transform_query"
-        and event['metadata'].get('langgraph_node', '') != "retrieval_decider"
-        and event['metadata'].get('langgraph_node', '') != "summarize_conversation"
+        and event['metadata'].get('langgraph_node', '') not in _SILENT_TOKEN_NODES
     ):
-        content = _remove_tool_calls(event["data"]["chunk"].content)
-        if content:
-            yield f"data: {json.dumps({'type': 'token', 'content': convert_message_content_to_string(content)})}\n\n"
+        if sse_event := _token_event(event["data"]["chunk"]):
+            yield sse_event
+
+
+async def _stream_with_astream_events(agent: CompiledStateGraph, kwargs: dict[str, Any], user_input: Union[StreamInput, ToolCallApproval], run_id: str) -> AsyncGenerator[SSEEvent, None]:
+    """
+    Stream events from the callback events of every runnable in the graph and its subgraphs.
+    Kept as a fallback, see _stream_with_graph_modes.
+    """
+    async for event in agent.astream_events(**kwargs, version="v2"):
+        async for sse_event in _process_stream_event(event, user_input, run_id):
+            yield sse_event
+
+
+async def _stream_with_graph_modes(agent: CompiledStateGraph, kwargs: dict[str, Any], user_input: Union[StreamInput, ToolCallApproval], run_id: str) -> AsyncGenerator[SSEEvent, None]:
+    """
+    Stream events using the graph's `updates` and `messages` stream modes.
+    `updates` gives the output of each top level node once it finishes, and `messages` gives the chunks of
+    every chat model, so no events are created for the other runnables in the graph. Tokens are only
+    requested when the client wants them.
+    """
+    stream_mode = ["updates", "messages"] if user_input.stream_tokens else ["updates"]
+    async for mode, payload in agent.astream(**kwargs, stream_mode=stream_mode):
+        if mode == "messages":
+            chunk, metadata = payload
+            # Whole messages returned by nodes are also sent in this mode, those are handled with the updates
+            if isinstance(chunk, BaseMessageChunk) and metadata.get("langgraph_node") not in _SILENT_TOKEN_NODES:
+                if sse_event := _token_event(chunk):
+                    yield sse_event
+        else:
+            for node, update in payload.items():
+                if node in _SILENT_MESSAGE_NODES or not isinstance(update, dict) or "messages" not in update:
+                    continue
+                for sse_event in _message_events(update["messages"], node, user_input, run_id):
+                    yield sse_event
 
 
 @app.get("/status")
 async def get_status() -> dict[str, str]:
-    """Health check endpoint."""
+    """Health check endpoint. This only says the service is up, see /ready for whether it is warmed up."""
     if not app.state.agent:
         raise HTTPException(status_code=500, detail="Agent not initialized")
 
     return {"status": "ok"}
 
 
+@app.get("/ready")
+async def get_ready(response: Response) -> Readiness:
+    """
+    Readiness check for load balancers. Returns 503 until every required component is warm, i.e. vector stores
+    are loaded and connections to the model provider and OBP are open, so that traffic only goes to instances
+    that can serve at full speed. The body lists the warm-up state of each component.
+    """
+    readiness = app.state.warmup.readiness()
+    if not readiness.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return readiness
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    """
+    Metrics in the Prometheus text format: graph node, tool, LLM and OBP latencies, token counts, retrieval
+    grades and the service's queues and streams. With several workers each one serves its own metrics.
+    """
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/models")
+async def get_models() -> ModelList:
+    """List the models that can be selected with the `model` field of /invoke and /stream."""
+    return ModelList(default=model_registry.sizes["medium"], models=model_registry.available_models())
+
+
+def _profile_trigger(x_opey_profile: str | None) -> str | None:
+    """Whether the request's run should be profiled, see RunProfiler.trigger."""
+    if app.state.profiler is None:
+        return None
+    return app.state.profiler.trigger(x_opey_profile)
+
+
 @app.post("/invoke")
-async def invoke(user_input: UserInput) -> ChatMessage:
+async def invoke(user_input: UserInput, response: Response, x_opey_profile: str | None = Header(default=None)) -> ChatMessage:
     """
     Invoke the agent with user input to retrieve a final response.
     Use thread_id to persist and continue a multi-turn conversation. run_id kwarg
     is also attached to messages for recording feedback.
+    When the run is profiled its profile can be fetched from /profiles/{run_id}, see the X-Profile-ID header.
     """
     agent: CompiledStateGraph = app.state.agent
-    kwargs, run_id = _parse_input(user_input)
+    # Runs of a thread are serialized with the streamed ones, invoke runs are never attached to as duplicates
+    user_input.thread_id = user_input.thread_id or str(uuid.uuid4())
+    run, _ = await _reserve_run(user_input.thread_id, uuid.uuid4(), None)
     try:
-        response = await agent.ainvoke(**kwargs)
-        output = ChatMessage.from_langchain(response["messages"][-1])
-        logger.info(f"Replied to thread_id {kwargs['config']['configurable']['thread_id']} with message:\n\n {output.content}\n")
-        output.run_id = str(run_id)
-        return output
-    except Exception as e:
-        logging.error(f"Error invoking agent: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        kwargs, run_id = _parse_input(user_input, uuid.UUID(run.run_id))
+        profile_trigger = _profile_trigger(x_opey_profile)
+        async with app.state.admission.slot("invoke"), app.state.runs.thread_turn(run):
+            try:
+                if profile_trigger:
+                    response.headers["X-Profile-ID"] = str(run_id)
+                    async with app.state.profiler.profile(str(run_id), profile_trigger):
+                        result = await agent.ainvoke(**kwargs)
+                else:
+                    result = await agent.ainvoke(**kwargs)
+                output = ChatMessage.from_langchain(result["messages"][-1])
+                logger.info(f"Replied to thread_id {kwargs['config']['configurable']['thread_id']} with message:\n\n {output.content}\n")
+                output.run_id = str(run_id)
+                return output
+            except Exception as e:
+                logging.error(f"Error invoking agent: {e}")
+                raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # The run's reservation is given up if it never got its turn, i.e. admission was rejected
+        app.state.runs.discard(run)
 
 
-async def message_generator(user_input: StreamInput) -> AsyncGenerator[str, None]:
+async def message_generator(user_input: StreamInput, kwargs: dict[str, Any], run_id: uuid.UUID) -> AsyncGenerator[str, None]:
     """
     Generate a stream of messages from the agent.
     This is the workhorse method for the /stream endpoint.
     """
     agent: CompiledStateGraph = app.state.agent
-    kwargs, run_id = _parse_input(user_input)
     config = kwargs["config"]
-    print(f"------------START STREAM-----------\n\n")
-    # Process streamed events from the graph and yield messages over the SSE stream.
-    async for event in agent.astream_events(**kwargs, version="v2"):
-        async for msg in _process_stream_event(event, user_input, str(run_id)):
-            yield msg
+    logger.debug("Starting stream of run %s", run_id)
+    # Process streamed output from the graph and yield messages over the SSE stream.
+    # Tokens are coalesced and frames encoded according to the client's stream options
+    encoder = SSEEncoder(user_input)
+    stream = _stream_with_astream_events if STREAM_WITH_ASTREAM_EVENTS else _stream_with_graph_modes
+    try:
+        async for frame in encode_sse_stream(stream(agent, kwargs, user_input, str(run_id)), user_input):
+            yield frame
+    except asyncio.CancelledError:
+        # The run was abandoned by the client, see RunManager
+        await _patch_dangling_tool_calls(agent, config)
+        raise
     # Interruption for human in the loop
     # Wait for user approval via HTTP request
     agent_state = await agent.aget_state(config)
     messages = agent_state.values.get("messages", [])
-    print(f"next node: {agent_state.next}")
+    logger.debug("Next node: %s", agent_state.next)
     tool_call_message = messages[-1] if messages else None
 
     if not tool_call_message or not tool_call_message.tool_calls:
         pass
     else:
-        print(f"Tool call message: {tool_call_message}\n")
         tool_call = tool_call_message.tool_calls[0]
-        print(f"Waiting for approval of tool call: {tool_call}\n")
+        logger.debug("Waiting for approval of tool call: %s", Payload(tool_call))
         tool_approval_message = ChatMessage(type="tool", tool_approval_request=True, tool_call_id=tool_call["id"], content="", tool_calls=[tool_call])
         log_chat_message(tool_approval_message.content)
-        yield f"data: {json.dumps({'type': 'message', 'content': tool_approval_message.model_dump()})}\n\n"
-    yield "data: [DONE]\n\n"
+        yield encoder.encode({'type': 'message', 'content': tool_approval_message})
+    yield DONE_FRAME
 
 
 def _sse_response_example() -> dict[int, Any]:
@@ -241,7 +457,7 @@ def _sse_response_example() -> dict[int, Any]:
             "description": "Server Sent Event Response",
             "content": {
                 "text/event-stream": {
-                    "example": "data: {'type': 'token', 'content': 'Hello'}\n\ndata: {'type': 'token', 'content': ' World'}\n\ndata: [DONE]\n\n",
+                    "example": "id: 1\ndata: {'type': 'token', 'content': 'Hello'}\n\nid: 2\ndata: {'type': 'token', 'content': ' World'}\n\nid: 3\ndata: [DONE]\n\n",
                     "schema": {"type": "string"},
                 }
             },
@@ -249,63 +465,191 @@ def _sse_response_example() -> dict[int, Any]:
     }
 
 
+async def _patch_dangling_tool_calls(agent: CompiledStateGraph, config: RunnableConfig) -> None:
+    """
+    Answer the tool calls of a cancelled run, so that the thread's next turn doesn't send the provider
+    tool calls without results. Tool calls waiting for human review are left for the approval endpoint.
+    """
+    agent_state = await agent.aget_state(config)
+    messages = agent_state.values.get("messages", [])
+    last_message = messages[-1] if messages else None
+    if not isinstance(last_message, AIMessage) or not last_message.tool_calls or "human_review" in agent_state.next:
+        return
+    logger.info(f"Answering {len(last_message.tool_calls)} tool call(s) left by the cancelled run on thread {config['configurable']['thread_id']}")
+    await agent.aupdate_state(
+        config,
+        {"messages": [ToolMessage(content="Request was cancelled before the tool call finished", tool_call_id=tool_call["id"]) for tool_call in last_message.tool_calls]},
+        as_node="tools",
+    )
+
+
+def _run_response(run: AgentRun, last_event_id: int = 0) -> StreamingResponse:
+    return StreamingResponse(
+        app.state.runs.subscribe(run, last_event_id),
+        media_type="text/event-stream",
+        headers={"X-Run-ID": run.run_id},
+    )
+
+
+async def _reserve_run(thread_id: str, run_id: uuid.UUID, request_key: Any, allow_wait: bool = True) -> tuple[AgentRun, bool]:
+    """
+    Reserve the thread's next turn for a run, see RunManager.reserve.
+    Returns the reserved run, or the thread's run started by the same request if there is one, and whether it's
+    the latter, in which case the client should be attached to it instead.
+    """
+    if duplicate := app.state.runs.find_duplicate(thread_id, request_key):
+        logger.info(f"Duplicate request on thread {thread_id}, attaching it to run {duplicate.run_id}")
+        return duplicate, True
+    try:
+        return await app.state.runs.reserve(str(run_id), thread_id, request_key, allow_wait=allow_wait), False
+    except ThreadBusyError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+
+def _start_run(run: AgentRun, user_input: StreamInput, profile_trigger: str | None = None) -> StreamingResponse:
+    """
+    Start the reserved agent run for a stream request in the background and stream its frames to the client.
+    The run keeps going if the client disconnects, the client can reattach with GET /stream/{run_id}
+    using the run ID from the X-Run-ID header and the last `id:` it received. With a `profile_trigger`
+    the run is profiled, its profile can be fetched from /profiles/{run_id} once it finishes.
+
+    The caller must hold a run slot from the admission controller, it is released when the run finishes.
+    """
+    try:
+        kwargs, run_id = _parse_input(user_input, uuid.UUID(run.run_id))
+    except BaseException:
+        app.state.admission.release()
+        app.state.runs.discard(run)
+        raise
+    token_usage = RunTokenUsage()
+    kwargs["config"]["callbacks"].append(token_usage)
+    frames = message_generator(user_input, kwargs, run_id)
+    if profile_trigger:
+        frames = app.state.profiler.profile_stream(str(run_id), profile_trigger, frames)
+    app.state.runs.start(run, frames, token_usage)
+    started = time.perf_counter()
+    run.task.add_done_callback(lambda _: app.state.admission.release(time.perf_counter() - started))
+    response = _run_response(run)
+    if profile_trigger:
+        response.headers["X-Profile-ID"] = str(run_id)
+    return response
+
+
 @app.post("/stream", response_class=StreamingResponse, responses=_sse_response_example())
-async def stream_agent(user_input: StreamInput) -> StreamingResponse:
+async def stream_agent(user_input: StreamInput, x_opey_profile: str | None = Header(default=None)) -> StreamingResponse:
     """
     Stream the agent's response to a user input, including intermediate messages and tokens.
     Use thread_id to persist and continue a multi-turn conversation. run_id kwarg
     is also attached to all messages for recording feedback.
     """
     logger.debug(f"Received stream request: {user_input}")
-    return StreamingResponse(message_generator(user_input), media_type="text/event-stream")
+    # Validate before the response starts, errors can't change the status code once streaming
+    _check_model_available(user_input.model)
+    # Runs of a thread are serialized, a repeated request attaches to the run it already started
+    request_key = ("stream", user_input.message, user_input.model)
+    user_input.thread_id = user_input.thread_id or str(uuid.uuid4())
+    run, attached = await _reserve_run(user_input.thread_id, uuid.uuid4(), request_key)
+    if attached:
+        return _run_response(run)
+    try:
+        await app.state.admission.acquire("stream")
+    except BaseException:
+        app.state.runs.discard(run)
+        raise
+    return _start_run(run, user_input, _profile_trigger(x_opey_profile))
 
 
 @app.post("/approval/{thread_id}", response_class=StreamingResponse, responses=_sse_response_example())
-async def user_approval(user_approval_response: ToolCallApproval, thread_id: str) -> StreamingResponse:
-    print(f"[DEBUG] Approval endpoint user_response: {user_approval_response}\n")
+async def user_approval(user_approval_response: ToolCallApproval, thread_id: str, x_opey_profile: str | None = Header(default=None)) -> StreamingResponse:
+    logger.debug("Approval for thread %s: %s", thread_id, Payload(user_approval_response))
+
+    # The approval changes the thread's state before its run starts, so it can't wait for another run of the thread
+    request_key = ("approval", user_approval_response.tool_call_id, user_approval_response.approval)
+    run, attached = await _reserve_run(thread_id, uuid.uuid4(), request_key, allow_wait=False)
+    if attached:
+        return _run_response(run)
+    # Take the run slot before changing the state, so that a rejected approval can simply be retried
+    try:
+        await app.state.admission.acquire("approval")
+    except BaseException:
+        app.state.runs.discard(run)
+        raise
 
     agent: CompiledStateGraph = app.state.agent
-    agent_state = await agent.aget_state({"configurable": {"thread_id": thread_id}})
-    if user_approval_response.approval == "deny":
-        # Answer as if we were the obp requests tool node
-        await agent.aupdate_state(
-            {"configurable": {"thread_id": thread_id}},
-            {"messages": [ToolMessage(content="User denied request to OBP API", tool_call_id=user_approval_response.tool_call_id)]},
-            as_node="tools",
-        )
-    else:
-        # If approved, just continue to the OBP requests node
-        await agent.aupdate_state(
-            {"configurable": {"thread_id": thread_id}},
-            values=None,
-            as_node="human_review",
-        )
-    print(f"[DEBUG] Agent state: {agent_state}\n")
+    try:
+        agent_state = await agent.aget_state({"configurable": {"thread_id": thread_id}})
+        if user_approval_response.approval == "deny":
+            # Answer as if we were the obp requests tool node
+            await agent.aupdate_state(
+                {"configurable": {"thread_id": thread_id}},
+                {"messages": [ToolMessage(content="User denied request to OBP API", tool_call_id=user_approval_response.tool_call_id)]},
+                as_node="tools",
+            )
+        else:
+            # If approved, just continue to the OBP requests node
+            await agent.aupdate_state(
+                {"configurable": {"thread_id": thread_id}},
+                values=None,
+                as_node="human_review",
+            )
+    except BaseException:
+        app.state.admission.release()
+        app.state.runs.discard(run)
+        raise
+    logger.debug("Agent state: %s", Payload(agent_state))
 
     user_input = StreamInput(
         message="",
         thread_id=thread_id,
         is_tool_call_approval=True,
+        # Keep the stream options the client asked for on the approval request
+        **user_approval_response.model_dump(include=set(StreamOptions.model_fields)),
     )
-    return StreamingResponse(message_generator(user_input), media_type="text/event-stream")
+    return _start_run(run, user_input, _profile_trigger(x_opey_profile))
+
+
+@app.get("/stream/{run_id}", response_class=StreamingResponse, responses=_sse_response_example())
+async def reattach_stream(run_id: str, last_event_id: str | None = Header(default=None)) -> StreamingResponse:
+    """
+    Reattach to a run started by /stream or /approval, i.e. after the connection dropped.
+    Frames are sent from after the `Last-Event-ID` header, or from the start of the run without it.
+    Runs can be reattached to until RUN_RETENTION_SECONDS after they finish.
+    """
+    run = app.state.runs.get(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"Run {run_id} not found, it may have finished too long ago")
+    try:
+        resume_from = int(last_event_id) if last_event_id else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid Last-Event-ID: {last_event_id}")
+    logger.info(f"Client reattached to run {run_id} from event {resume_from}")
+    return _run_response(run, resume_from)
+
+
+@app.get("/profiles/{run_id}")
+async def get_profile(run_id: str) -> FileResponse:
+    """
+    Download the profile of a profiled run, a speedscope file (open it in https://www.speedscope.app) or HTML
+    depending on PROFILING_FORMAT. Profiles are saved shortly after their run finishes.
+    """
+    profiler = app.state.profiler
+    path = profiler.path(run_id) if profiler is not None else None
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"No profile for run {run_id}, it may not have finished or been profiled")
+    return FileResponse(path, media_type=profiler.media_type)
 
 
 @app.post("/feedback")
-async def feedback(feedback: Feedback) -> FeedbackResponse:
+async def feedback(feedback: Feedback, request: Request) -> FeedbackResponse:
     """
     Record feedback for a run to LangSmith.
     This is a simple wrapper for the LangSmith create_feedback API, so the
     credentials can be stored and managed in the service rather than the client.
+    The feedback is queued and submitted in the background, so this returns straight away.
     See: https://api.smith.langchain.com/redoc#tag/feedback/operation/create_feedback_api_v1_feedback_post
     """
-    client = LangsmithClient()
-    kwargs = feedback.kwargs or {}
-    client.create_feedback(
-        run_id=feedback.run_id,
-        key=feedback.key,
-        score=feedback.score,
-        **kwargs,
-    )
+    if request.app.state.feedback is not None:
+        request.app.state.feedback.submit(feedback)
     return FeedbackResponse()
 
 
@@ -338,7 +682,7 @@ async def auth(consent_auth_body: ConsentAuthBody, response: Response) -> AuthRe
         logger.debug("Looks like signing the JWT failed OMG")
         logger.error(f"Error in /auth endpoint: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    print("got consent jwt")
+    logger.debug("Signed the consent JWT")
     # Set the JWT cookie
     response.set_cookie(key="jwt", value=opey_jwt, httponly=False, samesite='lax', secure=False)
     return AuthResponse(success=True)
\ No newline at end of file
@@ -0,0 +1,118 @@
+import asyncio
+import json
+
+from collections.abc import AsyncGenerator, AsyncIterator
+from dataclasses import dataclass
+from typing import Any
+
+from schema import ChatMessage, StreamOptions
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, compact frames are then encoded with the standard library
+    orjson = None
+
+# An event on the stream, i.e. {"type": "token", "content": "Hello"}. Message events carry a ChatMessage as content
+SSEEvent = dict[str, Any]
+
+DONE_FRAME = "data: [DONE]\n\n"
+
+
+class SSEEncoder:
+    """Encodes stream events as SSE frames according to the client's stream options."""
+
+    def __init__(self, options: StreamOptions | None = None):
+        options = options or StreamOptions()
+        self.compact_json = options.compact_json
+        self._message_exclude = {"original"} if options.omit_original else None
+
+    def dumps(self, data: Any) -> str:
+        if not self.compact_json:
+            return json.dumps(data)
+        if orjson is not None:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+        return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+    def encode(self, event: SSEEvent) -> str:
+        content = event["content"]
+        if isinstance(content, ChatMessage):
+            content = content.model_dump(exclude=self._message_exclude)
+        return f"data: {self.dumps({'type': event['type'], 'content': content})}\n\n"
+
+
+@dataclass
+class _End:
+    error: BaseException | None = None
+
+
+async def coalesce_tokens(events: AsyncIterator[SSEEvent], window_ms: int, max_bytes: int = 0) -> AsyncGenerator[SSEEvent, None]:
+    """
+    Merge token events arriving within `window_ms` of the first buffered token into a single token event.
+    The buffer is also sent once it holds `max_bytes` of text, and before any other event so that order is kept.
+
+    The events are consumed in a separate task so that the buffer can be sent when the window ends,
+    even if the next event is slow to come. Closing this generator cancels that task.
+    """
+    if window_ms <= 0:
+        async for event in events:
+            yield event
+        return
+
+    window = window_ms / 1000
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def produce() -> None:
+        try:
+            async for event in events:
+                queue.put_nowait(event)
+            queue.put_nowait(_End())
+        except Exception as e:
+            queue.put_nowait(_End(e))
+
+    loop = asyncio.get_running_loop()
+    producer = asyncio.create_task(produce())
+    buffer: list[str] = []
+    buffered_bytes = 0
+    deadline: float | None = None
+    try:
+        while True:
+            if not queue.empty():
+                # Skip setting up a timeout for events that are already waiting
+                item = queue.get_nowait()
+            else:
+                try:
+                    timeout = None if deadline is None else max(deadline - loop.time(), 0)
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    item = None
+
+            if isinstance(item, dict) and item["type"] == "token":
+                if not buffer:
+                    deadline = loop.time() + window
+                buffer.append(item["content"])
+                buffered_bytes += len(item["content"].encode())
+                if not max_bytes or buffered_bytes < max_bytes:
+                    continue
+
+            # The window ended, the buffer is full, or another event has to go out after the tokens
+            if buffer:
+                yield {"type": "token", "content": "".join(buffer)}
+                buffer = []
+                buffered_bytes = 0
+                deadline = None
+            if isinstance(item, _End):
+                if item.error is not None:
+                    raise item.error
+                return
+            if isinstance(item, dict) and item["type"] != "token":
+                yield item
+    finally:
+        producer.cancel()
+
+
+async def encode_sse_stream(events: AsyncIterator[SSEEvent], options: StreamOptions) -> AsyncGenerator[str, None]:
+    """Coalesce and encode stream events into SSE frames according to the client's stream options."""
+    encoder = SSEEncoder(options)
+    async for event in coalesce_tokens(events, options.coalesce_tokens_ms, options.coalesce_tokens_bytes):
+        yield encoder.encode(event)
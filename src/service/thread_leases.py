@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class ThreadLeases:
+    """
+    Leases on threads, kept in the checkpoint database so that they are shared by every worker using it.
+    A run holds the lease on its thread while it runs, so that runs of the same thread on different workers
+    don't load the same checkpoint and interleave their writes. Leases expire after `ttl_seconds` unless
+    renewed, so a crashed worker can't hold a thread forever.
+    """
+
+    def __init__(self, saver: AsyncSqliteSaver, ttl_seconds: float = 30, poll_seconds: float = 0.25):
+        self.saver = saver
+        self.ttl_seconds = ttl_seconds
+        self.poll_seconds = poll_seconds
+        # Identifies this worker, a run's owner is this plus its run ID
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    async def setup(self) -> None:
+        await self.saver.setup()
+        async with self.saver.lock:
+            await self.saver.conn.execute(
+                "CREATE TABLE IF NOT EXISTS thread_leases (thread_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            await self.saver.conn.commit()
+
+    def owner(self, run_id: str) -> str:
+        return f"{self.worker_id}:{run_id}"
+
+    async def try_acquire(self, thread_id: str, owner: str) -> bool:
+        """Take the lease on the thread if it is free or expired. Returns whether `owner` holds it."""
+        now = time.time()
+        async with self.saver.lock:
+            await self.saver.conn.execute(
+                """
+                INSERT INTO thread_leases (thread_id, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (thread_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE thread_leases.expires_at < ? OR thread_leases.owner = excluded.owner
+                """,
+                (thread_id, owner, now + self.ttl_seconds, now),
+            )
+            await self.saver.conn.commit()
+            async with self.saver.conn.execute("SELECT owner FROM thread_leases WHERE thread_id = ?", (thread_id,)) as cursor:
+                row = await cursor.fetchone()
+        return row is not None and row[0] == owner
+
+    async def acquire(self, thread_id: str, owner: str) -> None:
+        """Wait for the lease on the thread."""
+        waited = False
+        while not await self.try_acquire(thread_id, owner):
+            if not waited:
+                logger.info(f"Thread {thread_id} is running on another worker, waiting for it to finish")
+                waited = True
+            await asyncio.sleep(self.poll_seconds)
+
+    async def held_elsewhere(self, thread_id: str) -> bool:
+        """Whether a run on another worker holds an unexpired lease on the thread."""
+        async with self.saver.lock:
+            async with self.saver.conn.execute(
+                "SELECT owner FROM thread_leases WHERE thread_id = ? AND expires_at >= ?", (thread_id, time.time())
+            ) as cursor:
+                row = await cursor.fetchone()
+        return row is not None and not row[0].startswith(f"{self.worker_id}:")
+
+    async def renew(self, thread_id: str, owner: str) -> None:
+        async with self.saver.lock:
+            await self.saver.conn.execute(
+                "UPDATE thread_leases SET expires_at = ? WHERE thread_id = ? AND owner = ?",
+                (time.time() + self.ttl_seconds, thread_id, owner),
+            )
+            await self.saver.conn.commit()
+
+    async def release(self, thread_id: str, owner: str) -> None:
+        async with self.saver.lock:
+            await self.saver.conn.execute("DELETE FROM thread_leases WHERE thread_id = ? AND owner = ?", (thread_id, owner))
+            await self.saver.conn.commit()
+
+    async def keep_renewed(self, thread_id: str, owner: str) -> None:
+        """Renew the lease until cancelled."""
+        while True:
+            await asyncio.sleep(self.ttl_seconds / 3)
+            try:
+                await self.renew(thread_id, owner)
+            except Exception as e:
+                logger.warning(f"Failed to renew the lease on thread {thread_id}: {e}")
+
+
+class PostgresThreadLeases(ThreadLeases):
+    """ThreadLeases kept in the Postgres checkpoint database, shared by the workers of every machine using it."""
+
+    def __init__(self, saver: BaseCheckpointSaver, ttl_seconds: float = 30, poll_seconds: float = 0.25):
+        super().__init__(saver, ttl_seconds, poll_seconds)
+        # The saver's connection pool, see open_checkpointer
+        self.pool = saver.conn
+
+    async def _fetch_owner(self, query: str, params: tuple) -> str | None:
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(query, params)
+            row = await cursor.fetchone() if cursor.description else None
+        return row["owner"] if row else None
+
+    async def setup(self) -> None:
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                "CREATE TABLE IF NOT EXISTS thread_leases (thread_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at DOUBLE PRECISION NOT NULL)"
+            )
+
+    async def try_acquire(self, thread_id: str, owner: str) -> bool:
+        now = time.time()
+        # RETURNING only returns a row if the insert or update happened, i.e. if `owner` holds the lease
+        holder = await self._fetch_owner(
+            """
+            INSERT INTO thread_leases (thread_id, owner, expires_at) VALUES (%s, %s, %s)
+            ON CONFLICT (thread_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE thread_leases.expires_at < %s OR thread_leases.owner = excluded.owner
+            RETURNING owner
+            """,
+            (thread_id, owner, now + self.ttl_seconds, now),
+        )
+        return holder == owner
+
+    async def held_elsewhere(self, thread_id: str) -> bool:
+        holder = await self._fetch_owner(
+            "SELECT owner FROM thread_leases WHERE thread_id = %s AND expires_at >= %s", (thread_id, time.time())
+        )
+        return holder is not None and not holder.startswith(f"{self.worker_id}:")
+
+    async def renew(self, thread_id: str, owner: str) -> None:
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                "UPDATE thread_leases SET expires_at = %s WHERE thread_id = %s AND owner = %s",
+                (time.time() + self.ttl_seconds, thread_id, owner),
+            )
+
+    async def release(self, thread_id: str, owner: str) -> None:
+        async with self.pool.connection() as conn:
+            await conn.execute("DELETE FROM thread_leases WHERE thread_id = %s AND owner = %s", (thread_id, owner))
+
+
+def create_thread_leases(saver: BaseCheckpointSaver, backend: str) -> ThreadLeases | None:
+    """
+    Thread leases in the checkpoint database of the given back end, see checkpoint_backend. None for a single
+    worker on SQLite, where nothing else writes to the database and the RunManager already serializes runs.
+    """
+    if backend == "sqlite" and int(os.getenv("WORKERS", 1)) <= 1:
+        return None
+    ttl_seconds = float(os.getenv("THREAD_LEASE_SECONDS", 30))
+    if backend == "postgres":
+        return PostgresThreadLeases(saver, ttl_seconds=ttl_seconds)
+    return ThreadLeases(saver, ttl_seconds=ttl_seconds)
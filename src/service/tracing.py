@@ -0,0 +1,328 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+from typing import Any, Literal
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from langchain_core.outputs import ChatGeneration, LLMResult
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+traces_total = metrics.counter("opey_traces_total", "Run traces, by result (written, sampled_out, dropped, failed)")
+trace_queue_depth = metrics.gauge("opey_trace_queue_depth", "Run traces waiting to be written")
+
+TraceFormat = Literal["jsonl", "otlp"]
+
+# LangGraph's internal runnables, i.e. channel writes and edge functions, their children are attached to their parent
+_HIDDEN_TAG = "langsmith:hidden"
+# OTLP span kinds
+_SPAN_KIND_INTERNAL = 1
+_SPAN_KIND_CLIENT = 3
+
+
+def _run_name(serialized: dict[str, Any] | None, kwargs: dict[str, Any]) -> str:
+    if kwargs.get("name"):
+        return kwargs["name"]
+    serialized = serialized or {}
+    return serialized.get("name") or (serialized.get("id") or ["unknown"])[-1]
+
+
+class RunTracer(BaseCallbackHandler):
+    """
+    Callback handler recording the span tree of one run: its graph nodes, subgraphs, LLM, tool and retriever calls
+    and OBP requests, with their timings and token counts. When the run ends the trace is kept if it failed, took at
+    least `slow_run_seconds` or is picked by `sample_rate`, and handed to `writer`.
+    """
+
+    run_inline = True
+
+    def __init__(self, writer: "TraceWriter", thread_id: str, sample_rate: float = 0.1, slow_run_seconds: float = 10):
+        self.writer = writer
+        self.thread_id = thread_id
+        self.sample_rate = sample_rate
+        self.slow_run_seconds = slow_run_seconds
+        self.spans: dict[UUID, dict[str, Any]] = {}
+        # Parent of each run, with hidden runs skipped
+        self._parents: dict[UUID, UUID | None] = {}
+        self._root: UUID | None = None
+        self._finished = False
+        self.total_tokens = 0
+
+    def _parent(self, parent_run_id: UUID | None) -> str | None:
+        while parent_run_id is not None and parent_run_id not in self.spans:
+            parent_run_id = self._parents.get(parent_run_id)
+        return str(parent_run_id) if parent_run_id is not None else None
+
+    def _start(self, run_id: UUID, parent_run_id: UUID | None, name: str, kind: str, tags: list[str] | None = None, **attributes: Any) -> None:
+        if self._finished:
+            return
+        if self._root is None and parent_run_id is None:
+            self._root = run_id
+        self._parents[run_id] = parent_run_id
+        if tags and _HIDDEN_TAG in tags and run_id != self._root:
+            return
+        self.spans[run_id] = {
+            "span_id": str(run_id),
+            "parent_id": self._parent(parent_run_id),
+            "name": name,
+            "kind": kind,
+            "start_ns": time.time_ns(),
+            "end_ns": None,
+            "status": "ok",
+            "attributes": {key: value for key, value in attributes.items() if value is not None},
+        }
+
+    def _end(self, run_id: UUID, error: BaseException | None = None, **attributes: Any) -> None:
+        span = self.spans.get(run_id)
+        if span is not None and not self._finished:
+            span["end_ns"] = time.time_ns()
+            span["attributes"].update((key, value) for key, value in attributes.items() if value is not None)
+            if error is not None:
+                span["status"] = "cancelled" if isinstance(error, asyncio.CancelledError) else "error"
+                span["attributes"]["error"] = f"{type(error).__name__}: {error}"[:500]
+        if run_id == self._root:
+            self._finish()
+
+    def _finish(self) -> None:
+        # The trace may be in the writer's thread from here on
+        self._finished = True
+        root = self.spans[self._root]
+        duration = (root["end_ns"] - root["start_ns"]) / 1e9
+        if root["status"] == "ok" and duration < self.slow_run_seconds and random.random() >= self.sample_rate:
+            traces_total.inc(result="sampled_out")
+            return
+        for span in self.spans.values():
+            # Runs cut short by the root ending, i.e. when it was cancelled
+            if span["end_ns"] is None:
+                span["end_ns"] = root["end_ns"]
+                span["status"] = "cancelled"
+        self.writer.submit({
+            "trace_id": str(self._root),
+            "thread_id": self.thread_id,
+            "start_ns": root["start_ns"],
+            "duration_seconds": duration,
+            "status": root["status"],
+            "total_tokens": self.total_tokens,
+            "spans": list(self.spans.values()),
+        })
+
+    def on_chain_start(self, serialized: dict[str, Any], inputs: Any, *, run_id: UUID, parent_run_id: UUID | None = None, tags: list[str] | None = None, metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
+        name = _run_name(serialized, kwargs)
+        node = (metadata or {}).get("langgraph_node")
+        self._start(run_id, parent_run_id, name, "node" if name == node else "chain", tags, langgraph_node=node)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error)
+
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: list, *, run_id: UUID, parent_run_id: UUID | None = None, tags: list[str] | None = None, metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
+        metadata = metadata or {}
+        self._start(
+            run_id, parent_run_id, _run_name(serialized, kwargs), "llm", tags,
+            langgraph_node=metadata.get("langgraph_node"), model=metadata.get("ls_model_name"), messages=sum(len(batch) for batch in messages),
+        )
+
+    def on_llm_start(self, serialized: dict[str, Any], prompts: list[str], *, run_id: UUID, parent_run_id: UUID | None = None, tags: list[str] | None = None, metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
+        metadata = metadata or {}
+        self._start(run_id, parent_run_id, _run_name(serialized, kwargs), "llm", tags, langgraph_node=metadata.get("langgraph_node"), model=metadata.get("ls_model_name"))
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        span = self.spans.get(run_id)
+        if span is not None and "first_token_ns" not in span["attributes"]:
+            span["attributes"]["first_token_ns"] = time.time_ns()
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        usage = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+        for generations in response.generations:
+            for generation in generations:
+                if isinstance(generation, ChatGeneration) and generation.message.usage_metadata:
+                    for key in usage:
+                        usage[key] += generation.message.usage_metadata.get(key, 0)
+        self.total_tokens += usage["total_tokens"]
+        self._end(run_id, **usage)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error)
+
+    def on_tool_start(self, serialized: dict[str, Any], input_str: str, *, run_id: UUID, parent_run_id: UUID | None = None, tags: list[str] | None = None, **kwargs: Any) -> None:
+        self._start(run_id, parent_run_id, _run_name(serialized, kwargs), "tool", tags)
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error)
+
+    def on_retriever_start(self, serialized: dict[str, Any], query: str, *, run_id: UUID, parent_run_id: UUID | None = None, tags: list[str] | None = None, **kwargs: Any) -> None:
+        self._start(run_id, parent_run_id, _run_name(serialized, kwargs), "retriever", tags)
+
+    def on_retriever_end(self, documents: list[Document], *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, documents=len(documents))
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error)
+
+    def on_custom_event(self, name: str, data: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        # OBP requests are reported by the obp_requests tool once they are done, see agent/components/tools.py
+        if name != "obp_request" or self._finished:
+            return
+        end_ns = time.time_ns()
+        span_id = f"{run_id}:obp:{len(self.spans)}"
+        self.spans[span_id] = {
+            "span_id": span_id,
+            "parent_id": self._parent(run_id),
+            "name": f"OBP {data['method']}",
+            "kind": "obp",
+            "start_ns": end_ns - int(data["duration_seconds"] * 1e9),
+            "end_ns": end_ns,
+            "status": "ok" if isinstance(data["status"], int) and data["status"] < 400 else "error",
+            "attributes": {"path": data["path"], "status_code": data["status"]},
+        }
+
+
+def _otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span_id(span_id: str) -> str:
+    # OTLP span IDs are 8 bytes, run IDs are random UUIDs so their first 8 bytes are unique enough
+    if ":obp:" in span_id:
+        run_id, _, index = span_id.partition(":obp:")
+        return f"{int(UUID(run_id).hex[:16], 16) ^ (int(index) + 1):016x}"
+    return UUID(span_id).hex[:16]
+
+
+def to_otlp(trace: dict[str, Any]) -> dict[str, Any]:
+    """A trace in the OTLP JSON format, as written by the OpenTelemetry collector's file exporter."""
+    trace_id = UUID(trace["trace_id"]).hex
+    spans = []
+    for span in trace["spans"]:
+        attributes = {"opey.kind": span["kind"], "thread_id": trace["thread_id"], **span["attributes"]}
+        otlp_span = {
+            "traceId": trace_id,
+            "spanId": _otlp_span_id(span["span_id"]),
+            "name": span["name"],
+            "kind": _SPAN_KIND_CLIENT if span["kind"] in ("llm", "obp") else _SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(span["start_ns"]),
+            "endTimeUnixNano": str(span["end_ns"]),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()],
+            # Status codes: 1 ok, 2 error
+            "status": {"code": 1} if span["status"] == "ok" else {"code": 2, "message": span["attributes"].get("error", span["status"])},
+        }
+        if span["parent_id"]:
+            otlp_span["parentSpanId"] = _otlp_span_id(span["parent_id"])
+        spans.append(otlp_span)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "opey-agent"}}]},
+            "scopeSpans": [{"scope": {"name": "opey.tracing"}, "spans": spans}],
+        }]
+    }
+
+
+class TraceWriter:
+    """
+    Appends run traces to a file from a background task, a JSON line per trace, either as Opey's own span tree
+    or in the OTLP JSON format. Traces are queued, up to `max_queue` of them, and written in batches in a
+    worker thread. When the queue is full new traces are dropped.
+    """
+
+    def __init__(self, path: str, format: TraceFormat = "jsonl", max_queue: int = 1000, batch_size: int = 50):
+        self.path = path
+        self.format = format
+        self.batch_size = batch_size
+        self._queue: asyncio.Queue[dict[str, Any]] = asyncio.Queue(max_queue)
+        self._task: asyncio.Task | None = None
+
+    def submit(self, trace: dict[str, Any]) -> None:
+        """Queue a trace for writing, never blocks."""
+        try:
+            self._queue.put_nowait(trace)
+        except asyncio.QueueFull:
+            traces_total.inc(result="dropped")
+        trace_queue_depth.set(self._queue.qsize())
+
+    def _write(self, batch: list[dict[str, Any]]) -> None:
+        lines = "".join(json.dumps(to_otlp(trace) if self.format == "otlp" else trace, default=str) + "\n" for trace in batch)
+        with open(self.path, "a") as f:
+            f.write(lines)
+
+    async def run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            trace_queue_depth.set(self._queue.qsize())
+            try:
+                await asyncio.to_thread(self._write, batch)
+                traces_total.inc(len(batch), result="written")
+            except Exception as e:
+                logger.warning(f"Failed to write {len(batch)} traces to {self.path}: {e}")
+                traces_total.inc(len(batch), result="failed")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Write the queued traces, waiting up to `timeout` seconds, and stop."""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Trace writer didn't finish within {timeout}s on shutdown, {self._queue.qsize()} traces left unwritten")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+class RunTracing:
+    """Creates a RunTracer for each run, configured with the TRACE_* env vars, see create_run_tracing."""
+
+    def __init__(self, writer: TraceWriter, sample_rate: float, slow_run_seconds: float):
+        self.writer = writer
+        self.sample_rate = sample_rate
+        self.slow_run_seconds = slow_run_seconds
+
+    def tracer(self, thread_id: str) -> RunTracer:
+        return RunTracer(self.writer, thread_id, self.sample_rate, self.slow_run_seconds)
+
+
+def create_run_tracing() -> RunTracing | None:
+    """Local run tracing for TRACE_EXPORT, jsonl, otlp or none (the default)."""
+    export = os.getenv("TRACE_EXPORT", "none")
+    if export == "none":
+        return None
+    if export not in ("jsonl", "otlp"):
+        raise ValueError(f"Unknown TRACE_EXPORT {export}, use jsonl, otlp or none")
+    writer = TraceWriter(
+        os.getenv("TRACE_FILE_PATH", "traces.jsonl"),
+        format=export,
+        max_queue=int(os.getenv("TRACE_QUEUE_SIZE", 1000)),
+    )
+    return RunTracing(
+        writer,
+        sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", 0.1)),
+        slow_run_seconds=float(os.getenv("TRACE_SLOW_RUN_SECONDS", 10)),
+    )
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import time
+
+from collections.abc import Awaitable, Callable
+
+from agent import obp_calling_enabled
+from agent.components.sub_graphs.retriever_config import get_retriever, get_vector_store
+from agent.components.sub_graphs.glossary_retrieval.components.nodes import GLOSSARY_COLLECTION
+from agent.components.sub_graphs.endpoint_retrieval.components.nodes import ENDPOINT_COLLECTION
+from agent.utils.config import get_cached_direct_login_token, get_headers, get_obp_session, obp_base_url
+from agent.utils.model_factory import model_registry
+from schema import ComponentStatus, Readiness
+from utils.chat_log import get_chat_log_sanitizer
+from utils.startup_timing import startup_report
+
+logger = logging.getLogger("uvicorn.error")
+
+WarmupStep = Callable[[], Awaitable[None]]
+
+
+class Warmup:
+    """
+    Warms up the components that would otherwise be initialised by the first request, in the background,
+    and keeps track of which components are warm so that readiness can be reported to the load balancer.
+
+    Steps run concurrently. Required steps that fail are retried every `retry_seconds` until they succeed.
+    """
+
+    def __init__(self, retry_seconds: float = 30):
+        self.retry_seconds = retry_seconds
+        self.components: dict[str, ComponentStatus] = {}
+        self._steps: dict[str, WarmupStep] = {}
+        self._task: asyncio.Task | None = None
+
+    def add(self, component: str, step: WarmupStep, required: bool = True) -> None:
+        self._steps[component] = step
+        self.components[component] = ComponentStatus(status="pending", required=required)
+
+    def skip(self, component: str) -> None:
+        """List a component that isn't used in this configuration, it never blocks readiness."""
+        self.components[component] = ComponentStatus(status="skipped", required=False)
+
+    async def _run_step(self, component: str) -> None:
+        status = self.components[component]
+        status.status = "warming"
+        start = time.perf_counter()
+        try:
+            await self._steps[component]()
+            status.status = "warm"
+            status.error = None
+        except Exception as e:
+            status.status = "failed"
+            status.error = str(e)
+            logger.warning(f"Warm-up of {component} failed: {e}")
+        finally:
+            status.seconds = time.perf_counter() - start
+            startup_report.record(f"warmup:{component}", status.seconds)
+
+    async def run(self) -> None:
+        pending = list(self._steps)
+        while pending:
+            await asyncio.gather(*(self._run_step(component) for component in pending))
+            pending = [c for c in pending if self.components[c].status == "failed" and self.components[c].required]
+            if pending:
+                logger.info(f"Retrying warm-up of {pending} in {self.retry_seconds}s")
+                await asyncio.sleep(self.retry_seconds)
+        logger.info("Warm-up finished, service is ready")
+        startup_report.log(logger)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def readiness(self) -> Readiness:
+        ready = all(status.status == "warm" for status in self.components.values() if status.required)
+        return Readiness(ready=ready, components=self.components)
+
+
+async def _warm_vector_store(collection: str) -> None:
+    # Loading a Chroma collection is blocking
+    await asyncio.to_thread(get_vector_store, collection)
+
+
+async def _warm_obp() -> None:
+    # Log in and open a pooled connection to OBP
+    token = await asyncio.to_thread(get_cached_direct_login_token)
+    if not token:
+        raise ValueError("Could not get a DirectLogin token from OBP")
+    async with get_obp_session().get(f"{obp_base_url}/obp/{os.getenv('OBP_API_VERSION')}/root") as response:
+        await response.read()
+
+
+async def _load_pii_dictionary() -> None:
+    # Names and IDs of the customers and accounts the OBP user can see, so that chat logs are redacted of them
+    version = os.getenv("OBP_API_VERSION")
+    headers = await asyncio.to_thread(get_headers)
+    terms = {}
+    async with get_obp_session().get(f"{obp_base_url}/obp/{version}/users/current/customers", headers=headers) as response:
+        response.raise_for_status()
+        for customer in (await response.json()).get("customers", []):
+            terms[customer.get("legal_name") or ""] = "name"
+            terms[customer.get("customer_number") or ""] = "id"
+            terms[customer.get("customer_id") or ""] = "id"
+    async with get_obp_session().get(f"{obp_base_url}/obp/{version}/my/accounts", headers=headers) as response:
+        response.raise_for_status()
+        for account in (await response.json()).get("accounts", []):
+            terms[account.get("id") or ""] = "id"
+    await asyncio.to_thread(get_chat_log_sanitizer().set_dictionary, terms)
+    logger.info(f"Loaded {len(terms)} names and IDs from OBP to redact from chat logs")
+
+
+async def _synthetic_retrieval() -> None:
+    # The first embedding call pays for the embeddings client's connection setup
+    await get_retriever(GLOSSARY_COLLECTION, k=1).ainvoke("What is a bank account?")
+
+
+def create_warmup() -> Warmup:
+    """
+    Create the warm-up for this configuration, from the WARMUP_* env vars.
+    With WARMUP_ENABLED=false nothing is warmed up and the service is ready straight away.
+    """
+    warmup = Warmup(retry_seconds=float(os.getenv("WARMUP_RETRY_SECONDS", 30)))
+    if os.getenv("WARMUP_ENABLED", "true") != "true":
+        return warmup
+
+    for collection in (GLOSSARY_COLLECTION, ENDPOINT_COLLECTION):
+        warmup.add(f"vector_store:{collection}", lambda collection=collection: _warm_vector_store(collection))
+
+    # One connection per distinct agent model, models of the same provider may share a pool but not all do
+    agent_models = list(dict.fromkeys(model_registry.sizes[size] for size in ("medium", "small")))
+    for model in agent_models:
+        warmup.add(f"model_connection:{model}", lambda model=model: model_registry.aopen_connection(model, temperature=0.7))
+
+    if obp_calling_enabled():
+        warmup.add("obp", _warm_obp)
+    else:
+        warmup.skip("obp")
+
+    if obp_calling_enabled() and os.getenv("PII_OBP_DICTIONARY", "true") == "true":
+        warmup.add("pii_dictionary", _load_pii_dictionary, required=False)
+    else:
+        warmup.skip("pii_dictionary")
+
+    # Synthetic calls cost tokens, so they are opt in and never block readiness
+    if os.getenv("WARMUP_SYNTHETIC_CALLS") == "true":
+        warmup.add("synthetic:retrieval", _synthetic_retrieval, required=False)
+        for model in agent_models:
+            warmup.add(f"synthetic:model:{model}", lambda model=model: model_registry.aping(model, temperature=0.7), required=False)
+
+    return warmup
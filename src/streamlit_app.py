@@ -15,7 +15,7 @@ from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 from PIL import Image
 from client import AgentClient
-from schema import ChatMessage, ToolCallApproval
+from schema import ChatMessage, ModelList, ToolCallApproval
 
 from utils.utils import generate_mermaid_diagram
 from utils.chat_log import log_chat_message
@@ -44,6 +44,11 @@ def get_agent_client() -> AgentClient:
     return AgentClient(agent_url)
 
 
+@st.cache_data(ttl=300)
+def get_available_models() -> ModelList:
+    return get_agent_client().list_models()
+
+
 async def main() -> None:
     st.set_page_config(
         page_title=APP_TITLE,
@@ -67,12 +72,7 @@ async def main() -> None:
     #     await asyncio.sleep(0.1)
     #     st.rerun()
 
-    models = {
-        "OpenAI GPT-4o-mini (streaming)": "gpt-4o-mini",
-        "Gemini 1.5 Flash (streaming)": "gemini-1.5-flash",
-        "Claude 3 Haiku (streaming)": "claude-3-haiku",
-        "llama-3.1-70b on Groq": "llama-3.1-70b",
-    }
+    models = get_available_models()
     # Config options
     with st.sidebar:
         st.image(OPEY_LOGO, width=300)
@@ -80,8 +80,7 @@ async def main() -> None:
         ""
         "Full toolkit for running an AI agent service built with LangGraph, FastAPI and Streamlit"
         with st.popover(":material/settings: Settings", use_container_width=True):
-            m = st.radio("LLM to use", options=models.keys())
-            model = models[m]
+            model = st.radio("LLM to use", options=models.models, index=models.models.index(models.default))
             use_streaming = st.toggle("Stream results", value=True)
 
         @st.dialog("Architecture")
@@ -1,25 +1,245 @@
+import atexit
+import logging
 import os
-from supabase import create_client, Client
+import queue
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Literal, Protocol
 from datetime import datetime
 
-# Initialize Supabase client
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+from utils.metrics import metrics
+from utils.pii import SanitizerPool, create_sanitizer_pool
+from utils.startup_timing import startup_report
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+logger = logging.getLogger("uvicorn.error")
+
+chat_log_records = metrics.counter("opey_chat_log_records_total", "Chat log records, by result (shipped, dropped, failed)")
+chat_log_queue_depth = metrics.gauge("opey_chat_log_queue_depth", "Chat log records waiting to be shipped")
+chat_log_flush_seconds = metrics.histogram("opey_chat_log_flush_seconds", "Duration of chat log batch inserts, by sink")
+
+# Supabase client, created on first use so that importing this module stays cheap
+_supabase: "Client | None" = None
+_supabase_lock = threading.Lock()
+
+
+def get_supabase_client() -> "Client":
+    """Get the shared Supabase client, creating it on first use."""
+    global _supabase
+    with _supabase_lock:
+        if _supabase is None:
+            with startup_report.measure("init:supabase"):
+                from supabase import create_client
+                _supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+        return _supabase
+
+
+class ChatLogSink(Protocol):
+    name: str
+
+    def write(self, records: list[dict[str, Any]]) -> None: ...
+
+
+class SupabaseSink:
+    """Inserts chat log records into the Supabase chat_logs table, a batch per request."""
+
+    name = "supabase"
+
+    def write(self, records: list[dict[str, Any]]) -> None:
+        get_supabase_client().table("chat_logs").insert(records).execute()
+
+
+class SQLiteSink:
+    """Inserts chat log records into a chat_logs table in a local SQLite file, a stand-in for Supabase."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        # Only used from the shipper's thread
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS chat_logs (id INTEGER PRIMARY KEY, timestamp TEXT NOT NULL, message TEXT NOT NULL)")
+        self._conn.commit()
+
+    def write(self, records: list[dict[str, Any]]) -> None:
+        self._conn.executemany("INSERT INTO chat_logs (timestamp, message) VALUES (:timestamp, :message)", records)
+        self._conn.commit()
+
+
+class ChatLogShipper:
+    """
+    Ships chat log records to a sink from a background thread, so that logging never waits on the sink.
+
+    Records are queued in memory, up to `max_queue` of them, and written in batches of up to `batch_size`
+    records, at least every `flush_interval` seconds. Messages are sanitized by `sanitizer` in the shipper's
+    thread, or its worker processes, just before being written. When the queue is full the newest record is dropped, or
+    with the "drop_oldest" policy the oldest queued one. A batch that fails is retried up to `max_retries`
+    times and then dropped. Every record is counted in opey_chat_log_records_total by how it ended.
+    """
+
+    def __init__(
+        self,
+        sink: ChatLogSink,
+        sanitizer: SanitizerPool | None = None,
+        max_queue: int = 10000,
+        batch_size: int = 100,
+        flush_interval: float = 2,
+        drop_policy: Literal["drop_newest", "drop_oldest"] = "drop_newest",
+        max_retries: int = 3,
+    ):
+        self.sink = sink
+        self.sanitizer = sanitizer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drop_policy = drop_policy
+        self.max_retries = max_retries
+        self._queue: queue.Queue[dict[str, Any]] = queue.Queue(max_queue)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="chat-log-shipper", daemon=True)
+        self._thread.start()
+
+    def submit(self, record: dict[str, Any]) -> None:
+        """Queue a record for shipping, never blocks."""
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if self.drop_policy == "drop_oldest":
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    self._queue.put_nowait(record)
+                except queue.Full:
+                    pass
+            chat_log_records.inc(result="dropped")
+        chat_log_queue_depth.set(self._queue.qsize())
+
+    def _next_batch(self) -> list[dict[str, Any]]:
+        """Wait for a full batch, until the flush interval is up or until the shipper is stopping."""
+        batch: list[dict[str, Any]] = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or (self._stopping.is_set() and self._queue.empty()):
+                break
+            try:
+                batch.append(self._queue.get(timeout=min(timeout, 0.1) if self._stopping.is_set() else timeout))
+            except queue.Empty:
+                continue
+        return batch
+
+    def _write(self, batch: list[dict[str, Any]]) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                with chat_log_flush_seconds.time(sink=self.sink.name):
+                    self.sink.write(batch)
+                chat_log_records.inc(len(batch), result="shipped")
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.warning(f"Dropping {len(batch)} chat log records after {attempt + 1} failed attempts: {e}")
+                    chat_log_records.inc(len(batch), result="failed")
+                    return
+                # Don't retry for long while shutting down
+                time.sleep(0 if self._stopping.is_set() else min(2 ** attempt, 30))
+
+    def _run(self) -> None:
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            chat_log_queue_depth.set(self._queue.qsize())
+            if batch and self.sanitizer is not None:
+                try:
+                    messages = self.sanitizer.sanitize_batch([record["message"] for record in batch])
+                except Exception as e:
+                    # Never ship messages that may still hold personal data
+                    logger.warning(f"Dropping {len(batch)} chat log records that failed sanitization: {e}")
+                    chat_log_records.inc(len(batch), result="failed")
+                    continue
+                batch = [{**record, "message": message} for record, message in zip(batch, messages)]
+            if batch:
+                self._write(batch)
+
+    def close(self, timeout: float = 10) -> None:
+        """Ship the queued records and stop, waiting up to `timeout` seconds."""
+        self._stopping.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f"Chat log shipper didn't finish within {timeout}s, {self._queue.qsize()} records were not shipped")
+        elif self.sanitizer is not None:
+            self.sanitizer.close()
+
+
+_shipper: ChatLogShipper | None = None
+_shipper_lock = threading.Lock()
+_sanitizer: SanitizerPool | None = None
+_sanitizer_lock = threading.Lock()
+
+
+def get_chat_log_sanitizer() -> SanitizerPool:
+    """Get the PII sanitizer for chat logs, i.e. to load the names and IDs it should redact."""
+    global _sanitizer
+    with _sanitizer_lock:
+        if _sanitizer is None:
+            _sanitizer = create_sanitizer_pool()
+        return _sanitizer
+
+
+def get_chat_log_shipper() -> ChatLogShipper | None:
+    """Get the shared chat log shipper for the CHAT_LOG_SINK, supabase, sqlite or none. It is created on first use."""
+    global _shipper
+    with _shipper_lock:
+        if _shipper is None:
+            sink_name = os.getenv("CHAT_LOG_SINK", "supabase")
+            if sink_name == "none":
+                return None
+            if sink_name == "supabase":
+                sink = SupabaseSink()
+            elif sink_name == "sqlite":
+                sink = SQLiteSink(os.getenv("CHAT_LOG_SQLITE_PATH", "chat_logs.db"))
+            else:
+                raise ValueError(f"Unknown CHAT_LOG_SINK {sink_name}, use supabase, sqlite or none")
+            _shipper = ChatLogShipper(
+                sink,
+                get_chat_log_sanitizer(),
+                max_queue=int(os.getenv("CHAT_LOG_QUEUE_SIZE", 10000)),
+                batch_size=int(os.getenv("CHAT_LOG_BATCH_SIZE", 100)),
+                flush_interval=float(os.getenv("CHAT_LOG_FLUSH_INTERVAL_SECONDS", 2)),
+                drop_policy=os.getenv("CHAT_LOG_DROP_POLICY", "drop_newest"),
+            )
+            # The service closes it on shutdown, this covers other processes such as the Streamlit app
+            atexit.register(_shipper.close)
+        return _shipper
+
+
+def close_chat_log_shipper(timeout: float = 10) -> None:
+    """Ship the queued chat log records and stop the shipper, if it was started."""
+    global _shipper
+    with _shipper_lock:
+        shipper, _shipper = _shipper, None
+    if shipper is not None:
+        atexit.unregister(shipper.close)
+        shipper.close(timeout)
 
 
 def log_chat_message(message: str):
-    """Log a chat message to Supabase."""
-    # Ensure no PII is logged
-    sanitized_message = sanitize_message(message)
+    """
+    Log a chat message to the chat log sink. The message is sanitized and shipped in the background,
+    this never blocks.
+    """
+    shipper = get_chat_log_shipper()
+    if shipper is None:
+        return
     data = {
         "timestamp": datetime.utcnow().isoformat(),
-        "message": sanitized_message
+        "message": message
     }
-    supabase.table("chat_logs").insert(data).execute()
+    shipper.submit(data)
 
 
 def sanitize_message(message: str) -> str:
-    """Sanitize the message to remove PII."""
-    # Implement PII removal logic here
-    return message
+    """Sanitize the message to remove PII, see PIISanitizer."""
+    return get_chat_log_sanitizer().sanitizer.sanitize(message)
@@ -0,0 +1,141 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+
+from typing import Any
+
+from utils.metrics import metrics
+
+log_records_dropped = metrics.counter("opey_log_records_dropped_total", "Log records dropped, by reason (queue_full, sampled_out)")
+
+# Longest rendering of a Payload in a log message
+PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", 2000))
+
+# Loggers writing to the console, as set up by uvicorn
+_CONSOLE_LOGGERS = ("", "uvicorn", "uvicorn.error", "uvicorn.access")
+
+
+class Payload:
+    """
+    A large object in a log message, i.e. an OBP response, a message or the agent's state. It is only rendered
+    if the record is emitted, and cut to `max_chars`, so logging it on a hot path costs nothing at a disabled level.
+    Messages, and lists of them, are rendered with their pretty_repr, dicts and lists as compact JSON and anything
+    else with repr.
+
+        logger.debug("Response from OBP: %s", Payload(json_response))
+    """
+
+    __slots__ = ("value", "max_chars")
+
+    def __init__(self, value: Any, max_chars: int | None = None):
+        self.value = value
+        self.max_chars = max_chars if max_chars is not None else PAYLOAD_MAX_CHARS
+
+    def __str__(self) -> str:
+        value = self.value
+        if isinstance(value, str):
+            text = value
+        elif hasattr(value, "pretty_repr"):
+            text = value.pretty_repr()
+        elif isinstance(value, list) and value and all(hasattr(item, "pretty_repr") for item in value):
+            text = "\n".join(item.pretty_repr() for item in value)
+        elif isinstance(value, (dict, list)):
+            try:
+                text = json.dumps(value, default=str, ensure_ascii=False)
+            except (TypeError, ValueError):
+                text = repr(value)
+        else:
+            text = repr(value)
+        if self.max_chars and len(text) > self.max_chars:
+            return f"{text[:self.max_chars]}... ({len(text) - self.max_chars} more chars)"
+        return text
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a `rate` sample of the records at or below `max_level`, i.e. of chatty debug logs, and every other record."""
+
+    def __init__(self, rate: float, max_level: int = logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.max_level = max_level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level or random.random() < self.rate:
+            return True
+        log_records_dropped.inc(reason="sampled_out")
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for a QueueListener thread to write, dropping them rather than blocking when the queue is full."""
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc(reason="queue_full")
+
+
+_listeners: list[logging.handlers.QueueListener] = []
+_replaced_handlers: list[tuple[logging.Logger, list[logging.Handler]]] = []
+_lock = threading.Lock()
+
+
+def configure_logging() -> None:
+    """
+    Set up logging for the service, configured with the LOG_* env vars, once uvicorn has set up its loggers.
+
+    The level of the "uvicorn.error" logger, used across the service, agent and subgraphs, is set to LOG_LEVEL.
+    Records at or below LOG_SAMPLE_MAX_LEVEL are sampled at LOG_SAMPLE_RATE. The console handlers are moved
+    behind queues of up to LOG_QUEUE_SIZE records each, written by a background thread, so that requests never
+    wait on the console. Does nothing if logging is already set up.
+    """
+    with _lock:
+        if _listeners:
+            return
+        if level := os.getenv("LOG_LEVEL"):
+            logging.getLogger("uvicorn.error").setLevel(level.upper())
+        sample_rate = float(os.getenv("LOG_SAMPLE_RATE", 1))
+        sample_max_level = logging.getLevelName(os.getenv("LOG_SAMPLE_MAX_LEVEL", "DEBUG").upper())
+        queue_size = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+        if queue_size <= 0:
+            return
+        for name in _CONSOLE_LOGGERS:
+            logger = logging.getLogger(name)
+            handlers = [handler for handler in logger.handlers if not isinstance(handler, logging.handlers.QueueHandler)]
+            if not handlers:
+                continue
+            records: queue.Queue[logging.LogRecord] = queue.Queue(queue_size)
+            queue_handler = NonBlockingQueueHandler(records)
+            if sample_rate < 1:
+                queue_handler.addFilter(SamplingFilter(sample_rate, sample_max_level))
+            # Each logger keeps its own handlers, i.e. uvicorn's access log keeps its format
+            listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+            listener.start()
+            _listeners.append(listener)
+            _replaced_handlers.append((logger, handlers))
+            for handler in handlers:
+                logger.removeHandler(handler)
+            logger.addHandler(queue_handler)
+
+
+def stop_logging() -> None:
+    """Write the queued records and put the console handlers back."""
+    with _lock:
+        for listener in _listeners:
+            listener.stop()
+        for logger, handlers in _replaced_handlers:
+            for handler in [handler for handler in logger.handlers if isinstance(handler, NonBlockingQueueHandler)]:
+                logger.removeHandler(handler)
+            for handler in handlers:
+                logger.addHandler(handler)
+        _listeners.clear()
+        _replaced_handlers.clear()
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,190 @@
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Iterator
+
+# Default latency buckets in seconds, covering fast tool calls up to slow LLM generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = tuple[tuple[str, str], ...]
+
+
+def _label_key(labels: dict[str, str]) -> LabelValues:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: LabelValues) -> str:
+    """Labels in the Prometheus text format, i.e. {model="gpt-4o",role="opey"}"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    """Base class for an in-process metric, values are kept per set of label values."""
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+
+    def samples(self) -> list[tuple[str, LabelValues, float]]:
+        """The metric's current samples, as (sample name, labels, value)."""
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in self._values.items()]
+
+    def render(self) -> str:
+        """The metric in the Prometheus text exposition format."""
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"]
+        lines += [f"{name}{_format_labels(labels)} {_format_value(value)}" for name, labels, value in self.samples()]
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+
+class Gauge(Metric):
+    """Value that can go up and down, i.e. the number of active streams."""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self._values: dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets, plus their sum and count."""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket..., count in +Inf], sum
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    def count(self, **labels: str) -> int:
+        return sum(self._counts.get(_label_key(labels), []))
+
+    def sum(self, **labels: str) -> float:
+        return self._sums.get(_label_key(labels), 0)
+
+    def samples(self) -> list[tuple[str, LabelValues, float]]:
+        with self._lock:
+            counts = {labels: list(bucket_counts) for labels, bucket_counts in self._counts.items()}
+            sums = dict(self._sums)
+        samples = []
+        for labels, bucket_counts in counts.items():
+            # Buckets are kept per bound, Prometheus buckets count every observation up to their bound
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), bucket_counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", tuple(sorted((*labels, ("le", _format_value(bound))))), cumulative))
+            samples.append((f"{self.name}_sum", labels, sums[labels]))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the wall-clock duration of the block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+class MetricsRegistry:
+    """
+    Process-wide collection of metrics. Metrics are created on first use and shared by name,
+    so modules can declare the metrics they record at import time without coordinating.
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls: type, name: str, description: str, **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, description, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric '{name}' is already registered as a {metric.type_name}")
+            return metric
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        return self._get_or_create(Gauge, name, description)
+
+    def histogram(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, description, buckets=buckets)
+
+    def render_prometheus(self) -> str:
+        """Every metric in the Prometheus text exposition format, as served on /metrics."""
+        with self._lock:
+            registered = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return "".join(metric.render() for metric in registered)
+
+
+metrics = MetricsRegistry()
@@ -2,13 +2,18 @@ import json
 import requests
 import aiohttp
 import asyncio
+import logging
 import os
 
 from typing import Any
 
 from dotenv import load_dotenv
 
+from utils.logs import Payload
+
 load_dotenv()
+
+logger = logging.getLogger("uvicorn.error")
 # Config load from .env file
 
 obp_base_url = os.getenv("OBP_BASE_URL")
@@ -26,10 +31,10 @@ def get_direct_login_token():
     response = requests.post(url, headers=headers)
     if response.status_code == 201:
         token = response.json().get('token')
-        print("Token fetched successfully!")
+        logger.debug("DirectLogin token fetched")
         return token
     else:
-        print("Error fetching token:", response.json())
+        logger.warning("Error fetching DirectLogin token: %s", Payload(response.text))
         return None
 
 
@@ -41,9 +46,9 @@ async def _async_request(method: str, url: str, body: Any | None, headers: dict[
                 return response, json_response
             
     except aiohttp.ClientError as e:
-        print(f"Error fetching data from {url}: {e}")
+        logger.warning("Error fetching data from %s: %s", url, e)
     except asyncio.TimeoutError:
-        print(f"Request to {url} timed out")
+        logger.warning("Request to %s timed out", url)
 
 def get_headers():
     token = get_direct_login_token()
@@ -84,7 +89,7 @@ async def obp_requests(method: str, path: str, body: str):
     try:
         r = await _async_request(method, url, json_body, headers=headers)
     except Exception as e:
-        print(f"Error fetching data from {url}: {e}")
+        logger.warning("Error fetching data from %s: %s", url, e)
         return
     
     
@@ -94,7 +99,7 @@ async def obp_requests(method: str, path: str, body: str):
     response, json_response = r 
      
 
-    print("Response from OBP:\n", response.status, json_response)
+    logger.debug("Response from OBP: %s %s", response.status, Payload(json_response))
     
     return response
     
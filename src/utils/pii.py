@@ -0,0 +1,324 @@
+import hashlib
+import hmac
+import os
+import re
+
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Literal
+
+try:
+    # pyahocorasick, a C implementation of the automaton below
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+PIIKind = Literal["email", "iban", "card", "phone", "account", "name", "id"]
+RedactionAction = Literal["mask", "hash", "partial", "keep"]
+
+# One pass over the text finds every candidate, the kind of a run of digits is decided in _classify_digits.
+# ISO dates and times are matched first so that they are kept, rather than taken for phone numbers.
+_COMBINED_PATTERN = re.compile(
+    r"(?P<keep>\b\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?)"
+    r"|(?P<email>\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b)"
+    r"|(?P<iban>\b[A-Z]{2}\d{2}(?: ?[A-Z0-9]{4}){2,7}(?: ?[A-Z0-9]{1,3})?\b)"
+    r"|(?P<digits>(?<![\w.])(?:\+\d{1,3}[ .-]?)?(?:\(\d{1,4}\)[ .-]?)?\d+(?:[ .-]\d+)*(?![\w]))"
+)
+_SEPARATORS = str.maketrans("", "", " .-()+")
+# Amounts, i.e. 99999999.99, and IPv4 addresses, which are kept rather than taken for phone numbers
+_AMOUNT_PATTERN = re.compile(r"\d+\.\d{1,2}")
+_IPV4_PATTERN = re.compile(r"(?:25[0-5]|2[0-4]\d|1?\d?\d)(?:\.(?:25[0-5]|2[0-4]\d|1?\d?\d)){3}")
+
+
+def _luhn_valid(digits: str) -> bool:
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if i % 2:
+            value = value * 2 - 9 if value > 4 else value * 2
+        total += value
+    return total % 10 == 0
+
+
+def _iban_valid(iban: str) -> bool:
+    compact = iban.replace(" ", "")
+    if not 15 <= len(compact) <= 34:
+        return False
+    rearranged = compact[4:] + compact[:4]
+    return int("".join(str(int(c, 36)) for c in rearranged)) % 97 == 1
+
+
+def _classify_digits(text: str) -> PIIKind | None:
+    digits = text.translate(_SEPARATORS)
+    if not digits.isdigit() or _AMOUNT_PATTERN.fullmatch(text) or _IPV4_PATTERN.fullmatch(text):
+        return None
+    if 13 <= len(digits) <= 19 and _luhn_valid(digits):
+        return "card"
+    if text[0] in "+(" and 7 <= len(digits) <= 15:
+        return "phone"
+    if len(digits) == len(text):
+        # A bare run of digits, i.e. an account or customer number
+        return "account" if 8 <= len(digits) <= 18 else None
+    return "phone" if 9 <= len(digits) <= 15 else None
+
+
+def _joins_word(text: str, i: int, step: int) -> bool:
+    """
+    Whether the character at `i`, next to a word, joins it to the next one, i.e. in john.smith or smith_j.
+    "@" and "_" do, and so does "." followed by a word character, but not at the end of a sentence.
+    """
+    if not 0 <= i < len(text) or text[i] not in ".@_":
+        return False
+    return text[i] != "." or (0 <= i + step < len(text) and text[i + step].isalnum())
+
+
+def _word_bounds(text: str, start: int, end: int) -> tuple[int, int]:
+    """The whole word around text[start:end], with ".", "@" and "_" as word characters, see _joins_word."""
+    while start and (text[start - 1].isalnum() or _joins_word(text, start - 1, -1)):
+        start -= 1
+    while end < len(text) and (text[end].isalnum() or _joins_word(text, end, 1)):
+        end += 1
+    return start, end
+
+
+class _Automaton:
+    """Aho-Corasick automaton over lowercased terms, used when pyahocorasick isn't installed."""
+
+    def __init__(self, terms: dict[str, PIIKind]):
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        # Longest term ending at each state, as (length, kind)
+        self.output: list[tuple[int, PIIKind] | None] = [None]
+        for term, kind in terms.items():
+            state = 0
+            for char in term:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                state = next_state
+            self.output[state] = (len(term), kind)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                if self.output[next_state] is None:
+                    self.output[next_state] = self.output[self.fail[next_state]]
+
+    def iter(self, text: str):
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                yield end, output[state]
+
+
+class PIISanitizer:
+    """
+    Redacts personal data from text before it is logged.
+
+    Emails, IBANs, card numbers, phone numbers and account numbers are found in a single pass of one combined
+    pattern, with card numbers and IBANs checked against their checksums to avoid redacting other numbers. Known
+    names and IDs, i.e. the customers and accounts fetched from OBP, are found with an Aho-Corasick automaton,
+    so the cost doesn't grow with the size of the dictionary. Each kind is redacted according to `policy`:
+    - mask: replaced by its kind, i.e. [EMAIL]
+    - hash: replaced by its kind and a keyed hash, so the same value can be followed across logs
+    - partial: all but the last 4 characters are masked
+    - keep: left as is
+
+    The pattern's matches take precedence over the dictionary's, so that a known name in an email address
+    doesn't stop the address from being found:
+
+    >>> sanitizer = PIISanitizer(dictionary={"Smith": "name"})
+    >>> sanitizer.sanitize("Mail john.smith@example.com or Ms Smith on +44 20 7946 0958")
+    'Mail [EMAIL] or Ms [NAME] on [PHONE]'
+    >>> sanitizer.sanitize("Signed in as john.smith.")
+    'Signed in as [NAME].'
+    >>> sanitizer.sanitize("Paid 99999999.99 from 192.168.100.200 to account 12345678")
+    'Paid 99999999.99 from 192.168.100.200 to account [ACCOUNT]'
+    """
+
+    def __init__(self, policy: dict[str, RedactionAction] | None = None, dictionary: dict[str, PIIKind] | None = None, hash_key: str = ""):
+        self.policy = policy or {}
+        self.hash_key = hash_key.encode()
+        self.set_dictionary(dictionary or {})
+
+    def set_dictionary(self, dictionary: dict[str, PIIKind]) -> None:
+        """Replace the known names and IDs, matched case insensitively on word boundaries."""
+        dictionary = {term.lower(): kind for term, kind in dictionary.items() if len(term) >= 3}
+        automaton = None
+        if dictionary and ahocorasick is not None:
+            automaton = ahocorasick.Automaton()
+            for term, kind in dictionary.items():
+                automaton.add_word(term, (len(term), kind))
+            automaton.make_automaton()
+        elif dictionary:
+            automaton = _Automaton(dictionary)
+        # Built before being swapped in, as the shipper's thread may be sanitizing meanwhile
+        self.dictionary, self._automaton = dictionary, automaton
+
+    def __getstate__(self) -> dict:
+        # pyahocorasick automatons can't be pickled, they are rebuilt when sent to a worker process
+        return {"policy": self.policy, "hash_key": self.hash_key, "dictionary": self.dictionary}
+
+    def __setstate__(self, state: dict) -> None:
+        self.policy = state["policy"]
+        self.hash_key = state["hash_key"]
+        self.set_dictionary(state["dictionary"])
+
+    def redact(self, value: str, kind: PIIKind) -> str:
+        action = self.policy.get(kind, "mask")
+        if action == "keep":
+            return value
+        if action == "partial":
+            return "*" * max(len(value) - 4, 0) + value[-4:]
+        if action == "hash":
+            digest = hmac.new(self.hash_key, value.lower().encode(), hashlib.sha256).hexdigest()[:12]
+            return f"[{kind.upper()}:{digest}]"
+        return f"[{kind.upper()}]"
+
+    @staticmethod
+    def _pattern_matches(text: str) -> list[tuple[int, int, PIIKind]]:
+        """Matches of the combined pattern that are personal data, as (start, end, kind)."""
+        matches = []
+        for match in _COMBINED_PATTERN.finditer(text):
+            group = match.lastgroup
+            if group == "digits":
+                kind = _classify_digits(match.group())
+            elif group == "iban":
+                kind = "iban" if _iban_valid(match.group()) else None
+            elif group == "email":
+                kind = "email"
+            else:
+                kind = None
+            if kind:
+                matches.append((match.start(), match.end(), kind))
+        return matches
+
+    def _dictionary_matches(self, text: str, automaton: "_Automaton | ahocorasick.Automaton") -> list[tuple[int, int, PIIKind]]:
+        """
+        Leftmost longest dictionary matches on word boundaries, as (start, end, kind). A match joined to other
+        words by ".", "@" or "_", i.e. smith in john.smith, is widened to the whole word, which is redacted.
+        """
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # A few characters lowercase to several, which would shift the match offsets
+            lowered = "".join(char.lower() if len(char.lower()) == 1 else char for char in text)
+        candidates = sorted(
+            ((end - length + 1, end + 1, kind) for end, (length, kind) in automaton.iter(lowered)),
+            key=lambda match: (match[0], -match[1]),
+        )
+        matches = []
+        last_end = 0
+        for start, end, kind in candidates:
+            if start < last_end:
+                continue
+            if (start and lowered[start - 1].isalnum()) or (end < len(lowered) and lowered[end].isalnum()):
+                continue
+            start, end = _word_bounds(lowered, start, end)
+            if start < last_end:
+                continue
+            matches.append((start, end, kind))
+            last_end = end
+        return matches
+
+    def sanitize(self, text: str) -> str:
+        matches = self._pattern_matches(text)
+        automaton = self._automaton
+        if automaton is not None:
+            # Dictionary matches within a pattern match are dropped, the pattern match is redacted as a whole
+            spans = matches
+            matches = []
+            i = 0
+            for start, end, kind in self._dictionary_matches(text, automaton):
+                while i < len(spans) and spans[i][1] <= start:
+                    matches.append(spans[i])
+                    i += 1
+                if i == len(spans) or end <= spans[i][0]:
+                    matches.append((start, end, kind))
+            matches.extend(spans[i:])
+        if not matches:
+            return text
+        parts = []
+        position = 0
+        for start, end, kind in matches:
+            parts.append(text[position:start])
+            parts.append(self.redact(text[start:end], kind))
+            position = end
+        parts.append(text[position:])
+        return "".join(parts)
+
+
+# Sanitizer of a worker process, see sanitize_batch
+_worker_sanitizer: PIISanitizer | None = None
+
+
+def _init_worker(sanitizer: PIISanitizer) -> None:
+    global _worker_sanitizer
+    _worker_sanitizer = sanitizer
+
+
+def _sanitize_in_worker(texts: list[str]) -> list[str]:
+    return [_worker_sanitizer.sanitize(text) for text in texts]
+
+
+class SanitizerPool:
+    """Runs a PIISanitizer over batches of texts in `workers` processes, or in the calling thread with 0 workers."""
+
+    def __init__(self, sanitizer: PIISanitizer, workers: int = 0, chunk_size: int = 64):
+        self.sanitizer = sanitizer
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._executor: Executor | None = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.sanitizer,))
+        return self._executor
+
+    def set_dictionary(self, dictionary: dict[str, PIIKind]) -> None:
+        self.sanitizer.set_dictionary(dictionary)
+        # Workers hold a copy of the sanitizer, new ones are started with the new dictionary
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def sanitize_batch(self, texts: list[str]) -> list[str]:
+        if self.workers <= 0 or len(texts) <= self.chunk_size:
+            return [self.sanitizer.sanitize(text) for text in texts]
+        chunks = [texts[i:i + self.chunk_size] for i in range(0, len(texts), self.chunk_size)]
+        return [text for chunk in self._get_executor().map(_sanitize_in_worker, chunks) for text in chunk]
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def redaction_policy_from_env() -> dict[str, RedactionAction]:
+    """The redaction policy from PII_REDACTION_POLICY, i.e. "card=partial,email=hash". Kinds not listed are masked."""
+    policy = {}
+    for entry in os.getenv("PII_REDACTION_POLICY", "").split(","):
+        if "=" in entry:
+            kind, action = (part.strip() for part in entry.split("=", 1))
+            if action not in ("mask", "hash", "partial", "keep"):
+                raise ValueError(f"Unknown PII redaction action {action} for {kind}, use mask, hash, partial or keep")
+            policy[kind] = action
+    return policy
+
+
+def create_sanitizer_pool() -> SanitizerPool:
+    """The sanitizer for chat logs, configured with the PII_* env vars."""
+    sanitizer = PIISanitizer(redaction_policy_from_env(), hash_key=os.getenv("PII_HASH_KEY", ""))
+    return SanitizerPool(sanitizer, workers=int(os.getenv("PII_SANITIZER_WORKERS", 0)))
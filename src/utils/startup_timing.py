@@ -0,0 +1,59 @@
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Iterator
+
+from utils.metrics import metrics
+
+startup_seconds = metrics.gauge("opey_startup_seconds", "Time spent importing or initialising each component, by component")
+
+# Taken when this module is first imported, which is as early as the service gets
+_process_start = time.perf_counter()
+
+
+class StartupReport:
+    """
+    Records how long each component takes to import or initialise, so that cold start cost can be broken down.
+    Components initialised lazily on first use are recorded too, so the first request's overhead shows up as well.
+    """
+
+    def __init__(self):
+        self._timings: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.ready_after: float | None = None
+
+    def record(self, component: str, seconds: float) -> None:
+        with self._lock:
+            self._timings[component] = self._timings.get(component, 0) + seconds
+            startup_seconds.set(self._timings[component], component=component)
+
+    @contextmanager
+    def measure(self, component: str) -> Iterator[None]:
+        """Time the body of the with block as part of `component`, i.e. 'import:agent' or 'init:chroma:obp_glossary'."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(component, time.perf_counter() - start)
+
+    def mark_ready(self) -> None:
+        """Record that the service finished starting up and is about to serve requests."""
+        self.ready_after = time.perf_counter() - _process_start
+        startup_seconds.set(self.ready_after, component="total")
+
+    def timings(self) -> dict[str, float]:
+        with self._lock:
+            return dict(self._timings)
+
+    def log(self, logger: logging.Logger) -> None:
+        """Log the timings, slowest component first."""
+        timings = sorted(self.timings().items(), key=lambda item: item[1], reverse=True)
+        lines = [f"  {component:<40} {seconds * 1000:8.1f} ms" for component, seconds in timings]
+        if self.ready_after is not None:
+            lines.append(f"  {'total (process start to ready)':<40} {self.ready_after * 1000:8.1f} ms")
+        logger.info("Startup time report:\n" + "\n".join(lines))
+
+
+startup_report = StartupReport()
@@ -1,8 +1,11 @@
+import logging
 import os
 
-from service import opey_instance
+from agent import get_opey_graph
 from langchain_core.runnables.graph import MermaidDrawMethod
 
+logger = logging.getLogger("uvicorn.error")
+
 def generate_mermaid_diagram(path: str):
     """
     Generate a mermaid diagram from the agent graph
@@ -11,11 +14,11 @@ def generate_mermaid_diagram(path: str):
     try:
         if os.path.exists(path):
             os.remove(path)
-        graph_png = opey_instance.get_graph().draw_mermaid_png(
+        graph_png = get_opey_graph().get_graph().draw_mermaid_png(
             draw_method=MermaidDrawMethod.API,
             output_file_path=path,
         )
         return graph_png
     except Exception as e:
-        print("Error generating mermaid diagram:", e)
+        logger.warning("Error generating mermaid diagram: %s", e)
         return None 
\ No newline at end of file